@@ -1,17 +1,83 @@
+import click
+import hashlib
+import hmac
+import http.client
+import json
 import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 
+from app.config import BaseConfig
+from app.models.device import migrate_devices
+from app.models.syslog import migrate_syslogs as migrate_syslog_documents
+from app.models.syslog_rollup import backfill_rollups
+from app.models.syslog_summary import apply_retention, compact_syslogs, release_pins
+from app.utils.channel_cache import ChannelCache
+from app.utils.export import EXPORT_FORMATS, export_syslogs
+from app.utils.replay import CHUNK_SIZE, replay_files
+from datetime import datetime
+from urllib.parse import urlencode
+from app.utils import syslog_parser
+from app.utils.bench import run_ingest_benchmark
 from app.tasks import run_syslog_server
 from flask import Blueprint
-from multiprocessing import Process
 commands_blueprints = Blueprint("commands", __name__, cli_group=None)
 
+# Sample messages per syslog format, used by the benchmarks
+SAMPLE_MESSAGES = {
+    "cisco": b"<190>1531142: Sep 21 17:27:41.305: %MODULE-2-MOD_DIAG_FAIL: Module 2 (Serial number: JAE230418J0) "
+             b"reported failure Ethernet2/1 due to Fatal runtime Arb error. (DevErr is bitmap of failed modules) "
+             b"in device DEV_XBAR_COMPLEX (device error 0x2)",
+    "cisco-host": b"<189>52: core-sw-01: *Mar  1 18:46:11.123: %LINEPROTO-5-UPDOWN: Line protocol on Interface "
+                  b"GigabitEthernet0/1, changed state to down",
+    "rfc5424": b"<165>1 2003-10-11T22:14:15.003Z mymachine.example.com evntslog - ID47 "
+               b"[exampleSDID@32473 iut=\"3\" eventSource=\"Application\" eventID=\"1011\"] An application event log entry",
+    "rfc3164": b"<34>Oct 11 22:14:15 mymachine su: 'su root' failed for lonvick on /dev/pts/8",
+}
 
-@commands_blueprints.cli.command()
-def make_test():
+# Run in a fresh interpreter by bench-startup, prints the time until slack can post and the slack calls it took
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+from app.models.slack_integration import get_slack_integration
+slack = get_slack_integration()
+slack.channel_id
+elapsed = time.perf_counter() - start
+calls = sum(stats["calls"] + stats["rate_limited"] for stats in slack.api.metrics()["methods"].values())
+print(json.dumps({"seconds": elapsed, "slack_calls": calls}))
+"""
+
+
+# Imports of each process role, measured in a fresh interpreter by bench-imports
+IMPORT_ROLES = {
+    "web": "from app import create_app; create_app()",
+    "ingest": "from app.tasks.tasks import run_syslog_worker; from app.models.slack_integration import get_slack_integration",
+    "worker": "from app import celery; import app.tasks; import app.utils.charts; import app.utils.jira_client",
+}
+# Modules only the workers should load
+HEAVY_MODULES = ("matplotlib", "jira", "pyarrow")
+IMPORT_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "heavy": heavy}}))
+"""
+
+
+@commands_blueprints.cli.command(context_settings={"ignore_unknown_options": True})
+@click.argument("pytest_args", nargs=-1, type=click.UNPROCESSED)
+def make_test(pytest_args: tuple):
     """
-    Run basic tests
+    Run the tests in tests/ with pytest, extra arguments are passed to pytest
     """
-    pass
+    result = subprocess.run([sys.executable, "-m", "pytest", os.path.join(BaseConfig.BASEDIR, "tests"), *pytest_args])
+    sys.exit(result.returncode)
 
 
 @commands_blueprints.cli.command()
@@ -25,20 +91,306 @@ def install_git_hooks():
 
 
 @commands_blueprints.cli.command()
-def start_celery_worker():
+@click.option("--queue", "queues", multiple=True, type=click.Choice(["charts", "io", "beat"]),
+              help="Queues to serve, beat runs the scheduled tasks, default all of them")
+def start_celery_worker(queues: tuple):
     """
-    CLI to start celery worker
+    CLI to start the celery workers, a prefork worker for the charts queue and a thread pool worker for the io queue,
+    and celery beat
     """
-    # Purge all tasks
-    os.system("celery -A app.celery purge -f")
-    worker = Process(target=os.system, args=("celery -A app.celery worker --loglevel=info --pool=solo -n wkr", ))
+    commands = {
+        "charts": [
+            "celery", "-A", "app.celery", "worker", "--loglevel=info", "-Q", "charts", "--pool=prefork",
+            f"--concurrency={BaseConfig.CELERY_CHARTS_CONCURRENCY}", "--prefetch-multiplier=1", "-n", "charts@%h"
+        ],
+        "io": [
+            "celery", "-A", "app.celery", "worker", "--loglevel=info", "-Q", "io", f"--pool={BaseConfig.CELERY_IO_POOL}",
+            f"--concurrency={BaseConfig.CELERY_IO_CONCURRENCY}", "-n", "io@%h"
+        ],
+        # Only one beat may run, the schedule state is kept under tmp/
+        "beat": [
+            "celery", "-A", "app.celery", "beat", "--loglevel=info",
+            f"--schedule={os.path.join(BaseConfig.BASEDIR, 'tmp', 'celerybeat-schedule')}"
+        ],
+    }
+    os.makedirs(os.path.join(BaseConfig.BASEDIR, "tmp"), exist_ok=True)
+    workers = []
+    for queue in queues or commands:
+        env = dict(os.environ)
+        if BaseConfig.METRICS_WORKER_PORT:
+            # The charts worker and its pool processes serve metrics after the io worker's port
+            offset = 0 if queue == "io" else 1
+            env["METRICS_WORKER_PORT"] = str(BaseConfig.METRICS_WORKER_PORT + offset)
+        workers.append(subprocess.Popen(commands[queue], env=env))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        worker.start()
+        # Exit when any worker exits so the container is restarted
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(1)
     except (KeyboardInterrupt, SystemExit):
-        worker.terminate()
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+@commands_blueprints.cli.command()
+@click.option("--mode", type=click.Choice(["socketserver", "asyncio"]), default=BaseConfig.SYSLOG_SERVER_MODE,
+              help="Syslog ingest server implementation")
+@click.option("--workers", type=int, default=BaseConfig.SYSLOG_WORKERS,
+              help="Number of SO_REUSEPORT ingest processes, more than 1 always uses the asyncio server")
+def start_syslog_server(mode: str, workers: int):
+    """
+    CLI to start the syslog server
+    """
+    run_syslog_server(mode=mode, workers=workers)
+
+
+@commands_blueprints.cli.command()
+def migrate_device_syslogs():
+    """
+    Drop the Device.syslogs reference lists and add the unique src_ip index
+    """
+    print("Migrating devices")
+    summary = migrate_devices()
+    print(f"Merged {summary['merged']} duplicate devices, removed syslog lists from {summary['updated']} devices")
+
+
+@commands_blueprints.cli.command()
+def migrate_syslogs():
+    """
+    Create the syslog indexes and set pinned on the syslogs stored before pinning existed
+    """
+    print("Migrating syslogs")
+    summary = migrate_syslog_documents()
+    print(f"Pinned {summary['pinned']} syslogs with a jira ticket, {summary['unpinned']} syslogs can expire")
+
+
+@commands_blueprints.cli.command()
+@click.option("--count", type=int, default=200000, help="Messages to parse per format")
+def bench_parser(count: int):
+    """
+    Microbenchmark of the syslog parser, reports parses/sec per format
+    """
+    for name, message in SAMPLE_MESSAGES.items():
+        messages = [message] * count
+        start = time.perf_counter()
+        syslog_parser.parse_many(messages, src_ip="10.0.0.1", src_port=514)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12} {count / elapsed:>12,.0f} parses/sec")
+
+
+@commands_blueprints.cli.command()
+@click.option("--start", type=click.DateTime(), default=None, help="Only syslogs created from this time")
+@click.option("--end", type=click.DateTime(), default=None, help="Only syslogs created before this time")
+def backfill_syslog_rollups(start: datetime, end: datetime):
+    """
+    Build the hourly syslog rollups used by the charts from the stored syslogs
+    """
+    print("Building syslog rollups")
+    start_time = time.perf_counter()
+    written = backfill_rollups(start_time=start, end_time=end)
+    print(f"Wrote {written} rollups in {time.perf_counter() - start_time:.1f}s")
+
+
+@commands_blueprints.cli.command()
+@click.option("--output", required=True, help="File to write")
+@click.option("--src-ip", "src_ips", multiple=True, help="Only syslogs of this device, can be repeated")
+@click.option("--start", type=click.DateTime(), default=None, help="Only syslogs created from this time")
+@click.option("--end", type=click.DateTime(), default=None, help="Only syslogs created before this time")
+@click.option("--format", "file_format", type=click.Choice(EXPORT_FORMATS), default="parquet",
+              help="Parquet or Arrow IPC file")
+@click.option("--batch-size", type=int, default=BaseConfig.SYSLOG_EXPORT_BATCH_SIZE, help="Rows per row group")
+def export_syslog_file(output: str, src_ips: tuple, start: datetime, end: datetime, file_format: str,
+                       batch_size: int):
+    """
+    Export syslogs to a Parquet or Arrow IPC file for pandas or DuckDB
+    """
+    report = export_syslogs(path=output, src_ips=list(src_ips), start_time=start, end_time=end,
+                            file_format=file_format, batch_size=batch_size)
+    print(f"Exported {report['rows']} syslogs to {output} ({report['bytes'] / 1024 / 1024:.1f}MB) "
+          f"in {report['seconds']:.1f}s, {report['rows_per_second']:,.0f} rows/sec")
 
 
 @commands_blueprints.cli.command()
-def start_syslog_server():
-    run_syslog_server()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--src-ip", default=None, help="Device that sent the syslogs, by default the hostname in each syslog")
+@click.option("--src-port", type=int, default=514, help="Port the syslogs were sent from")
+@click.option("--processes", type=int, default=None, help="Parse processes, default one per core, 0 parses inline")
+@click.option("--post-rate", type=float, default=0,
+              help="Max slack posts per second of the syslogs the rules post, default 0 posts nothing")
+@click.option("--chunk-size", type=int, default=CHUNK_SIZE, help="Bytes of lines parsed and inserted together")
+def replay_syslog(files: tuple, src_ip: str, src_port: int, processes: int, post_rate: float, chunk_size: int):
+    """
+    Store archived syslog files, plain or gzip with one syslog per line, dated by their own timestamps
+    """
+    report = replay_files(paths=list(files), src_ip=src_ip, src_port=src_port, processes=processes,
+                          post_rate=post_rate, chunk_size=chunk_size)
+    print(f"Replayed {report['lines']} lines of {report['files']} files ({report['bytes'] / 1024 / 1024:.1f}MB) "
+          f"in {report['seconds']:.1f}s, {report['lines_per_second'] * 60:,.0f} lines/min")
+    print(f"stored {report['stored']}, dropped by rules {report['dropped']}, skipped without a device "
+          f"{report['skipped']}, older than the retention {report['expired']}, without a timestamp {report['undated']}")
+    print(f"wrote {report['summaries']} daily summaries")
+    print(f"posted {report['posted']}, not posted {report['not_posted']}")
+
+
+@commands_blueprints.cli.command()
+@click.option("--start", type=click.DateTime(), default=None,
+              help="Summarize every device from this day, by default only the days whose syslogs changed")
+@click.option("--end", type=click.DateTime(), default=None, help="Summarize the days before this one, default today")
+def compact_syslog_summaries(start: datetime, end: datetime):
+    """
+    Apply the syslog retention and summarize raw syslogs per device and day
+    """
+    apply_retention()
+    closed_tickets = None
+    if BaseConfig.JIRA_URL:
+        from app.utils.jira_client import closed_jira_issues
+        closed_tickets = closed_jira_issues
+    released = release_pins(closed_tickets=closed_tickets)
+    print(f"Released {released['expired']} expired syslog pins and {released['closed']} of closed jira tickets")
+    start_time = time.perf_counter()
+    written = compact_syslogs(start_time=start, end_time=end)
+    print(f"Wrote {written} daily summaries in {time.perf_counter() - start_time:.1f}s")
+
+
+@commands_blueprints.cli.command()
+@click.option("--requests", "total", type=int, default=5000, help="Requests to send")
+@click.option("--concurrency", type=int, default=8, help="Concurrent keep-alive connections")
+@click.option("--workers", type=int, default=2, help="Gunicorn workers")
+@click.option("--port", type=int, default=5099, help="Port gunicorn listens on")
+def bench_slack_actions(total: int, concurrency: int, workers: int, port: int):
+    """
+    Benchmark of the slack interaction route under gunicorn, reports acknowledged requests/sec
+    """
+    secret = "bench-signing-secret"
+    # An action type without a task so nothing is queued, only verification, parsing and dispatch are measured
+    payload = {"type": "block_actions", "actions": [{"type": "bench", "action_id": "bench"}]}
+    body = urlencode({"payload": json.dumps(payload)}).encode()
+    env = dict(os.environ, SLACK_SIGNING_SECRET=secret)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--bind", f"127.0.0.1:{port}",
+         "--log-level", "warning", "app:create_app()"],
+        env=env
+    )
+    try:
+        _wait_for_port(port=port, timeout=30)
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def client(count: int):
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            timings = []
+            failed = 0
+            for _ in range(count):
+                timestamp = str(int(time.time()))
+                signature = "v0=" + hmac.new(secret.encode(), b"v0:" + timestamp.encode() + b":" + body,
+                                             hashlib.sha256).hexdigest()
+                start = time.perf_counter()
+                connection.request("POST", "/slack/message_actions", body=body, headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "X-Slack-Request-Timestamp": timestamp,
+                    "X-Slack-Signature": signature,
+                })
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                timings.append(time.perf_counter() - start)
+            connection.close()
+            with lock:
+                latencies.extend(timings)
+                errors.append(failed)
+
+        threads = [threading.Thread(target=client, args=(total // concurrency,)) for _ in range(concurrency)]
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    print(f"{len(latencies)} requests in {elapsed:.2f}s, {len(latencies) / elapsed:,.0f} req/sec, {sum(errors)} errors")
+    print(f"p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms")
 
+
+def _wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException(f"Server did not start on port {port}")
+
+
+@commands_blueprints.cli.command()
+@click.option("--runs", type=int, default=3, help="Process starts to measure")
+@click.option("--cold", is_flag=True, help="Clear the cached channel id before the first run")
+def bench_startup(runs: int, cold: bool):
+    """
+    Measure process startup until slack can post, and the slack calls made on the way
+    """
+    if cold:
+        ChannelCache().delete(name=BaseConfig.SLACK_CHANNEL)
+    for run in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True)
+        if output.returncode != 0:
+            raise click.ClickException(output.stderr.strip().splitlines()[-1])
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        print(f"run {run + 1}: {result['seconds']:.3f}s, {result['slack_calls']} slack calls")
+
+
+@commands_blueprints.cli.command()
+@click.option("--role", "roles", multiple=True, type=click.Choice(list(IMPORT_ROLES)), help="Roles to measure, default all")
+def bench_imports(roles: tuple):
+    """
+    Import time and peak RSS per process role, fails if web or ingest load matplotlib or jira
+    """
+    leaked = []
+    for role in roles or IMPORT_ROLES:
+        probe = IMPORT_PROBE.format(imports=IMPORT_ROLES[role], heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True)
+        if output.returncode != 0:
+            raise click.ClickException(output.stderr.strip().splitlines()[-1])
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        print(f"{role:<8} {result['seconds']:>7.3f}s {result['rss_mb']:>8.1f} MB  {', '.join(result['heavy']) or '-'}")
+        if role != "worker" and result["heavy"]:
+            leaked.append(role)
+    if leaked:
+        raise click.ClickException(f"{', '.join(leaked)} imported {', '.join(HEAVY_MODULES)}")
+
+
+@commands_blueprints.cli.command()
+@click.option("--rate", type=int, default=2000, help="Syslogs sent per second")
+@click.option("--duration", type=float, default=10, help="Seconds to send for")
+@click.option("--mode", type=click.Choice(["socketserver", "asyncio"]), default=BaseConfig.SYSLOG_SERVER_MODE,
+              help="Syslog ingest server implementation")
+@click.option("--port", type=int, default=5599, help="UDP port of the benchmarked syslog server")
+@click.option("--mongo-host", default="mongomock://localhost/syslog_bench", help="mongomock:// or a local mongod")
+@click.option("--slack-latency", type=float, default=0.05, help="Seconds the fake slack takes per call")
+@click.option("--rate-limit-every", type=int, default=0, help="Rate limit every Nth post with a 429, 0 disables it")
+@click.option("--post-rate", type=float, default=1000, help="Posts per second per channel allowed by the scheduler")
+@click.option("--storm-suppression", is_flag=True, help="Fold repeated syslogs like production does")
+def bench_ingest(rate: int, duration: float, mode: str, port: int, mongo_host: str, slack_latency: float,
+                 rate_limit_every: int, post_rate: float, storm_suppression: bool):
+    """
+    End to end ingest benchmark against a local fake slack, reports msgs/sec, drop rate and post latency
+    """
+    report = run_ingest_benchmark(
+        rate=rate, duration=duration, port=port, mode=mode, mongo_host=mongo_host, slack_latency=slack_latency,
+        rate_limit_every=rate_limit_every, post_rate=post_rate, storm_suppression=storm_suppression
+    )
+    print(f"sent      {report['sent']} ({report['send_rate']:,.0f} msgs/sec)")
+    print(f"ingested  {report['accepted']} ({report['ingest_rate']:,.0f} msgs/sec), drop rate {report['drop_rate']:.2%}")
+    print(f"posted    {report['posted']}, post queue drops {report['post_dropped']}, 429s {report['rate_limited']}")
+    if report["latency_p50"] is not None:
+        print(f"ingest to post latency p50 {report['latency_p50'] * 1000:.1f}ms, p99 {report['latency_p99'] * 1000:.1f}ms")
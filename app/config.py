@@ -22,17 +22,91 @@ class BaseConfig:
     HOST = os.getenv("HOST")
     PORT = int(os.getenv("PORT"))
     LOGGING_LEVEL_FILTER = 2
+    # Json file of syslog routing rules, relative to the repository root. Without rules every syslog is stored and
+    # syslogs up to LOGGING_LEVEL_FILTER are posted
+    SYSLOG_RULES_FILE = os.getenv("SYSLOG_RULES_FILE")
+    # "socketserver" keeps the original blocking UDPServer, "asyncio" enables the batched ingest server
+    SYSLOG_SERVER_MODE = os.getenv("SYSLOG_SERVER_MODE", "socketserver")
+    SYSLOG_RCVBUF = int(os.getenv("SYSLOG_RCVBUF", 8 * 1024 * 1024))
+    SYSLOG_QUEUE_SIZE = int(os.getenv("SYSLOG_QUEUE_SIZE", 100000))
+    SYSLOG_BATCH_SIZE = int(os.getenv("SYSLOG_BATCH_SIZE", 500))
+    SYSLOG_STATS_INTERVAL = int(os.getenv("SYSLOG_STATS_INTERVAL", 60))
+    # Number of SO_REUSEPORT ingest processes, 1 runs a single server in the current process
+    SYSLOG_WORKERS = int(os.getenv("SYSLOG_WORKERS", 1))
+    # Write-ahead spool of the asyncio server, received syslogs are kept on disk until they are saved to mongo
+    SYSLOG_SPOOL = os.getenv("SYSLOG_SPOOL", "false").lower() == "true"
+    SYSLOG_SPOOL_DIR = os.path.join(BASEDIR, os.getenv("SYSLOG_SPOOL_DIR", "tmp/spool"))
+    SYSLOG_SPOOL_SEGMENT_SIZE = int(os.getenv("SYSLOG_SPOOL_SEGMENT_SIZE", 64 * 1024 * 1024))
+    SYSLOG_SPOOL_QUOTA = int(os.getenv("SYSLOG_SPOOL_QUOTA", 1024 * 1024 * 1024))
+    SYSLOG_SPOOL_COMMIT_INTERVAL = float(os.getenv("SYSLOG_SPOOL_COMMIT_INTERVAL", 1.0))
+    # RFC 6587 TCP listener of the asyncio server next to the UDP one, 0 disables it. TLS is used when a certificate
+    # and key are set
+    SYSLOG_TCP_PORT = int(os.getenv("SYSLOG_TCP_PORT", 0))
+    SYSLOG_TLS_CERT = os.getenv("SYSLOG_TLS_CERT")
+    SYSLOG_TLS_KEY = os.getenv("SYSLOG_TLS_KEY")
+    SYSLOG_TCP_BUFFER_SIZE = int(os.getenv("SYSLOG_TCP_BUFFER_SIZE", 256 * 1024))
+    SYSLOG_TCP_MAX_MESSAGE = int(os.getenv("SYSLOG_TCP_MAX_MESSAGE", 64 * 1024))
+    # Syslogs are written to mongo in bulk when either threshold is hit
+    SYSLOG_WRITE_BATCH_SIZE = int(os.getenv("SYSLOG_WRITE_BATCH_SIZE", 1000))
+    SYSLOG_WRITE_INTERVAL = float(os.getenv("SYSLOG_WRITE_INTERVAL", 1.0))
+    # Syslogs kept for the next flush while mongo is unavailable, the oldest are dropped beyond it
+    SYSLOG_WRITE_MAX_PENDING = int(os.getenv("SYSLOG_WRITE_MAX_PENDING", 100000))
+    DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", 10000))
+    # Days raw syslogs and hourly rollups are kept, 0 keeps them forever. Syslogs are compacted into daily summaries
+    # before they expire, pinned syslogs do not expire
+    SYSLOG_RETENTION_DAYS = int(os.getenv("SYSLOG_RETENTION_DAYS", 0))
+    SYSLOG_ROLLUP_RETENTION_DAYS = int(os.getenv("SYSLOG_ROLLUP_RETENTION_DAYS", 0))
+    # Days a syslog stays pinned after the last chart or export in its slack thread, ticket pins last until it is closed
+    SYSLOG_PIN_DAYS = int(os.getenv("SYSLOG_PIN_DAYS", 30))
+    SYSLOG_SUMMARY_TOP_MNEMONICS = int(os.getenv("SYSLOG_SUMMARY_TOP_MNEMONICS", 10))
+    # Exports are written SYSLOG_EXPORT_BATCH_SIZE rows per row group, Slack exports to SYSLOG_EXPORT_DIR
+    SYSLOG_EXPORT_BATCH_SIZE = int(os.getenv("SYSLOG_EXPORT_BATCH_SIZE", 50000))
+    SYSLOG_EXPORT_DIR = os.path.join(BASEDIR, os.getenv("SYSLOG_EXPORT_DIR", "tmp/exports"))
 
     # Slack Credentials
+    # Requests from Slack are verified with the signing secret, the legacy verification token is only
+    # used when no signing secret is configured
+    SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
+    SLACK_SIGNATURE_MAX_AGE = int(os.getenv("SLACK_SIGNATURE_MAX_AGE", 300))
     SLACK_VERIFICATION_TOKEN = os.getenv("SLACK_VERIFICATION_TOKEN")
     SLACK_USER_OAUTH_TOKEN = os.getenv("SLACK_USER_OAUTH_TOKEN")
     SLACK_CHANNEL = os.getenv("SLACK_CHANNEL")
+    # Base url of the Slack Web API, e.g. a local fake Slack for benchmarks
+    SLACK_API_URL = os.getenv("SLACK_API_URL", "https://www.slack.com/api/")
+    # Ports of the /metrics endpoints of the syslog server and celery worker, 0 disables them. SO_REUSEPORT
+    # syslog workers serve theirs on the following ports
+    METRICS_SYSLOG_PORT = int(os.getenv("METRICS_SYSLOG_PORT", 9101))
+    METRICS_WORKER_PORT = int(os.getenv("METRICS_WORKER_PORT", 9102))
+    # Slack API scheduling, chat_postMessage is limited per channel to SLACK_POST_RATE/s with bursts of SLACK_POST_BURST
+    SLACK_API_THREADS = int(os.getenv("SLACK_API_THREADS", 4))
+    SLACK_POST_RATE = float(os.getenv("SLACK_POST_RATE", 1.0))
+    SLACK_POST_BURST = int(os.getenv("SLACK_POST_BURST", 3))
+    # Background posting of syslog messages, levels up to SLACK_CRITICAL_LEVEL have SLACK_CRITICAL_QUEUE_SIZE
+    # more places in the queue and are posted first
+    SLACK_POST_QUEUE_SIZE = int(os.getenv("SLACK_POST_QUEUE_SIZE", 10000))
+    SLACK_CRITICAL_QUEUE_SIZE = int(os.getenv("SLACK_CRITICAL_QUEUE_SIZE", 100000))
+    SLACK_POSTER_THREADS = int(os.getenv("SLACK_POSTER_THREADS", 4))
+    SLACK_CRITICAL_LEVEL = int(os.getenv("SLACK_CRITICAL_LEVEL", 1))
+    # Repeats of a syslog within STORM_WINDOW seconds are folded into the first one
+    STORM_SUPPRESSION = os.getenv("STORM_SUPPRESSION", "false").lower() == "true"
+    STORM_WINDOW = int(os.getenv("STORM_WINDOW", 300))
+    STORM_MAX_ENTRIES = int(os.getenv("STORM_MAX_ENTRIES", 50000))
+    STORM_UPDATE_INTERVAL = int(os.getenv("STORM_UPDATE_INTERVAL", 30))
+    # Syslogs with a level in SLACK_DIGEST_LEVELS are posted as one summary per device every SLACK_DIGEST_WINDOW seconds
+    SLACK_DIGEST = os.getenv("SLACK_DIGEST", "false").lower() == "true"
+    SLACK_DIGEST_LEVELS = [int(level) for level in os.getenv("SLACK_DIGEST_LEVELS", "2").split(",") if level.strip()]
+    SLACK_DIGEST_WINDOW = int(os.getenv("SLACK_DIGEST_WINDOW", 60))
+    SLACK_DIGEST_SAMPLES = int(os.getenv("SLACK_DIGEST_SAMPLES", 5))
 
     # JIRA Credentials
     JIRA_URL = os.getenv("JIRA_URL")
     JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN")
     JIRA_EMAIL = os.getenv("JIRA_EMAIL")
     JIRA_PROJECT = os.getenv("JIRA_PROJECT")
+    # HTTP connections kept open to jira per worker process
+    JIRA_POOL_SIZE = int(os.getenv("JIRA_POOL_SIZE", 10))
+    # A ticket that is being created for longer than this is assumed lost and can be created again
+    JIRA_CLAIM_TIMEOUT = int(os.getenv("JIRA_CLAIM_TIMEOUT", 300))
 
     # MongoDB setup
     MONGODB_IP = os.getenv("MONGODB_IP")
@@ -45,8 +119,29 @@ class BaseConfig:
     # Celery
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
     CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND")
+    # Charts are rendered on the "charts" queue by a prefork pool, Jira and Slack calls run on the "io" queue
+    # in a thread (or gevent) pool
+    CELERY_CHARTS_CONCURRENCY = int(os.getenv("CELERY_CHARTS_CONCURRENCY", os.cpu_count() or 1))
+    CELERY_IO_CONCURRENCY = int(os.getenv("CELERY_IO_CONCURRENCY", 32))
+    CELERY_IO_POOL = os.getenv("CELERY_IO_POOL", "threads")
+
+    # Chart cache, "redis" or "disk". Charts are cached per device, range and CHART_CACHE_BUCKET seconds
+    CHART_CACHE_BACKEND = os.getenv("CHART_CACHE_BACKEND", "redis")
+    CHART_CACHE_REDIS_URL = os.getenv("CHART_CACHE_REDIS_URL", CELERY_RESULT_BACKEND)
+    CHART_CACHE_DIR = os.path.join(BASEDIR, os.getenv("CHART_CACHE_DIR", "tmp/charts"))
+    CHART_CACHE_TTL = int(os.getenv("CHART_CACHE_TTL", 600))
+    CHART_CACHE_BUCKET = int(os.getenv("CHART_CACHE_BUCKET", 300))
+    # Cache of the slack channel id so processes don't look it up on startup, "redis" or "disk"
+    SLACK_CHANNEL_CACHE_BACKEND = os.getenv("SLACK_CHANNEL_CACHE_BACKEND", "redis")
+    SLACK_CHANNEL_CACHE_REDIS_URL = os.getenv("SLACK_CHANNEL_CACHE_REDIS_URL", CELERY_RESULT_BACKEND)
+    SLACK_CHANNEL_CACHE_DIR = os.path.join(BASEDIR, os.getenv("SLACK_CHANNEL_CACHE_DIR", "tmp/slack"))
+    SLACK_CHANNEL_CACHE_TTL = int(os.getenv("SLACK_CHANNEL_CACHE_TTL", 86400))
 
     # Flask Config
     FLASK_PORT = int(os.getenv("FLASK_PORT"))
     FLASK_IP_ADDRESS = os.getenv("FLASK_IP_ADDRESS")
+    # /syslogs search API, requests need "Authorization: Bearer <SYSLOG_API_TOKEN>", without a token it is disabled
+    SYSLOG_API_TOKEN = os.getenv("SYSLOG_API_TOKEN")
+    SYSLOG_API_PAGE_SIZE = int(os.getenv("SYSLOG_API_PAGE_SIZE", 1000))
+    SYSLOG_API_MAX_PAGE_SIZE = int(os.getenv("SYSLOG_API_MAX_PAGE_SIZE", 10000))
 
@@ -1,4 +1,6 @@
 from app.models.syslog import Syslog
+from app.models.syslog_rollup import SyslogRollup
 from app.models.device import Device
+from app.models.syslog_summary import SyslogDailySummary
 from app.models.slack_integration import SlackIntegration
-from app.models.syslog_server import SyslogUDPHandler
+from app.models.syslog_server import SyslogUDPHandler, AsyncSyslogServer, SyslogWorkerSupervisor
@@ -1,21 +1,97 @@
 import datetime
+import threading
+
 from app import mongo_db
-from app.models import Syslog
+from collections import OrderedDict
+from pymongo import UpdateOne
 
 
 class Device(mongo_db.Document):
     """
-    Schema for mongodb to store devices
+    Schema for mongodb to store devices. Syslogs reference their device by src_ip
     """
     src_ip = mongo_db.StringField()
     src_port = mongo_db.IntField()
     syslog_count = mongo_db.IntField()
-    syslogs = mongo_db.ListField(mongo_db.ReferenceField(Syslog))
     date_created = mongo_db.DateTimeField(default=datetime.datetime.now)
 
+    meta = {
+        "indexes": [{"fields": ["src_ip"], "unique": True}],
+        # Existing databases can have duplicate devices, the index is created by `flask migrate-device-syslogs`
+        "auto_create_index": False,
+        # Devices that were not migrated yet still have the old syslogs list
+        "strict": False,
+    }
+
     def __init__(self, src_ip: str, src_port: str, **kwargs):
         if "syslog_count" not in kwargs:
             syslog_count = 0
             super().__init__(src_ip=src_ip, src_port=src_port, syslog_count=syslog_count, **kwargs)
         else:
-            super().__init__(src_ip=src_ip, src_port=src_port, **kwargs)
\ No newline at end of file
+            super().__init__(src_ip=src_ip, src_port=src_port, **kwargs)
+
+    @staticmethod
+    def count_update(src_ip: str, src_port: int, count: int, known: bool) -> UpdateOne:
+        """
+        Atomic update that adds count to the syslog_count of a device. Unknown devices are upserted
+        :param src_ip:
+        :param src_port:
+        :param count:
+        :param known: The device is known to exist
+        :return:
+        """
+        if known:
+            return UpdateOne({"src_ip": src_ip}, {"$inc": {"syslog_count": count}})
+        return UpdateOne(
+            {"src_ip": src_ip},
+            {
+                "$inc": {"syslog_count": count},
+                "$setOnInsert": {"src_port": src_port, "date_created": datetime.datetime.now()}
+            },
+            upsert=True
+        )
+
+
+class DeviceCache:
+    """
+    LRU set of device ips that are known to exist in mongo
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, src_ip: str) -> bool:
+        with self.lock:
+            if src_ip not in self.devices:
+                return False
+            self.devices.move_to_end(src_ip)
+            return True
+
+    def add(self, src_ip: str) -> None:
+        with self.lock:
+            self.devices[src_ip] = True
+            self.devices.move_to_end(src_ip)
+            if len(self.devices) > self.size:
+                self.devices.popitem(last=False)
+
+
+def migrate_devices() -> dict:
+    """
+    Remove the Device.syslogs reference list, merge duplicate devices and create the unique src_ip index
+    :return: Summary of the migration
+    """
+    collection = Device._get_collection()
+    merged = 0
+    duplicates = collection.aggregate([
+        {"$group": {"_id": "$src_ip", "ids": {"$push": "$_id"}, "count": {"$sum": {"$ifNull": ["$syslog_count", 0]}}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True)
+    for duplicate in duplicates:
+        keep, remove = duplicate["ids"][0], duplicate["ids"][1:]
+        collection.update_one({"_id": keep}, {"$set": {"syslog_count": duplicate["count"]}})
+        collection.delete_many({"_id": {"$in": remove}})
+        merged += len(remove)
+    unset = collection.update_many({"syslogs": {"$exists": True}}, {"$unset": {"syslogs": ""}})
+    Device.ensure_indexes()
+    return {"merged": merged, "updated": unset.modified_count}
@@ -0,0 +1,120 @@
+import atexit
+import logging
+import threading
+import time
+
+from app.config import BaseConfig
+from app.utils.metrics import QUEUE_DEPTH, SYSLOGS_TOTAL
+from collections import Counter
+from typing import Iterable
+
+DIGESTED = SYSLOGS_TOTAL.labels("digested")
+
+
+class DigestEntry:
+    """
+    Syslogs of one device in the current window
+    """
+    __slots__ = ("channel", "src_ip", "hostname", "count", "levels", "mnemonics", "samples", "first_time",
+                 "last_time")
+
+    def __init__(self, channel: str, message: dict):
+        self.channel = channel
+        self.src_ip = message["src_ip"]
+        self.hostname = message.get("hostname")
+        self.count = 0
+        self.levels = Counter()
+        self.mnemonics = Counter()
+        # (syslog_id, syslog) of the first syslogs of each mnemonic
+        self.samples = []
+        self.first_time = message["time"]
+        self.last_time = message["time"]
+
+
+class SlackDigest:
+    """
+    Collects the syslogs of the digest levels per device and channel, and posts one summary per device every window
+    seconds instead of a message per syslog. Levels up to SLACK_CRITICAL_LEVEL are never digested
+    """
+    def __init__(self, slack_integration, window: int = BaseConfig.SLACK_DIGEST_WINDOW,
+                 levels: Iterable[int] = BaseConfig.SLACK_DIGEST_LEVELS,
+                 max_samples: int = BaseConfig.SLACK_DIGEST_SAMPLES):
+        self.slack_integration = slack_integration
+        self.window = window
+        self.levels = {level for level in levels if level > BaseConfig.SLACK_CRITICAL_LEVEL}
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.thread = None
+        self.digested = 0
+        self.posted = 0
+        QUEUE_DEPTH.set_function(lambda: len(self.entries), "slack_digest")
+
+    def add(self, message: dict, channel: str = None, repeat: bool = False) -> bool:
+        """
+        Add a stored syslog to the digest of its device
+        :param message: message dict with syslog_id
+        :param channel: channel name, the default channel if not set
+        :param repeat: a repeat folded by storm suppression, syslog_id is its first occurrence. It is counted in the
+        digest but not as a digested syslog
+        :return: True if the syslog is digested, False if it has to be posted on its own
+        """
+        if message["level"] not in self.levels:
+            return False
+        channel = channel or BaseConfig.SLACK_CHANNEL
+        key = (channel, message["src_ip"])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = DigestEntry(channel=channel, message=message)
+            entry.count += 1
+            entry.levels[message["level"]] += 1
+            mnemonic = "-".join(filter(None, (message.get("facility"), message.get("mnemonic")))) or None
+            if entry.mnemonics[mnemonic] == 0 and len(entry.samples) < self.max_samples:
+                entry.samples.append((message["syslog_id"], message["syslog"]))
+            entry.mnemonics[mnemonic] += 1
+            entry.last_time = message["time"]
+            if not repeat:
+                self.digested += 1
+        if not repeat:
+            DIGESTED.inc()
+        self._start()
+        return True
+
+    def flush(self) -> None:
+        """
+        Post the digests collected so far
+        :return:
+        """
+        with self.lock:
+            entries, self.entries = self.entries, dict()
+        for entry in entries.values():
+            try:
+                response = self.slack_integration.post_digest(entry=entry)
+            except Exception as e:
+                logging.error(f"Error posting syslog digest of {entry.src_ip}: {e}")
+                continue
+            if not response:
+                continue
+            self.posted += 1
+            # Jira tickets and charts of the sampled syslogs are posted in the digest thread
+            for syslog_id, _ in entry.samples:
+                self.slack_integration.writer.set_thread_ts(syslog_id=syslog_id, thread_ts=response.data["ts"])
+
+    def _start(self) -> None:
+        if self.thread:
+            return
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name="slack-digest", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error posting syslog digests: {e}")
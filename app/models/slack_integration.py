@@ -1,14 +1,53 @@
 import logging
+import os
+import threading
+import time
 
 from app.config import BaseConfig
-from app.models import Device
 from app.models import Syslog
+from app.models.slack_digest import DigestEntry, SlackDigest
+from app.models.slack_poster import SlackPoster
+from app.models.slack_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_UPDATE, SlackScheduler
+from app.models.storm_suppressor import StormSuppressor, fingerprint
+from app.models.syslog_writer import SyslogWriter
+from app.utils import syslog_parser
+from app.utils.channel_cache import ChannelCache
+from app.utils.metrics import STAGE_SECONDS, SYSLOGS_TOTAL
+from app.utils.rules import ACTION_DROP, ACTION_STORE, load_rules, route
 from app.utils.utils import generate_mkdn_message
 from slack_sdk import WebClient
 from slack_sdk.web import SlackResponse
 from slack_sdk.errors import SlackApiError
-from typing import Tuple
-from socket import socket
+from typing import Optional, Tuple
+
+# Errors of a post to a channel id that is no longer valid, the channel is looked up again
+STALE_CHANNEL_ERRORS = ("channel_not_found", "not_in_channel", "is_archived")
+
+PARSE_SECONDS = STAGE_SECONDS.labels("parse")
+ROUTE_SECONDS = STAGE_SECONDS.labels("route")
+SUPPRESS_SECONDS = STAGE_SECONDS.labels("suppress")
+BUFFER_SECONDS = STAGE_SECONDS.labels("buffer")
+DROPPED = SYSLOGS_TOTAL.labels("dropped")
+SUPPRESSED = SYSLOGS_TOTAL.labels("suppressed")
+STORED = SYSLOGS_TOTAL.labels("stored")
+
+_slack_integration = None
+_slack_integration_pid = None
+_slack_integration_lock = threading.Lock()
+
+
+def get_slack_integration() -> "SlackIntegration":
+    """
+    SlackIntegration shared by everything in this process, created on first use so importing the app makes no
+    Slack calls. A new one is created after a fork
+    :return:
+    """
+    global _slack_integration, _slack_integration_pid
+    if _slack_integration is None or _slack_integration_pid != os.getpid():
+        with _slack_integration_lock:
+            if _slack_integration is None or _slack_integration_pid != os.getpid():
+                _slack_integration, _slack_integration_pid = SlackIntegration(), os.getpid()
+    return _slack_integration
 
 
 class SlackIntegration:
@@ -16,65 +55,176 @@ class SlackIntegration:
     Class to handle all slack interactions
     """
     def __init__(self):
-        self.client = WebClient(token=BaseConfig.SLACK_USER_OAUTH_TOKEN)
+        self.client = WebClient(token=BaseConfig.SLACK_USER_OAUTH_TOKEN, base_url=BaseConfig.SLACK_API_URL)
+        # Every API call goes through the scheduler to respect Slack's rate limits
+        self.api = SlackScheduler(client=self.client)
         self.user_token = BaseConfig.SLACK_USER_OAUTH_TOKEN
-        self.channel_id = None
-        self.join_channel()
+        self.channel_ids = dict()
+        self.channel_lock = threading.Lock()
+        self.channel_cache = ChannelCache()
+        self.rules = load_rules()
+        self.writer = SyslogWriter()
+        self.poster = SlackPoster(slack_integration=self)
+        self.suppressor = StormSuppressor(slack_integration=self) if BaseConfig.STORM_SUPPRESSION else None
+        self.digest = SlackDigest(slack_integration=self) if BaseConfig.SLACK_DIGEST else None
+
+    @property
+    def channel_id(self) -> str:
+        """
+        Id of the default channel, resolved on first use
+        :return:
+        """
+        return self.get_channel_id(name=BaseConfig.SLACK_CHANNEL)
+
+    def get_channel_id(self, name: str) -> str:
+        """
+        Id of a channel, resolved and joined on first use
+        :param name:
+        :return:
+        """
+        channel_id = self.channel_ids.get(name)
+        if channel_id is None:
+            with self.channel_lock:
+                if name not in self.channel_ids:
+                    self.join_channel(name=name)
+                channel_id = self.channel_ids[name]
+        return channel_id
 
     def post_any_message(self, kwargs) -> None:
         try:
-            response = self.client.chat_postMessage(**kwargs)
+            response = self.api.call("chat_postMessage", priority=PRIORITY_INTERACTIVE, **kwargs).result()
             logging.info(f"Response: {response}")
         except SlackApiError as e:
             logging.error(f"Error uploading file: {e}")
 
     def post_message(self, message: dict) -> any:
         """
-        This function will post a message in the default channel if level is error
+        This function will post a message in the channel a rule routed it to, or the default channel
         :param message:
         :return:
         """
         logging.info(message)
-        # If the level is greater, do not post messages
-        if message["level"] > BaseConfig.LOGGING_LEVEL_FILTER:
-            return
+        channel = message.pop("channel", None) or BaseConfig.SLACK_CHANNEL
+        blocks = self._generate_slack_block(message=message)
+        text = generate_mkdn_message(message=message, format="JIRA")
+        try:
+            try:
+                return self._post_blocks(channel=channel, priority=message["level"], blocks=blocks, text=text)
+            except SlackApiError as e:
+                if e.response["error"] not in STALE_CHANNEL_ERRORS:
+                    raise
+                # The cached channel id is stale, look the channel up and join it again
+                logging.warning(f"Channel {channel} is no longer valid: {e.response['error']}")
+                self.channel_cache.delete(name=channel)
+                with self.channel_lock:
+                    self.join_channel(name=channel, use_cache=False)
+                return self._post_blocks(channel=channel, priority=message["level"], blocks=blocks, text=text)
+        except SlackApiError as e:
+            logging.error(f"Got an error: {e.response['error']}")
+
+    def _post_blocks(self, channel: str, priority: int, blocks: list, text: str) -> SlackResponse:
+        return self.api.call(
+            "chat_postMessage",
+            priority=priority,
+            channel=self.get_channel_id(name=channel),
+            blocks=blocks,
+            mrkdwn=True,
+            text=text
+        ).result()
+
+    def post_digest(self, entry: DigestEntry) -> any:
+        """
+        Post the summary of a device's syslogs over a digest window
+        :param entry:
+        :return:
+        """
+        try:
+            return self._post_blocks(
+                channel=entry.channel, priority=min(entry.levels), blocks=self._generate_digest_block(entry=entry),
+                text=f"{entry.count} syslogs from {entry.src_ip}"
+            )
+        except SlackApiError as e:
+            logging.error(f"Got an error: {e.response['error']}")
+
+    def update_message(self, channel: str, ts: str, message: dict, repeats: int) -> any:
+        """
+        Update a posted syslog message with the number of times it was repeated
+        :param channel:
+        :param ts: ts of the posted message
+        :param message: message dict with syslog_id
+        :param repeats:
+        :return:
+        """
         try:
             blocks = self._generate_slack_block(message=message)
-            response = self.client.chat_postMessage(
-                channel=self.channel_id,
+            blocks.insert(1, {
+                "type": "context",
+                "elements": [{"type": "mrkdwn", "text": f":repeat: Repeated {repeats} more times"}]
+            })
+            return self.api.call(
+                "chat_update",
+                priority=PRIORITY_UPDATE,
+                channel=channel,
+                ts=ts,
                 blocks=blocks,
-                mrkdwn=True,
                 text=generate_mkdn_message(message=message, format="JIRA")
-            )
-            return response
+            ).result()
         except SlackApiError as e:
             logging.error(f"Got an error: {e.response['error']}")
 
-    def join_channel(self) -> None:
+    def join_channel(self, name: str = None, use_cache: bool = True) -> None:
         """
-        Function will check if channel exists, then will join it
+        Function will check if channel exists, then will join it. A cached channel id was already joined
+        :param name: channel name, the default channel if not set
+        :param use_cache: use the channel id cached by another process
         :return:
         """
-        response = self.client.conversations_list()
-        for channel in response.data["channels"]:
-            if channel["name"] == BaseConfig.SLACK_CHANNEL:
-                self.channel_id = channel["id"]
-        if not self.channel_id:
-            raise Exception(f"Channel: {BaseConfig.SLACK_CHANNEL} was not found")
-        self.client.conversations_join(channel=self.channel_id)
+        name = name or BaseConfig.SLACK_CHANNEL
+        channel_id = self.channel_cache.get(name=name) if use_cache else None
+        if channel_id:
+            self.channel_ids[name] = channel_id
+            return
+        channel_id = self.find_channel(name=name)
+        if not channel_id:
+            raise Exception(f"Channel: {name} was not found")
+        self.api.call("conversations_join", channel=channel_id).result()
+        self.channel_ids[name] = channel_id
+        self.channel_cache.set(name=name, channel_id=channel_id)
 
-    def upload_file(self, filename: str) -> SlackResponse:
+    def find_channel(self, name: str) -> Optional[str]:
+        """
+        Look up a channel id by name, page by page until it is found
+        :param name:
+        :return:
+        """
+        cursor = None
+        while True:
+            response = self.api.call(
+                "conversations_list", exclude_archived=True, limit=1000, cursor=cursor
+            ).result()
+            for channel in response.data["channels"]:
+                if channel["name"] == name:
+                    return channel["id"]
+            cursor = response.data.get("response_metadata", dict()).get("next_cursor")
+            if not cursor:
+                return None
+
+    def upload_file(self, filename: str, content: bytes = None) -> SlackResponse:
         """
         This will upload a file to slack
-        :param filename:
+        :param filename: path of the file, or its name when content is given
+        :param content: file content to upload instead of reading filename
         :return:
         """
         try:
             # Send Slack Message
-            response = self.client.files_upload(
-                file=filename,
+            response = self.api.call(
+                "files_upload",
+                priority=PRIORITY_BULK,
+                file=content if content is not None else filename,
+                filename=os.path.basename(filename),
             )
-            return response
+            return response.result()
         except SlackApiError as e:
             logging.error(f"Error uploading file: {e}")
 
@@ -85,58 +235,69 @@ class SlackIntegration:
         :return:
         """
         try:
-            response = self.client.files_sharedPublicURL(
+            response = self.api.call(
+                "files_sharedPublicURL",
+                priority=PRIORITY_BULK,
                 file=slack_file_id,
                 token=self.user_token
             )
-            return response
+            return response.result()
         except SlackApiError as e:
             logging.error(f"Error uploading file: {e}")
 
-    def process_syslog_message(self, request: Tuple[bytes, socket]):
+    def process_syslog_message(self, data: bytes, address: Tuple[str, int]):
         """
         This function will parse the message and store it as a message_dict.
         We will also save it to mongo db
-        :param request: Tuple that contains bytes and socket
+        :param data: Raw syslog message
+        :param address: Address of the device that sent the message
         :return:
         """
         # Parse data from socket request
-        message = bytes.decode(request[0].strip())
-        source_ip_address, source_port = request[1].getsockname()
-        message_list = message.split("-")
-
-        # Store it in a data structure
-        message_dict = dict()
-        message_dict["src_port"] = source_port
-        message_dict["src_ip"] = source_ip_address
-        message_dict["time"] = message_list[0].split(":", 1)[1].split(": ")[0].strip()
-        message_dict["level"] = int(message_list[1])
-        message_dict["syslog"] = message_list[2]
-
-        # Save to mongo
-        devices = Device.objects(src_ip=source_ip_address)
-        if not devices:
-            device = Device(src_ip=source_ip_address, src_port=source_port)
-        else:
-            device = devices[0]
-
-        # Save syslog to database
-        syslog = Syslog(**message_dict)
-        syslog.save()
-        message_dict["syslog_id"] = str(syslog.id)
+        start = time.perf_counter()
+        source_ip_address, source_port = address[:2]
+        message_dict = syslog_parser.parse(data=data, src_ip=source_ip_address, src_port=source_port)
+        parsed = time.perf_counter()
+        PARSE_SECONDS.observe(parsed - start)
 
-        # Send message
-        response = self.post_message(message=message_dict)
+        # Rules decide what is stored and posted where, dropped syslogs cost nothing more
+        rule = route(rules=self.rules, message=message_dict)
+        routed = time.perf_counter()
+        ROUTE_SECONDS.observe(routed - parsed)
+        parsed = routed
+        if rule.action == ACTION_DROP:
+            DROPPED.inc()
+            return
 
-        # Get the slack thread id and save it to the syslog
-        thread_ts = response.data["ts"]
-        syslog.thread_ts = thread_ts
-        syslog.save()
+        # Repeats of a recent message are only counted on the first occurrence
+        if self.suppressor:
+            key = fingerprint(message=message_dict)
+            repeat = self.suppressor.check(key=key)
+            checked = time.perf_counter()
+            SUPPRESS_SECONDS.observe(checked - parsed)
+            parsed = checked
+            if repeat:
+                SUPPRESSED.inc()
+                # The first occurrence is in a digest, which counts its repeats too
+                if self.digest and rule.action != ACTION_STORE:
+                    message_dict["syslog_id"] = repeat
+                    self.digest.add(message=message_dict, channel=rule.channel, repeat=True)
+                return
+
+        # Buffer the syslog, it is written to mongo in bulk together with the device counters
+        syslog = Syslog(**message_dict)
+        message_dict["syslog_id"] = self.writer.add(syslog=syslog)
+        if self.suppressor:
+            self.suppressor.add(key=key, message=message_dict)
+        BUFFER_SECONDS.observe(time.perf_counter() - parsed)
+        STORED.inc()
 
-        # Reference is in the device and save the device
-        device.syslogs.append(syslog)
-        device.syslog_count += 1
-        device.save()
+        # Post in the background, the thread id is saved to the syslog once slack responds
+        if rule.action != ACTION_STORE:
+            if self.digest and self.digest.add(message=message_dict, channel=rule.channel):
+                return
+            message_dict["channel"] = rule.channel
+            self.poster.submit(message=message_dict)
 
     @staticmethod
     def _generate_slack_block(message: dict) -> list:
@@ -198,6 +359,20 @@ class SlackIntegration:
                                     "text": "Generate 1 month chart"
                                 },
                                 "value": value
+                            },
+                            {
+                                "text": {
+                                    "type": "plain_text",
+                                    "text": "Export 1 week of syslogs"
+                                },
+                                "value": value
+                            },
+                            {
+                                "text": {
+                                    "type": "plain_text",
+                                    "text": "Export 1 month of syslogs"
+                                },
+                                "value": value
                             }
                         ]
                     }
@@ -206,5 +381,46 @@ class SlackIntegration:
         ]
         return blocks
 
+    @staticmethod
+    def _generate_digest_block(entry: DigestEntry) -> list:
+        device = f"{entry.src_ip} ({entry.hostname})" if entry.hostname else entry.src_ip
+        levels = ", ".join(f"level {level}: {count}" for level, count in sorted(entry.levels.items()))
+        mnemonics = ", ".join(
+            f"{mnemonic or 'unknown'} x{count}" for mnemonic, count in entry.mnemonics.most_common(5)
+        )
+        blocks = [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"*Device* - {device}\n"
+                            f"*Time* - {entry.first_time} - {entry.last_time} UTC\n"
+                            f"*Syslogs* - {entry.count} ({levels})\n"
+                            f"*Top Mnemonics* - {mnemonics}\n"
+                }
+            },
+            {
+                "type": "divider"
+            }
+        ]
+        # Every sample links to its stored syslog so a ticket can be created for it
+        for syslog_id, syslog in entry.samples:
+            blocks.append({
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"```{syslog}```"
+                },
+                "accessory": {
+                    "type": "button",
+                    "value": syslog_id,
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Create Jira Ticket"
+                    }
+                }
+            })
+        return blocks
+
 
 
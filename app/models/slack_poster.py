@@ -0,0 +1,110 @@
+import atexit
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from app.config import BaseConfig
+from app.utils.metrics import QUEUE_DEPTH, STAGE_SECONDS, SYSLOGS_TOTAL
+
+POST_SECONDS = STAGE_SECONDS.labels("slack_post")
+POSTED = SYSLOGS_TOTAL.labels("posted")
+POST_FAILED = SYSLOGS_TOTAL.labels("post_failed")
+POST_DROPPED = SYSLOGS_TOTAL.labels("post_dropped")
+
+
+class SlackPoster:
+    """
+    Posts syslog messages to slack from a pool of background threads so ingest never waits on the Slack API.
+    Messages are posted by level, most severe first. The slack thread id is written back to the syslog
+    once the post completes
+    """
+    def __init__(self, slack_integration, threads: int = BaseConfig.SLACK_POSTER_THREADS,
+                 queue_size: int = BaseConfig.SLACK_POST_QUEUE_SIZE,
+                 critical_queue_size: int = BaseConfig.SLACK_CRITICAL_QUEUE_SIZE):
+        self.slack_integration = slack_integration
+        self.threads = threads
+        self.queue_size = queue_size
+        self.critical_queue_size = critical_queue_size
+        # Bounded by submit, a full queue never blocks ingest
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.posted = 0
+        self.failed = 0
+        self.dropped = 0
+        QUEUE_DEPTH.set_function(self.queue.qsize, "slack_post")
+
+    def submit(self, message: dict) -> bool:
+        """
+        Queue a message for posting. If the queue is full the message is dropped, it is already saved in mongo.
+        Critical messages can use critical_queue_size more places, they are posted first
+        :param message: message dict with syslog_id
+        :return: True if the message was queued
+        """
+        self._start()
+        limit = self.queue_size
+        if message["level"] <= BaseConfig.SLACK_CRITICAL_LEVEL:
+            limit += self.critical_queue_size
+        if self.queue.qsize() >= limit:
+            self.dropped += 1
+            POST_DROPPED.inc()
+            logging.warning(f"Slack post queue is full, not posting syslog {message['syslog_id']}")
+            return False
+        self.queue.put((message["level"], next(self.counter), message))
+        return True
+
+    def flush(self, timeout: float = 10) -> None:
+        """
+        Wait until queued messages are posted or the timeout expires
+        :param timeout:
+        :return:
+        """
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _start(self) -> None:
+        if self.workers:
+            return
+        with self.lock:
+            if self.workers:
+                return
+            for index in range(self.threads):
+                worker = threading.Thread(target=self._run, name=f"slack-poster-{index}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            _, _, message = self.queue.get()
+            # post_message removes the syslog_id from the message
+            syslog_id = message["syslog_id"]
+            start = time.perf_counter()
+            try:
+                self._post(syslog_id=syslog_id, message=message)
+            except Exception as e:
+                self.failed += 1
+                POST_FAILED.inc()
+                logging.error(f"Error posting syslog {syslog_id} to slack: {e}")
+            finally:
+                POST_SECONDS.observe(time.perf_counter() - start)
+                self.queue.task_done()
+
+    def _post(self, syslog_id: str, message: dict) -> None:
+        response = self.slack_integration.post_message(message=message)
+        if not response:
+            self.failed += 1
+            POST_FAILED.inc()
+            return
+        # Get the slack thread id and save it to the syslog
+        self.slack_integration.writer.set_thread_ts(syslog_id=syslog_id, thread_ts=response.data["ts"])
+        if self.slack_integration.suppressor:
+            self.slack_integration.suppressor.set_thread(
+                syslog_id=syslog_id, channel=response.data["channel"], ts=response.data["ts"]
+            )
+        self.posted += 1
+        POSTED.inc()
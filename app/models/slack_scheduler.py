@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from app.config import BaseConfig
+from app.utils.metrics import QUEUE_DEPTH
+from concurrent.futures import Future, ThreadPoolExecutor
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+# Priorities, lower runs first. Syslog posts use their level (0 - 7)
+PRIORITY_INTERACTIVE = 3
+PRIORITY_UPDATE = 6
+PRIORITY_BULK = 8
+
+# Requests per minute of the Slack API rate limit tiers, https://api.slack.com/docs/rate-limits
+TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    "conversations_list": 2,
+    "conversations_join": 3,
+    "chat_update": 3,
+    "files_upload": 2,
+    "files_sharedPublicURL": 3,
+}
+
+
+class TokenBucket:
+    """
+    Token bucket for one API method (and channel for chat_postMessage)
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def ready_at(self, now: float) -> float:
+        """
+        Time at which the next token is available
+        :param now:
+        :return:
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return max(now, self.paused_until)
+        return max(now + (1 - self.tokens) / self.rate, self.paused_until)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class SlackRequest:
+    __slots__ = ("priority", "seq", "method", "kwargs", "future", "enqueued")
+
+    def __init__(self, priority: int, seq: int, method: str, kwargs: dict):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SlackScheduler:
+    """
+    Schedules WebClient calls by priority under a token bucket per API method so we stay under Slack's rate limits.
+    A 429 pauses the bucket for Retry-After seconds and the request is queued again instead of being lost
+    """
+    def __init__(self, client: WebClient, threads: int = BaseConfig.SLACK_API_THREADS):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="slack-api")
+        # Requests are only taken off the priority queues when a thread is free to run them
+        self.slots = threading.Semaphore(threads)
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.buckets = dict()
+        # Pending requests per bucket, each a heap ordered by priority
+        self.queues = dict()
+        self.thread = None
+        self.stats = dict()
+        QUEUE_DEPTH.set_function(self.queue_depth, "slack_api")
+
+    def call(self, method: str, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        """
+        Queue a WebClient call
+        :param method: WebClient method name, e.g. chat_postMessage
+        :param priority: lower runs first
+        :param kwargs: arguments of the WebClient method
+        :return: Future with the SlackResponse, raises SlackApiError like the WebClient
+        """
+        request = SlackRequest(priority=priority, seq=next(self.counter), method=method, kwargs=kwargs)
+        self._start()
+        with self.condition:
+            self._enqueue(request=request)
+            self.condition.notify()
+        return request.future
+
+    def queue_depth(self) -> int:
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def metrics(self) -> dict:
+        """
+        Queue depth and per method call counts, 429s and time spent waiting in the queue
+        :return:
+        """
+        with self.condition:
+            return {
+                "queue_depth": sum(len(queue) for queue in self.queues.values()),
+                "methods": {method: dict(stats) for method, stats in self.stats.items()},
+            }
+
+    def _bucket_key(self, request: SlackRequest) -> tuple:
+        if request.method == "chat_postMessage":
+            return request.method, request.kwargs.get("channel")
+        return request.method, None
+
+    def _bucket(self, key: tuple) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if key[0] == "chat_postMessage":
+                # Posting is limited to about one message per second per channel with short bursts
+                bucket = TokenBucket(rate=BaseConfig.SLACK_POST_RATE, capacity=BaseConfig.SLACK_POST_BURST)
+            else:
+                per_minute = TIERS[METHOD_TIERS.get(key[0], 3)]
+                bucket = TokenBucket(rate=per_minute / 60, capacity=max(1, per_minute // 10))
+            self.buckets[key] = bucket
+        return bucket
+
+    def _enqueue(self, request: SlackRequest) -> None:
+        key = self._bucket_key(request=request)
+        heapq.heappush(self.queues.setdefault(key, []), request)
+
+    def _start(self) -> None:
+        if self.thread:
+            return
+        with self.condition:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name="slack-scheduler", daemon=True)
+            self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.slots.acquire()
+            with self.condition:
+                request, wait = self._next_request()
+                while request is None:
+                    self.condition.wait(timeout=wait)
+                    request, wait = self._next_request()
+            try:
+                self.executor.submit(self._execute, request)
+            except RuntimeError:
+                # The executor is shut down when the interpreter exits
+                request.future.cancel()
+                return
+
+    def _next_request(self) -> tuple:
+        """
+        Highest priority request among the buckets that have a token
+        :return: (request, None) or (None, seconds until a bucket has a token)
+        """
+        now = time.monotonic()
+        best_key, wait = None, None
+        for key, queue in self.queues.items():
+            if not queue:
+                continue
+            ready_at = self._bucket(key=key).ready_at(now=now)
+            if ready_at <= now:
+                if best_key is None or queue[0] < self.queues[best_key][0]:
+                    best_key = key
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        if best_key is None:
+            return None, wait
+        self._bucket(key=best_key).take()
+        return heapq.heappop(self.queues[best_key]), None
+
+    def _execute(self, request: SlackRequest) -> None:
+        try:
+            self._call(request=request)
+        finally:
+            self.slots.release()
+
+    def _call(self, request: SlackRequest) -> None:
+        stats = self._stats(method=request.method)
+        waited = time.monotonic() - request.enqueued
+        try:
+            response = getattr(self.client, request.method)(**request.kwargs)
+        except SlackApiError as e:
+            if e.response is not None and e.response.status_code == 429:
+                headers = e.response.headers or dict()
+                retry_after = float(headers.get("Retry-After", headers.get("retry-after", 1)))
+                logging.warning(f"Slack rate limited {request.method}, retrying in {retry_after}s")
+                with self.condition:
+                    stats["rate_limited"] += 1
+                    self._bucket(key=self._bucket_key(request=request)).pause(seconds=retry_after)
+                    self._enqueue(request=request)
+                    self.condition.notify()
+                return
+            request.future.set_exception(e)
+        except Exception as e:
+            request.future.set_exception(e)
+        else:
+            request.future.set_result(response)
+        with self.condition:
+            stats["calls"] += 1
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+
+    def _stats(self, method: str) -> dict:
+        with self.condition:
+            if method not in self.stats:
+                self.stats[method] = {"calls": 0, "rate_limited": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+            return self.stats[method]
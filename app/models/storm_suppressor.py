@@ -0,0 +1,166 @@
+import logging
+import re
+import threading
+import time
+
+from app.config import BaseConfig
+from collections import OrderedDict
+from typing import Optional
+
+# Interface ids (Ethernet2/1, Gi0/0/1.100), hex values and numbers are masked so repeats of a message
+# about a different port or counter share a fingerprint
+INTERFACE = re.compile(r"\b[A-Za-z-]*\d+(?:/\d+)+(?:[.:]\d+)?\b")
+HEX = re.compile(r"\b0x[0-9a-fA-F]+\b")
+NUMBER = re.compile(r"\d+")
+
+
+def fingerprint(message: dict) -> tuple:
+    """
+    Key that identifies repeats of a syslog: device, mnemonic, level and the text with numbers and interfaces masked
+    :param message: parsed syslog message
+    :return:
+    """
+    text = INTERFACE.sub("<if>", message["syslog"])
+    text = HEX.sub("<hex>", text)
+    text = NUMBER.sub("<n>", text)
+    return message["src_ip"], message.get("mnemonic"), message["level"], text
+
+
+class StormEntry:
+    """
+    First occurrence of a syslog and the repeats folded into it
+    """
+    __slots__ = ("message", "syslog_id", "last_seen", "repeats", "reported", "channel", "ts")
+
+    def __init__(self, message: dict, now: float):
+        self.message = message
+        self.syslog_id = message["syslog_id"]
+        self.last_seen = now
+        self.repeats = 0
+        self.reported = 0
+        self.channel = None
+        self.ts = None
+
+
+class StormSuppressor:
+    """
+    Deduplicates syslogs per fingerprint over a sliding window. Only the first occurrence is stored and posted,
+    repeats are counted on it and the slack message is updated with the repeat count every update_interval seconds
+    """
+    def __init__(self, slack_integration, window: int = BaseConfig.STORM_WINDOW,
+                 max_entries: int = BaseConfig.STORM_MAX_ENTRIES,
+                 update_interval: int = BaseConfig.STORM_UPDATE_INTERVAL):
+        self.slack_integration = slack_integration
+        self.window = window
+        self.max_entries = max_entries
+        self.update_interval = update_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.by_syslog_id = dict()
+        # Entries that were evicted with repeats that were not reported yet
+        self.evicted = []
+        self.thread = None
+        self.suppressed = 0
+
+    def check(self, key: tuple) -> Optional[str]:
+        """
+        Count a message as a repeat if its fingerprint was seen within the window
+        :param key: fingerprint of the message
+        :return: The syslog id of the first occurrence if this message is a repeat, else None
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now - entry.last_seen > self.window:
+                return None
+            entry.repeats += 1
+            entry.last_seen = now
+            self.entries.move_to_end(key)
+            self.suppressed += 1
+        self._start()
+        return entry.syslog_id
+
+    def add(self, key: tuple, message: dict) -> None:
+        """
+        Track the first occurrence of a message once it has a syslog id
+        :param key: fingerprint of the message
+        :param message:
+        :return:
+        """
+        now = time.monotonic()
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self._evict(entry=previous)
+            entry = StormEntry(message=dict(message), now=now)
+            self.entries[key] = entry
+            self.by_syslog_id[entry.syslog_id] = entry
+            self._expire(now=now)
+
+    def set_thread(self, syslog_id: str, channel: str, ts: str) -> None:
+        """
+        Remember where the first occurrence was posted so repeats can update it
+        :param syslog_id:
+        :param channel:
+        :param ts:
+        :return:
+        """
+        with self.lock:
+            entry = self.by_syslog_id.get(syslog_id)
+            if entry is not None:
+                entry.channel = channel
+                entry.ts = ts
+
+    def report(self) -> None:
+        """
+        Save new repeat counts and update the slack messages of entries that got repeats
+        :return:
+        """
+        with self.lock:
+            self._expire(now=time.monotonic())
+            entries = [entry for entry in self.entries.values() if entry.repeats > entry.reported]
+            entries.extend(self.evicted)
+            self.evicted = []
+            deltas = [(entry, entry.repeats - entry.reported) for entry in entries]
+            for entry in entries:
+                entry.reported = entry.repeats
+        for entry, delta in deltas:
+            message = entry.message
+            self.slack_integration.writer.add_repeats(
+                syslog_id=entry.syslog_id, src_ip=message["src_ip"], src_port=message["src_port"],
+                level=message["level"], count=delta
+            )
+            if entry.ts:
+                self.slack_integration.update_message(
+                    channel=entry.channel, ts=entry.ts, message=dict(message), repeats=entry.repeats
+                )
+
+    def _expire(self, now: float) -> None:
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.last_seen <= self.window and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+            self._evict(entry=entry)
+
+    def _evict(self, entry: StormEntry) -> None:
+        self.by_syslog_id.pop(entry.syslog_id, None)
+        if entry.repeats > entry.reported:
+            self.evicted.append(entry)
+
+    def _start(self) -> None:
+        if self.thread:
+            return
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name="storm-suppressor", daemon=True)
+            self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.update_interval)
+            try:
+                self.report()
+            except Exception as e:
+                logging.error(f"Error reporting syslog repeats: {e}")
@@ -1,18 +1,93 @@
 import datetime
 from app import mongo_db
+from mongoengine import Q
 
 
 class Syslog(mongo_db.Document):
     """
-    Schema for mongodb to store syslogs under Device.syslogs
+    Schema for mongodb to store syslogs, linked to their Device by src_ip
     """
     src_ip = mongo_db.StringField(required=True)
     src_port = mongo_db.IntField(required=True)
     level = mongo_db.IntField(required=True)
     syslog = mongo_db.StringField(required=True)
     time = mongo_db.StringField(required=True)
+    facility = mongo_db.StringField()
+    mnemonic = mongo_db.StringField()
+    hostname = mongo_db.StringField()
+    structured_data = mongo_db.StringField()
     thread_ts = mongo_db.StringField()
+    # Number of identical messages folded into this one by storm suppression
+    repeat_count = mongo_db.IntField(default=0)
+    # Jira ticket of this syslog, jira_pending_since is set while a ticket is being created
+    jira_url = mongo_db.StringField()
+    jira_pending_since = mongo_db.DateTimeField()
+    # Syslogs with a jira ticket or replies in their slack thread are not expired by the retention, pinned_at is when
+    # the last reply was posted
+    pinned = mongo_db.BooleanField(default=False)
+    pinned_at = mongo_db.DateTimeField()
     date_created = mongo_db.DateTimeField(default=datetime.datetime.now)
 
+    meta = {
+        # Searches by device page through _id, text searches use the text index
+        "indexes": [
+            ("src_ip", "date_created"), ("src_ip", "-_id"), "$syslog",
+            # Only the pinned syslogs, to release the pins
+            {"fields": ["pinned", "pinned_at"], "partialFilterExpression": {"pinned": True}},
+        ],
+        # Building the text index on a large collection takes a while, only `flask migrate-syslogs` and the compaction
+        # create the indexes, not every process that stores syslogs
+        "auto_create_index": False,
+    }
+
+    @classmethod
+    def claim_jira_ticket(cls, syslog_id: str, timeout: int) -> bool:
+        """
+        Atomically mark that a jira ticket is being created for a syslog, so only one request creates it
+        :param syslog_id:
+        :param timeout: seconds after which a claim that never completed can be taken over
+        :return: True if the caller should create the ticket
+        """
+        now = datetime.datetime.now()
+        stale = now - datetime.timedelta(seconds=timeout)
+        claimed = cls.objects(
+            Q(id=syslog_id) & Q(jira_url=None) & (Q(jira_pending_since=None) | Q(jira_pending_since__lt=stale))
+        ).update_one(set__jira_pending_since=now)
+        return claimed == 1
+
+    @classmethod
+    def release_jira_ticket(cls, syslog_id: str) -> None:
+        """
+        Give up a claim from claim_jira_ticket when no ticket was created
+        :param syslog_id:
+        :return:
+        """
+        cls.objects(id=syslog_id, jira_url=None).update_one(unset__jira_pending_since=True)
+
+    @classmethod
+    def pin(cls, syslog_id: str) -> None:
+        """
+        Keep a syslog past the retention after a reply was posted in its slack thread
+        :param syslog_id:
+        :return:
+        """
+        cls.objects(id=syslog_id).update_one(set__pinned=True, set__pinned_at=datetime.datetime.now())
+
     def __init__(self, src_ip: str, src_port: str, level: str, time: str, **kwargs):
-        super().__init__(src_ip=src_ip, src_port=src_port, level=level, time=time, **kwargs)
\ No newline at end of file
+        super().__init__(src_ip=src_ip, src_port=src_port, level=level, time=time, **kwargs)
+
+
+def migrate_syslogs() -> dict:
+    """
+    Create the syslog indexes and set pinned on the syslogs stored before it existed, the ones with a jira ticket are
+    pinned. The TTL index of the retention only expires syslogs that are not pinned
+    :return: Summary of the migration
+    """
+    Syslog.ensure_indexes()
+    collection = Syslog._get_collection()
+    pinned = collection.update_many(
+        {"pinned": {"$exists": False}, "jira_url": {"$ne": None}},
+        {"$set": {"pinned": True, "pinned_at": datetime.datetime.now()}}
+    ).modified_count
+    unpinned = collection.update_many({"pinned": {"$exists": False}}, {"$set": {"pinned": False}}).modified_count
+    return {"pinned": pinned, "unpinned": unpinned}
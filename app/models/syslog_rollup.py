@@ -0,0 +1,113 @@
+import datetime
+
+from app import mongo_db
+from app.models import Syslog
+from pymongo import UpdateOne
+
+
+class SyslogRollup(mongo_db.Document):
+    """
+    Schema for mongodb to store the number of syslogs per device per hour, in total and per level.
+    Maintained with $inc at ingest time so charts don't have to scan the syslogs
+    """
+    src_ip = mongo_db.StringField(required=True)
+    hour = mongo_db.DateTimeField(required=True)
+    count = mongo_db.IntField(default=0)
+    levels = mongo_db.DictField()
+    # False from when the hour changes until compact_syslogs summarizes its day again
+    compacted = mongo_db.BooleanField()
+
+    meta = {
+        "collection": "syslog_rollup",
+        "indexes": [
+            {"fields": ["src_ip", "hour"], "unique": True},
+            {"fields": ["hour"], "partialFilterExpression": {"compacted": False}},
+        ],
+    }
+
+    @staticmethod
+    def hour_of(date: datetime.datetime) -> datetime.datetime:
+        return date.replace(minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def inc_update(src_ip: str, hour: datetime.datetime, levels: dict) -> UpdateOne:
+        """
+        Atomic update that adds syslogs to a device's hourly rollup
+        :param src_ip:
+        :param hour: start of the hour
+        :param levels: {level: count}
+        :return:
+        """
+        inc = {f"levels.{level}": count for level, count in levels.items()}
+        inc["count"] = sum(levels.values())
+        return UpdateOne({"src_ip": src_ip, "hour": hour}, {"$inc": inc, "$set": {"compacted": False}}, upsert=True)
+
+    @staticmethod
+    def daily_counts_pipeline(src_ip: str, start_time: datetime.datetime, end_time: datetime.datetime) -> list:
+        """
+        Aggregation of a device's syslogs per day, in the format generate_chart expects
+        :param src_ip:
+        :param start_time:
+        :param end_time:
+        :return:
+        """
+        return [
+            {"$match": {"src_ip": src_ip, "hour": {"$gte": SyslogRollup.hour_of(start_time), "$lt": end_time}}},
+            {"$group": {"_id": {"day": {"$dayOfMonth": "$hour"}, "month": {"$month": "$hour"}, "year": {"$year": "$hour"}}, "count": {"$sum": "$count"}}}
+        ]
+
+
+def backfill_rollups(start_time: datetime.datetime = None, end_time: datetime.datetime = None,
+                     batch_size: int = 1000) -> int:
+    """
+    Rebuild the hourly rollups from the stored syslogs. Buckets are overwritten so this can be run again
+    :param start_time: only syslogs created from this time
+    :param end_time: only syslogs created before this time
+    :param batch_size: rollups written per bulk write
+    :return: number of rollups written
+    """
+    match = dict()
+    if start_time or end_time:
+        match["date_created"] = dict()
+        if start_time:
+            match["date_created"]["$gte"] = SyslogRollup.hour_of(start_time)
+        if end_time:
+            match["date_created"]["$lt"] = end_time
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "src_ip": "$src_ip",
+                "hour": {"$dateFromParts": {
+                    "year": {"$year": "$date_created"}, "month": {"$month": "$date_created"},
+                    "day": {"$dayOfMonth": "$date_created"}, "hour": {"$hour": "$date_created"}
+                }},
+                "level": "$level"
+            },
+            # Storm suppressed repeats are counted on their first occurrence
+            "count": {"$sum": {"$add": [1, {"$ifNull": ["$repeat_count", 0]}]}}
+        }},
+        {"$group": {
+            "_id": {"src_ip": "$_id.src_ip", "hour": "$_id.hour"},
+            "levels": {"$push": {"k": {"$toString": "$_id.level"}, "v": "$count"}},
+            "count": {"$sum": "$count"}
+        }},
+    ]
+    collection = SyslogRollup._get_collection()
+    written = 0
+    updates = []
+    for bucket in Syslog._get_collection().aggregate(pipeline, allowDiskUse=True):
+        updates.append(UpdateOne(
+            {"src_ip": bucket["_id"]["src_ip"], "hour": bucket["_id"]["hour"]},
+            {"$set": {"count": bucket["count"], "levels": {level["k"]: level["v"] for level in bucket["levels"]},
+                      "compacted": False}},
+            upsert=True
+        ))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            written += len(updates)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        written += len(updates)
+    return written
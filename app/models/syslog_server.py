@@ -1,8 +1,22 @@
+import asyncio
 import logging
+import multiprocessing
+import os
+import signal
+import socket
 import socketserver
+import ssl
+import threading
+import time
 
 from app.config import BaseConfig
-from app.models import SlackIntegration
+from app.models import Syslog
+from app.models.slack_integration import get_slack_integration
+from app.models.syslog_spool import SyslogSpool
+from app.utils.metrics import Gauge, QUEUE_DEPTH
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import PyMongoError
+from typing import Callable, List, Optional, Tuple
 
 
 logging.basicConfig(
@@ -12,8 +26,10 @@ logging.basicConfig(
     filename=BaseConfig.LOG_FILE,
     filemode='a')
 
-
-slack_integration = SlackIntegration()
+SERVER_MESSAGES = Gauge("syslog_server_messages", "Syslogs per outcome since the syslog server started",
+                        labelnames=("worker", "outcome"))
+# Longest octet count prefix we accept, a message length of up to 10 digits and the space
+MAX_OCTET_COUNT = 11
 
 
 class SyslogUDPHandler(socketserver.BaseRequestHandler):
@@ -22,4 +38,551 @@ class SyslogUDPHandler(socketserver.BaseRequestHandler):
     """
     def handle(self) -> None:
         # Push message to slack channel
-        slack_integration.process_syslog_message(request=self.request)
+        get_slack_integration().process_syslog_message(data=self.request[0], address=self.client_address)
+
+
+class SyslogServerStats:
+    """
+    Counters for the asyncio ingest server
+    """
+    FIELDS = ("received", "dropped", "kernel_dropped", "processed", "failed", "framing_errors")
+
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.kernel_dropped = 0
+        self.framing_errors = 0
+
+    def __str__(self) -> str:
+        return f"received={self.received} dropped={self.dropped} kernel_dropped={self.kernel_dropped} " \
+               f"processed={self.processed} failed={self.failed} framing_errors={self.framing_errors}"
+
+    def publish(self, counters, offset: int) -> None:
+        """
+        Copy the counters into a shared memory array so a supervisor process can read them
+        :param counters: multiprocessing.Array
+        :param offset: Index of the first counter of this worker
+        :return:
+        """
+        for index, field in enumerate(self.FIELDS):
+            counters[offset + index] = getattr(self, field)
+
+
+class SyslogDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Receives datagrams and hands them to the processing queue, or the spool, without doing any work inline
+    """
+    def __init__(self, queue: asyncio.Queue, stats: SyslogServerStats, spool: SyslogSpool = None):
+        self.queue = queue
+        self.stats = stats
+        self.spool = spool
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.stats.received += 1
+        if self.spool is not None:
+            try:
+                self.spool.append(data=data, address=addr)
+            except OSError as e:
+                self.stats.dropped += 1
+                logging.error(f"Error spooling syslog message: {e}")
+            return
+        try:
+            self.queue.put_nowait((data, addr))
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+
+    def error_received(self, exc: Exception) -> None:
+        logging.error(f"Syslog socket error: {exc}")
+
+
+class SyslogStreamProtocol(asyncio.BufferedProtocol):
+    """
+    Receives syslogs over TCP or TLS framed as in RFC 6587, either octet counted ("<length> <message>") or
+    terminated by a newline. The framing is chosen per connection from its first message (RFC 6587 section 3.4),
+    octet counting if it starts with digits and a space followed by a PRI. The socket is read straight into a reusable
+    buffer that messages are sliced from. When the processing queue is full reading is paused until there is room
+    again, the sender is slowed down by TCP flow control instead of us dropping its syslogs
+    """
+    def __init__(self, server: "AsyncSyslogServer", buffer_size: int = BaseConfig.SYSLOG_TCP_BUFFER_SIZE,
+                 max_message: int = BaseConfig.SYSLOG_TCP_MAX_MESSAGE):
+        self.server = server
+        self.max_message = max_message
+        # Room for the largest message and its octet count
+        self.buffer = bytearray(max(buffer_size, max_message + MAX_OCTET_COUNT + 1))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Bytes of an oversized octet counted message, or the rest of an oversized line, that are skipped
+        self.discard = 0
+        self.discard_line = False
+        # None until the first message shows the framing of the connection
+        self.octet_counting = None
+        self.transport = None
+        self.address = None
+        self.paused = False
+        self.eof = False
+        self.closed = False
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")[:2]
+        logging.debug(f"Syslog connection from {self.address[0]}:{self.address[1]}")
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.end == len(self.buffer) or (self.paused and len(self.buffer) - self.end < sizehint):
+            # Move the partial message at the end to the front
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        if self.paused and len(self.buffer) - self.end < sizehint:
+            # TLS hands us everything it buffered when the connection is closed, even while we are paused
+            buffer = bytearray(self.end + sizehint)
+            buffer[:self.end] = self.view[:self.end]
+            self.view.release()
+            self.buffer, self.view = buffer, memoryview(buffer)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.end += nbytes
+        self._parse()
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        if not self.paused:
+            self._finish()
+        # Keep the connection open while paused, we still have to process what was buffered
+        return True
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        # A paused connection stays registered until the data it buffered is processed
+        self.closed = True
+        if exc is not None:
+            logging.warning(f"Syslog connection from {self.address[0]}:{self.address[1]} lost: {exc}")
+
+    def resume(self) -> None:
+        """
+        Continue with the buffered data once the processing queue has room
+        :return:
+        """
+        self.paused = False
+        self._parse()
+        if self.paused:
+            return
+        if self.eof or self.closed:
+            self._finish()
+        elif not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _parse(self) -> None:
+        buffer = self.buffer
+        while self.start < self.end:
+            if self.discard:
+                skipped = min(self.discard, self.end - self.start)
+                self.start += skipped
+                self.discard -= skipped
+                continue
+            if self.discard_line:
+                newline = buffer.find(b"\n", self.start, self.end)
+                if newline < 0:
+                    self.start = self.end
+                    break
+                self.start = newline + 1
+                self.discard_line = False
+                continue
+            if self.server.queue_full():
+                self._pause()
+                return
+            if self.octet_counting is None:
+                self.octet_counting = self._detect_framing()
+                if self.octet_counting is None:
+                    break
+            if self.octet_counting:
+                if buffer[self.start] in (0x0A, 0x0D):
+                    # Some senders end octet counted messages with a newline too
+                    self.start += 1
+                    continue
+                space = buffer.find(b" ", self.start, min(self.end, self.start + MAX_OCTET_COUNT))
+                if space < 0 and self.end - self.start < MAX_OCTET_COUNT:
+                    break
+                if space < 0 or not bytes(self.view[self.start:space]).isdigit():
+                    # Skip to the next line, the best guess of where the next message starts
+                    self._framing_error(reason="message without an octet count")
+                    self.discard_line = True
+                    continue
+                length = int(bytes(self.view[self.start:space]))
+                if length > self.max_message:
+                    self._framing_error(reason=f"message of {length} bytes")
+                    self.start = space + 1
+                    self.discard = length
+                    continue
+                if space + 1 + length > self.end:
+                    break
+                self.server.receive(data=bytes(self.view[space + 1:space + 1 + length]), address=self.address)
+                self.start = space + 1 + length
+            else:
+                # Non-transparent framing, the message ends at a newline
+                newline = buffer.find(b"\n", self.start, self.end)
+                if newline < 0:
+                    if self.end - self.start > self.max_message:
+                        self._framing_error(reason="line longer than the max message size")
+                        self.discard_line = True
+                        self.start = self.end
+                    break
+                self._receive_line(stop=newline)
+                self.start = newline + 1
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _detect_framing(self) -> Optional[bool]:
+        """
+        Framing of the connection from its first message
+        :return: True for octet counting, False for newline framing, None until enough bytes were received
+        """
+        buffer = self.buffer
+        if not 0x30 <= buffer[self.start] <= 0x39:
+            return False
+        space = buffer.find(b" ", self.start, min(self.end, self.start + MAX_OCTET_COUNT))
+        if space < 0:
+            if self.end - self.start < MAX_OCTET_COUNT and buffer.find(b"\n", self.start, self.end) < 0:
+                return None
+            return False
+        if space + 1 == self.end:
+            return None
+        return bytes(self.view[self.start:space]).isdigit() and buffer[space + 1] == 0x3C
+
+    def _receive_line(self, stop: int) -> None:
+        if stop > self.start and self.buffer[stop - 1] == 0x0D:
+            stop -= 1
+        if stop > self.start:
+            self.server.receive(data=bytes(self.view[self.start:stop]), address=self.address)
+
+    def _framing_error(self, reason: str) -> None:
+        self.server.stats.framing_errors += 1
+        logging.error(f"Syslog framing error from {self.address[0]}: {reason}")
+
+    def _pause(self) -> None:
+        self.paused = True
+        self.transport.pause_reading()
+        self.server.paused_streams.add(self)
+
+    def _finish(self) -> None:
+        # The last message may have no newline, an octet counted one that is cut short is incomplete
+        if self.start < self.end and not (self.discard or self.discard_line):
+            if self.octet_counting:
+                self._framing_error(reason="connection closed in the middle of a message")
+            elif self.server.queue_full():
+                self.server.stats.dropped += 1
+            else:
+                self._receive_line(stop=self.end)
+        self.start = self.end = 0
+        self.transport.close()
+
+
+class AsyncSyslogServer:
+    """
+    asyncio based syslog server. The event loop only reads from the socket into a bounded queue,
+    messages are processed in batches on a separate thread so a slow database or Slack call
+    does not stop us from draining the kernel receive buffer. With the spool enabled datagrams are written to disk
+    and processed from there, so nothing is lost while mongo is down or the process restarts.
+    With a tcp_port syslogs are also received over TCP (TLS if a certificate is configured)
+    """
+    def __init__(self, host: str = BaseConfig.HOST, port: int = BaseConfig.PORT,
+                 rcvbuf: int = BaseConfig.SYSLOG_RCVBUF, queue_size: int = BaseConfig.SYSLOG_QUEUE_SIZE,
+                 batch_size: int = BaseConfig.SYSLOG_BATCH_SIZE, reuse_port: bool = False,
+                 counters=None, counters_offset: int = 0, spool: bool = BaseConfig.SYSLOG_SPOOL,
+                 udp: bool = True, tcp_port: int = BaseConfig.SYSLOG_TCP_PORT):
+        self.host = host
+        self.port = port
+        self.udp = udp
+        self.tcp_port = tcp_port
+        self.rcvbuf = rcvbuf
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.reuse_port = reuse_port
+        self.counters = counters
+        self.counters_offset = counters_offset
+        self.stats = SyslogServerStats()
+        self.sock = None
+        self.queue = None
+        # TCP connections waiting for room in the queue
+        self.paused_streams = set()
+        # A single thread keeps processing order identical to the socketserver handler
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="syslog-processor")
+        worker = str(counters_offset // len(SyslogServerStats.FIELDS))
+        # Every worker has its own spool
+        self.spool = SyslogSpool(directory=os.path.join(BaseConfig.SYSLOG_SPOOL_DIR, f"worker-{worker}")) \
+            if spool else None
+        self.stopping = threading.Event()
+        for field in SyslogServerStats.FIELDS:
+            SERVER_MESSAGES.set_function(lambda field=field: getattr(self.stats, field), worker, field)
+
+    def serve_forever(self) -> None:
+        try:
+            asyncio.run(self.serve())
+        finally:
+            logging.info(f"Syslog server stopped: {self.stats}")
+            print(f"Syslog server stopped: {self.stats}")
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        QUEUE_DEPTH.set_function(self.queue.qsize, "syslog_receive")
+        transport = None
+        if self.udp:
+            self.sock = self._create_socket()
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: SyslogDatagramProtocol(queue=self.queue, stats=self.stats, spool=self.spool),
+                sock=self.sock
+            )
+            logging.info(f"Async syslog server listening on {self.host}:{self.port} "
+                         f"(rcvbuf={self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)})")
+        tcp_server = None
+        if self.tcp_port:
+            ssl_context = self._create_ssl_context()
+            tcp_server = await loop.create_server(
+                lambda: SyslogStreamProtocol(server=self), host=self.host, port=self.tcp_port, ssl=ssl_context,
+                reuse_port=self.reuse_port or None
+            )
+            logging.info(f"Async syslog server listening on {self.host}:{self.tcp_port}/tcp"
+                         f"{' (tls)' if ssl_context else ''}")
+        reporter = asyncio.create_task(self._report_stats())
+        try:
+            if self.spool is not None:
+                await loop.run_in_executor(self.executor, self._consume_spool)
+            else:
+                await self._consume()
+        finally:
+            self.stopping.set()
+            reporter.cancel()
+            if tcp_server is not None:
+                tcp_server.close()
+            if transport is not None:
+                self.stats.kernel_dropped = kernel_drop_count(sock=self.sock)
+                transport.close()
+            self.executor.shutdown(wait=True)
+            if self.spool is not None:
+                self.spool.close()
+
+    def _create_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Every worker binds the same port and the kernel load balances datagrams between them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.bind((self.host, self.port))
+        sock.setblocking(False)
+        return sock
+
+    @staticmethod
+    def _create_ssl_context() -> Optional[ssl.SSLContext]:
+        if not BaseConfig.SYSLOG_TLS_CERT:
+            return None
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=BaseConfig.SYSLOG_TLS_CERT, keyfile=BaseConfig.SYSLOG_TLS_KEY)
+        return context
+
+    def queue_full(self) -> bool:
+        return self.spool is None and self.queue.full()
+
+    def receive(self, data: bytes, address: Tuple[str, int]) -> None:
+        """
+        Hand a syslog received over TCP to the spool or the processing queue, the caller checked queue_full
+        :param data:
+        :param address:
+        :return:
+        """
+        self.stats.received += 1
+        if self.spool is not None:
+            try:
+                self.spool.append(data=data, address=address)
+            except OSError as e:
+                self.stats.dropped += 1
+                logging.error(f"Error spooling syslog message: {e}")
+            return
+        self.queue.put_nowait((data, address))
+
+    async def _consume(self) -> None:
+        """
+        Pull everything that is queued (up to batch_size) and process it off the event loop
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # The queue has room again, read from the connections that were paused
+            for stream in list(self.paused_streams):
+                if self.queue.full():
+                    break
+                self.paused_streams.discard(stream)
+                stream.resume()
+            await loop.run_in_executor(self.executor, self._process_batch, batch)
+
+    def _consume_spool(self) -> None:
+        """
+        Process the spool in batches. The read position is committed once the syslogs read so far are saved
+        to mongo. While mongo is down the writer keeps the syslogs it could not insert, reading stops until they are
+        saved so they are neither processed again nor committed unsaved
+        :return:
+        """
+        writer = get_slack_integration().writer
+        last_commit = time.monotonic()
+        while not self.stopping.is_set():
+            batch = self.spool.read(max_records=self.batch_size, timeout=BaseConfig.SYSLOG_SPOOL_COMMIT_INTERVAL)
+            self._process_batch(batch)
+            if time.monotonic() - last_commit < BaseConfig.SYSLOG_SPOOL_COMMIT_INTERVAL:
+                continue
+            writer.flush()
+            while writer.unsaved and not self.stopping.is_set():
+                logging.warning(f"Saving syslogs failed, {writer.unsaved} syslogs wait for mongo")
+                self._wait_for_mongo()
+                writer.flush()
+            if not writer.unsaved:
+                self.spool.commit()
+            last_commit = time.monotonic()
+
+    def _wait_for_mongo(self) -> None:
+        while not self.stopping.wait(timeout=BaseConfig.SYSLOG_SPOOL_COMMIT_INTERVAL):
+            try:
+                Syslog._get_collection().database.command("ping")
+                return
+            except PyMongoError as e:
+                logging.warning(f"Waiting for mongo: {e}")
+
+    def _process_batch(self, batch: List[Tuple[bytes, Tuple[str, int]]]) -> None:
+        slack_integration = get_slack_integration()
+        for data, address in batch:
+            try:
+                slack_integration.process_syslog_message(data=data, address=address)
+                self.stats.processed += 1
+            except Exception as e:
+                self.stats.failed += 1
+                logging.error(f"Error processing syslog message: {e}")
+
+    async def _report_stats(self) -> None:
+        last_log = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            if self.sock is not None:
+                self.stats.kernel_dropped = kernel_drop_count(sock=self.sock)
+            if self.counters is not None:
+                self.stats.publish(counters=self.counters, offset=self.counters_offset)
+            if time.monotonic() - last_log >= BaseConfig.SYSLOG_STATS_INTERVAL:
+                last_log = time.monotonic()
+                backlog = f" spooled={self.spool.backlog()}B" if self.spool is not None else ""
+                logging.info(f"Syslog server stats: {self.stats} queued={self.queue.qsize()}{backlog}")
+
+
+class SyslogWorkerSupervisor:
+    """
+    Runs N ingest processes that all bind the syslog port with SO_REUSEPORT.
+    Dead workers are restarted and their counters are gathered through shared memory
+    """
+    def __init__(self, target: Callable, workers: int = BaseConfig.SYSLOG_WORKERS):
+        # Spawn rather than fork, the Mongo and Slack clients must not be shared with the children
+        self.context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.workers = workers
+        self.fields = len(SyslogServerStats.FIELDS)
+        self.counters = self.context.Array("Q", workers * self.fields, lock=False)
+        # Counters of workers that died, so totals survive restarts
+        self.carried = [[0] * self.fields for _ in range(workers)]
+        self.restarts = [0] * workers
+        self.processes = [None] * workers
+        self.running = False
+        for index in range(workers):
+            for field in SyslogServerStats.FIELDS:
+                SERVER_MESSAGES.set_function(
+                    lambda index=index, field=field: self.worker_stats(index=index)[field], str(index), field
+                )
+
+    def serve_forever(self) -> None:
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        last_log = time.monotonic()
+        try:
+            while self.running:
+                for index in range(self.workers):
+                    self._check_worker(index=index)
+                if time.monotonic() - last_log >= BaseConfig.SYSLOG_STATS_INTERVAL:
+                    last_log = time.monotonic()
+                    self.log_stats()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._shutdown()
+            self.log_stats()
+
+    def worker_stats(self, index: int) -> dict:
+        offset = index * self.fields
+        return {
+            field: self.carried[index][i] + self.counters[offset + i]
+            for i, field in enumerate(SyslogServerStats.FIELDS)
+        }
+
+    def log_stats(self) -> None:
+        totals = dict.fromkeys(SyslogServerStats.FIELDS, 0)
+        for index in range(self.workers):
+            stats = self.worker_stats(index=index)
+            for field, value in stats.items():
+                totals[field] += value
+            logging.info(f"Syslog worker {index} stats: {stats} restarts={self.restarts[index]}")
+        logging.info(f"Syslog workers total: {totals}")
+        print(f"Syslog workers total: {totals}")
+
+    def _check_worker(self, index: int) -> None:
+        process = self.processes[index]
+        if process is not None and process.is_alive():
+            return
+        if process is not None:
+            logging.error(f"Syslog worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting")
+            self.restarts[index] += 1
+            offset = index * self.fields
+            for i in range(self.fields):
+                self.carried[index][i] += self.counters[offset + i]
+                self.counters[offset + i] = 0
+        process = self.context.Process(
+            target=self.target,
+            args=(self.counters, index * self.fields),
+            name=f"syslog-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def _stop(self, signum, frame) -> None:
+        self.running = False
+
+    def _shutdown(self) -> None:
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=5)
+
+
+def kernel_drop_count(sock: socket.socket) -> int:
+    """
+    Number of datagrams the kernel dropped for this socket because the receive buffer was full.
+    Linux only, the counter is read from /proc/net/udp using the socket inode
+    :param sock:
+    :return:
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for proc_file in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(proc_file) as file:
+                next(file)
+                for line in file:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[12])
+        except (OSError, IndexError, StopIteration):
+            continue
+    return 0
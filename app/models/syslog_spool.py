@@ -0,0 +1,234 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from app.config import BaseConfig
+from app.utils.metrics import Counter, Gauge
+from typing import List, Optional, Tuple
+
+# crc32 of the datagram, datagram length, source port, source ip length. Followed by the ip and the datagram
+RECORD_HEADER = struct.Struct("<IIHB")
+SEGMENT_SUFFIX = ".spool"
+OFFSET_FILE = "offset.json"
+
+SPOOL_RECORDS = Counter("syslog_spool_records_total", "Spooled datagrams by outcome: appended, dropped, corrupt",
+                        labelnames=("outcome",))
+SPOOL_BYTES = Gauge("syslog_spool_bytes", "Bytes of spool segments on disk", labelnames=("spool",))
+
+
+class SyslogSpool:
+    """
+    Append-only write-ahead spool of received datagrams, split in segment files of segment_size bytes.
+    Segments are read through mmap from the committed offset, the offset is persisted so processing resumes
+    where it stopped after a crash. When the segments exceed quota bytes the oldest ones are dropped
+    """
+    def __init__(self, directory: str = BaseConfig.SYSLOG_SPOOL_DIR,
+                 segment_size: int = BaseConfig.SYSLOG_SPOOL_SEGMENT_SIZE,
+                 quota: int = BaseConfig.SYSLOG_SPOOL_QUOTA):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.data_ready = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.sizes = {segment: os.path.getsize(self._path(segment=segment)) for segment in self.segments}
+        self.total = sum(self.sizes.values())
+        # Appends always start a new segment so we never append after a record torn by a crash
+        self.write_segment = None
+        self.write_fd = None
+        self._open_segment(segment=(self.segments[-1] + 1) if self.segments else 1)
+        self.committed = self._load_offset()
+        self.read_segment, self.read_position = self.committed
+        self.map = None
+        self.map_segment = None
+        self.appended = 0
+        self.dropped = 0
+        self.corrupt = 0
+        SPOOL_BYTES.set_function(lambda: self.total, os.path.basename(directory))
+
+    def append(self, data: bytes, address: Tuple[str, int]) -> None:
+        """
+        Write a datagram to the end of the spool
+        :param data:
+        :param address: (ip, port) of the sender
+        :return:
+        """
+        ip = address[0].encode()
+        record = RECORD_HEADER.pack(zlib.crc32(data), len(data), address[1], len(ip)) + ip + data
+        with self.lock:
+            if self.sizes[self.write_segment] and self.sizes[self.write_segment] + len(record) > self.segment_size:
+                self._open_segment(segment=self.write_segment + 1)
+            os.write(self.write_fd, record)
+            self.sizes[self.write_segment] += len(record)
+            self.total += len(record)
+            self.appended += 1
+            if self.total > self.quota:
+                self._enforce_quota()
+        SPOOL_RECORDS.labels("appended").inc()
+        self.data_ready.set()
+
+    def read(self, max_records: int, timeout: float) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """
+        Next datagrams after the read position, waits up to timeout seconds for new ones
+        :param max_records:
+        :param timeout:
+        :return: [(data, (ip, port))]
+        """
+        waited = False
+        while True:
+            self.data_ready.clear()
+            with self.lock:
+                records = self._read(max_records=max_records)
+            if records or waited:
+                return records
+            self.data_ready.wait(timeout=timeout)
+            waited = True
+
+    def commit(self) -> None:
+        """
+        Persist the read position, everything before it was processed. Segments that were read are deleted
+        :return:
+        """
+        with self.lock:
+            os.fsync(self.write_fd)
+            self.committed = (self.read_segment, self.read_position)
+            temp_path = os.path.join(self.directory, f"{OFFSET_FILE}.tmp")
+            with open(temp_path, "w") as file:
+                json.dump({"segment": self.read_segment, "position": self.read_position}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, os.path.join(self.directory, OFFSET_FILE))
+            while self.segments and self.segments[0] < self.read_segment:
+                self._delete_segment(segment=self.segments[0])
+
+    def backlog(self) -> int:
+        """
+        Bytes that were not read yet
+        :return:
+        """
+        with self.lock:
+            return sum(size for segment, size in self.sizes.items() if segment >= self.read_segment) \
+                - self.read_position
+
+    def close(self) -> None:
+        with self.lock:
+            self._close_map()
+            os.close(self.write_fd)
+
+    def _read(self, max_records: int) -> List[Tuple[bytes, Tuple[str, int]]]:
+        records = []
+        while len(records) < max_records:
+            size = self.sizes[self.read_segment]
+            if self.read_position >= size:
+                if self.read_segment == self.write_segment:
+                    break
+                self._next_read_segment()
+                continue
+            if self.map is None or self.map_segment != self.read_segment or len(self.map) < size:
+                self._map_segment(size=size)
+            record = self._parse(position=self.read_position)
+            if record is None:
+                # A record torn by a crash or a damaged segment, the rest of the segment is skipped
+                logging.error(f"Corrupt syslog spool record in segment {self.read_segment} at {self.read_position}")
+                self.corrupt += 1
+                SPOOL_RECORDS.labels("corrupt").inc()
+                self.read_position = size
+                continue
+            data, address, self.read_position = record
+            records.append((data, address))
+        return records
+
+    def _parse(self, position: int) -> Optional[Tuple[bytes, Tuple[str, int], int]]:
+        view = self.map
+        if position + RECORD_HEADER.size > len(view):
+            return None
+        crc, length, port, ip_length = RECORD_HEADER.unpack_from(view, position)
+        start = position + RECORD_HEADER.size
+        end = start + ip_length + length
+        if end > len(view):
+            return None
+        data = view[start + ip_length:end]
+        if zlib.crc32(data) != crc:
+            return None
+        return data, (view[start:start + ip_length].decode(), port), end
+
+    def _next_read_segment(self) -> None:
+        self.read_segment = next(segment for segment in self.segments if segment > self.read_segment)
+        self.read_position = 0
+        self._close_map()
+
+    def _map_segment(self, size: int) -> None:
+        self._close_map()
+        with open(self._path(segment=self.read_segment), "rb") as file:
+            self.map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        self.map_segment = self.read_segment
+
+    def _close_map(self) -> None:
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.map_segment = None
+
+    def _open_segment(self, segment: int) -> None:
+        if self.write_fd is not None:
+            os.fsync(self.write_fd)
+            os.close(self.write_fd)
+        self.write_fd = os.open(self._path(segment=segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.write_segment = segment
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def _enforce_quota(self) -> None:
+        while self.total > self.quota and self.segments[0] != self.write_segment:
+            segment = self.segments[0]
+            if segment >= self.read_segment:
+                position = self.read_position if segment == self.read_segment else 0
+                dropped = self._count_records(segment=segment, position=position)
+                self.dropped += dropped
+                SPOOL_RECORDS.labels("dropped").inc(dropped)
+                logging.warning(f"Syslog spool is over its quota, dropped {dropped} unprocessed syslogs")
+                if segment == self.read_segment:
+                    self._next_read_segment()
+            self._delete_segment(segment=segment)
+
+    def _count_records(self, segment: int, position: int) -> int:
+        count = 0
+        with open(self._path(segment=segment), "rb") as file:
+            file.seek(position)
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return count
+                _, length, _, ip_length = RECORD_HEADER.unpack(header)
+                file.seek(ip_length + length, os.SEEK_CUR)
+                count += 1
+
+    def _delete_segment(self, segment: int) -> None:
+        if self.map_segment == segment:
+            self._close_map()
+        self.segments.remove(segment)
+        self.total -= self.sizes.pop(segment)
+        try:
+            os.remove(self._path(segment=segment))
+        except OSError as e:
+            logging.error(f"Error removing syslog spool segment {segment}: {e}")
+
+    def _load_offset(self) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as file:
+                offset = json.load(file)
+            if offset["segment"] in self.sizes:
+                return offset["segment"], min(offset["position"], self.sizes[offset["segment"]])
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.segments[0], 0
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:016d}{SEGMENT_SUFFIX}")
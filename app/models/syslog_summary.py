@@ -0,0 +1,269 @@
+import datetime
+import itertools
+import logging
+
+from app import mongo_db
+from app.config import BaseConfig
+from app.models import Syslog, SyslogRollup
+from pymongo import UpdateOne
+from typing import Callable, Dict, Iterable, List
+
+# Name of the TTL index of each collection with a retention
+TTL_INDEX = "retention_ttl"
+
+
+class SyslogDailySummary(mongo_db.Document):
+    """
+    Schema for mongodb to store the syslogs of a device per day: the count, counts per level and the top mnemonics.
+    Compacted from the raw syslogs before they expire, charts read them beyond the rollup retention
+    """
+    src_ip = mongo_db.StringField(required=True)
+    day = mongo_db.DateTimeField(required=True)
+    count = mongo_db.IntField(default=0)
+    levels = mongo_db.DictField()
+    # [{"mnemonic": "LINK-UPDOWN", "count": 12}], most frequent first
+    mnemonics = mongo_db.ListField(mongo_db.DictField())
+
+    meta = {
+        "collection": "syslog_daily_summary",
+        "indexes": [{"fields": ["src_ip", "day"], "unique": True}],
+    }
+
+    @staticmethod
+    def day_of(date: datetime.datetime) -> datetime.datetime:
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def compact_syslogs(start_time: datetime.datetime = None, end_time: datetime.datetime = None,
+                    days: Dict[datetime.datetime, Iterable[str]] = None,
+                    raw_days: int = BaseConfig.SYSLOG_RETENTION_DAYS,
+                    top_mnemonics: int = BaseConfig.SYSLOG_SUMMARY_TOP_MNEMONICS, batch_size: int = 1000) -> int:
+    """
+    Summarize the raw syslogs per device and day. By default only the devices and days whose hourly rollups changed
+    since they were last summarized, so syslogs stored late or replayed are summarized again. Days are overwritten so
+    a range can be compacted again, as long as its syslogs have not expired yet
+    :param start_time: summarize every device from this day instead of the changed days
+    :param end_time: days before this one, by default until today (today is not complete yet)
+    :param days: src_ips to summarize per day instead of the changed days, for days whose rollups may have expired
+    :param raw_days: changed days whose syslogs may have started to expire are not summarized again, 0 keeps them
+    :param top_mnemonics: mnemonics kept per device and day
+    :param batch_size: summaries written per bulk write
+    :return: number of summaries written
+    """
+    end_time = SyslogDailySummary.day_of(end_time or datetime.datetime.now())
+    if start_time:
+        summaries = _summarize(match={"date_created": {
+            "$gte": SyslogDailySummary.day_of(start_time), "$lt": end_time
+        }})
+        return _write_summaries(summaries=summaries, top_mnemonics=top_mnemonics, batch_size=batch_size)
+
+    first_day = None
+    if raw_days:
+        first_day = SyslogDailySummary.day_of(datetime.datetime.now() - datetime.timedelta(days=raw_days))
+        first_day += datetime.timedelta(days=1)
+    rollups = SyslogRollup._get_collection()
+    if days is None:
+        changed = rollups.aggregate([
+            {"$match": {"compacted": False, "hour": {"$lt": end_time}}},
+            {"$group": {
+                "_id": {"$dateFromParts": {"year": {"$year": "$hour"}, "month": {"$month": "$hour"},
+                                           "day": {"$dayOfMonth": "$hour"}}},
+                "src_ips": {"$addToSet": "$src_ip"}
+            }},
+        ])
+        days = {day["_id"]: day["src_ips"] for day in changed}
+    written = 0
+    for day, src_ips in sorted(days.items()):
+        if day >= end_time:
+            continue
+        src_ips = list(src_ips)
+        rollup_match = {"compacted": False, "src_ip": {"$in": src_ips},
+                        "hour": {"$gte": day, "$lt": day + datetime.timedelta(days=1)}}
+        # Marked before the syslogs are read, rollups changed after it are summarized again by the next compaction
+        rollups.update_many(rollup_match, {"$set": {"compacted": True}})
+        if first_day and day < first_day:
+            logging.warning(f"Not summarizing {len(src_ips)} devices on {day:%Y-%m-%d} again, "
+                            f"their syslogs may have expired")
+            continue
+        try:
+            summaries = _summarize(match={
+                "src_ip": {"$in": src_ips},
+                "date_created": {"$gte": day, "$lt": day + datetime.timedelta(days=1)}
+            })
+            written += _write_summaries(summaries=summaries, top_mnemonics=top_mnemonics, batch_size=batch_size)
+        except Exception:
+            rollup_match["compacted"] = True
+            rollups.update_many(rollup_match, {"$set": {"compacted": False}})
+            raise
+    return written
+
+
+def _summarize(match: dict) -> dict:
+    """
+    Counts, counts per level and counts per mnemonic of the syslogs matching a filter
+    :param match:
+    :return: {(src_ip, day): {"count": count, "levels": {level: count}, "mnemonics": {mnemonic: count}}}
+    """
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "src_ip": "$src_ip",
+                "day": {"$dateFromParts": {
+                    "year": {"$year": "$date_created"}, "month": {"$month": "$date_created"},
+                    "day": {"$dayOfMonth": "$date_created"}
+                }},
+                "level": "$level",
+                "facility": "$facility",
+                "mnemonic": "$mnemonic"
+            },
+            # Storm suppressed repeats are counted on their first occurrence
+            "count": {"$sum": {"$add": [1, {"$ifNull": ["$repeat_count", 0]}]}}
+        }},
+    ]
+    summaries = dict()
+    for bucket in Syslog._get_collection().aggregate(pipeline, allowDiskUse=True):
+        group = bucket["_id"]
+        summary = summaries.setdefault((group["src_ip"], group["day"]), {"count": 0, "levels": {}, "mnemonics": {}})
+        summary["count"] += bucket["count"]
+        level = str(group["level"])
+        summary["levels"][level] = summary["levels"].get(level, 0) + bucket["count"]
+        mnemonic = "-".join(filter(None, (group.get("facility"), group.get("mnemonic")))) or "unknown"
+        summary["mnemonics"][mnemonic] = summary["mnemonics"].get(mnemonic, 0) + bucket["count"]
+    return summaries
+
+
+def _write_summaries(summaries: dict, top_mnemonics: int, batch_size: int) -> int:
+    """
+    Overwrite the daily summaries of _summarize
+    :param summaries:
+    :param top_mnemonics: mnemonics kept per device and day
+    :param batch_size: summaries written per bulk write
+    :return: number of summaries written
+    """
+    collection = SyslogDailySummary._get_collection()
+    written = 0
+    updates = []
+    for (src_ip, day), summary in summaries.items():
+        mnemonics = sorted(summary["mnemonics"].items(), key=lambda item: item[1], reverse=True)[:top_mnemonics]
+        updates.append(UpdateOne(
+            {"src_ip": src_ip, "day": day},
+            {"$set": {"count": summary["count"], "levels": summary["levels"],
+                      "mnemonics": [{"mnemonic": mnemonic, "count": count} for mnemonic, count in mnemonics]}},
+            upsert=True
+        ))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            written += len(updates)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        written += len(updates)
+    return written
+
+
+def daily_counts(src_ip: str, start_time: datetime.datetime, end_time: datetime.datetime,
+                 rollup_retention_days: int = BaseConfig.SYSLOG_ROLLUP_RETENTION_DAYS) -> list:
+    """
+    A device's syslogs per day in the format generate_chart expects. Days the hourly rollups may have expired for
+    are read from the daily summaries
+    :param src_ip:
+    :param start_time:
+    :param end_time:
+    :param rollup_retention_days:
+    :return:
+    """
+    rollup_start = start_time
+    counts = []
+    if rollup_retention_days:
+        # First day that is complete in the rollups
+        rollup_start = max(start_time, SyslogDailySummary.day_of(
+            datetime.datetime.now() - datetime.timedelta(days=rollup_retention_days - 1)
+        ))
+    if rollup_start > start_time:
+        summaries = SyslogDailySummary.objects(
+            src_ip=src_ip, day__gte=SyslogDailySummary.day_of(start_time), day__lt=rollup_start
+        ).only("day", "count")
+        counts.extend(
+            {"_id": {"day": summary.day.day, "month": summary.day.month, "year": summary.day.year},
+             "count": summary.count}
+            for summary in summaries
+        )
+    if rollup_start < end_time:
+        pipeline = SyslogRollup.daily_counts_pipeline(src_ip=src_ip, start_time=rollup_start, end_time=end_time)
+        counts.extend(SyslogRollup.objects().aggregate(pipeline=pipeline))
+    return counts
+
+
+def ensure_ttl_index(collection, field: str, days: int, partial_filter: dict = None) -> None:
+    """
+    Create, update or drop the TTL index of a collection so documents expire days after field
+    :param collection: pymongo collection
+    :param field: date field
+    :param days: 0 drops the index, documents are kept forever
+    :param partial_filter: only documents matching it expire
+    :return:
+    """
+    existing = collection.index_information().get(TTL_INDEX)
+    if not days:
+        if existing:
+            collection.drop_index(TTL_INDEX)
+        return
+    seconds = days * 86400
+    if existing and existing.get("partialFilterExpression") == partial_filter:
+        if existing.get("expireAfterSeconds") != seconds:
+            collection.database.command(
+                {"collMod": collection.name, "index": {"name": TTL_INDEX, "expireAfterSeconds": seconds}}
+            )
+        return
+    if existing:
+        collection.drop_index(TTL_INDEX)
+    options = {"partialFilterExpression": partial_filter} if partial_filter else dict()
+    collection.create_index(field, name=TTL_INDEX, expireAfterSeconds=seconds, **options)
+
+
+def apply_retention(raw_days: int = BaseConfig.SYSLOG_RETENTION_DAYS,
+                    rollup_days: int = BaseConfig.SYSLOG_ROLLUP_RETENTION_DAYS) -> None:
+    """
+    Create the syslog indexes and set up the TTL indexes. Raw syslogs only expire while they are not pinned
+    :param raw_days: days raw syslogs are kept, 0 keeps them forever
+    :param rollup_days: days hourly rollups are kept, 0 keeps them forever
+    :return:
+    """
+    Syslog.ensure_indexes()
+    ensure_ttl_index(collection=Syslog._get_collection(), field="date_created", days=raw_days,
+                     partial_filter={"pinned": False})
+    ensure_ttl_index(collection=SyslogRollup._get_collection(), field="hour", days=rollup_days)
+    logging.info(f"Syslog retention: raw {raw_days or 'forever'} days, rollups {rollup_days or 'forever'} days")
+
+
+def release_pins(pin_days: int = BaseConfig.SYSLOG_PIN_DAYS, closed_tickets: Callable[[List[str]], set] = None,
+                 batch_size: int = 100) -> dict:
+    """
+    Unpin the syslogs without a ticket whose last slack thread reply is older than pin_days, and the syslogs whose
+    ticket was closed. Unpinned syslogs expire with the retention
+    :param pin_days: 0 never expires the thread pins
+    :param closed_tickets: returns the closed ones of a list of jira urls, None keeps the ticket pins
+    :param batch_size: tickets checked per call of closed_tickets
+    :return: {"expired": thread pins released, "closed": ticket pins released}
+    """
+    collection = Syslog._get_collection()
+    unpin = {"$set": {"pinned": False}, "$unset": {"pinned_at": ""}}
+    released = {"expired": 0, "closed": 0}
+    if pin_days:
+        expired = datetime.datetime.now() - datetime.timedelta(days=pin_days)
+        released["expired"] = collection.update_many(
+            {"pinned": True, "pinned_at": {"$lt": expired}, "jira_url": None}, unpin
+        ).modified_count
+    if closed_tickets:
+        tickets = collection.find({"pinned": True, "jira_url": {"$ne": None}}, projection={"jira_url": True})
+        while True:
+            batch = {syslog["_id"]: syslog["jira_url"] for syslog in itertools.islice(tickets, batch_size)}
+            if not batch:
+                break
+            closed = closed_tickets(list(set(batch.values())))
+            ids = [_id for _id, jira_url in batch.items() if jira_url in closed]
+            if ids:
+                released["closed"] += collection.update_many({"_id": {"$in": ids}}, unpin).modified_count
+    logging.info(f"Released {released['expired']} expired syslog pins and {released['closed']} of closed tickets")
+    return released
@@ -0,0 +1,316 @@
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from app.config import BaseConfig
+from app.models import Syslog, SyslogRollup
+from app.models.device import Device, DeviceCache
+from app.utils.metrics import QUEUE_DEPTH, STAGE_SECONDS
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from typing import List, Tuple
+
+# Time per bulk write of a flush
+SYSLOG_SAVE_SECONDS = STAGE_SECONDS.labels("syslog_save")
+DEVICE_SAVE_SECONDS = STAGE_SECONDS.labels("device_save")
+ROLLUP_SAVE_SECONDS = STAGE_SECONDS.labels("rollup_save")
+SYSLOG_UPDATE_SECONDS = STAGE_SECONDS.labels("syslog_update")
+
+
+class SyslogWriter:
+    """
+    Write-behind buffer for syslogs. Syslogs get their id on the client so they can be posted to slack right away,
+    they are inserted with insert_many when the buffer reaches batch_size or every flush_interval seconds.
+    Device counters, hourly rollups and slack thread ids are applied as bulk updates in the same flush, counters only
+    for the syslogs that were inserted. Syslogs whose insert failed are kept and inserted again with the next flush,
+    a syslog that was inserted before the error is reported as a duplicate of its id then
+    """
+    def __init__(self, batch_size: int = BaseConfig.SYSLOG_WRITE_BATCH_SIZE,
+                 flush_interval: float = BaseConfig.SYSLOG_WRITE_INTERVAL,
+                 max_pending: int = BaseConfig.SYSLOG_WRITE_MAX_PENDING):
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.known_devices = DeviceCache(size=BaseConfig.DEVICE_CACHE_SIZE)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        # Pending inserts by id, device counts by src_ip, rollup counts by (src_ip, hour),
+        # thread ids and repeat counts by syslog id
+        self.syslogs = dict()
+        self.devices = dict()
+        self.rollups = dict()
+        self.thread_ts = dict()
+        self.repeats = dict()
+        self.inserted = 0
+        self.flushes = 0
+        self.failed = 0
+        QUEUE_DEPTH.set_function(lambda: len(self.syslogs), "syslog_write")
+
+    def add(self, syslog: Syslog) -> str:
+        """
+        Buffer a syslog for insertion
+        :param syslog:
+        :return: id of the syslog
+        """
+        if syslog.id is None:
+            syslog.id = ObjectId()
+        syslog.validate()
+        with self.lock:
+            self.syslogs[syslog.id] = syslog
+            full = len(self.syslogs) >= self.batch_size
+        self._start()
+        if full:
+            self.wakeup.set()
+        return str(syslog.id)
+
+    def insert_many(self, documents: List[dict]) -> int:
+        """
+        Insert syslog documents right away instead of buffering them, so bulk loads wait for mongo. Device counters
+        and hourly rollups are counted from each document's date_created and written with the next flush
+        :param documents: syslogs in their stored form, they get their _id on insert
+        :return: number of syslogs inserted
+        """
+        if not documents:
+            return 0
+        failed = set()
+        start = time.perf_counter()
+        try:
+            Syslog._get_collection().insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            logging.error(f"Error writing {len(failed)} of {len(documents)} syslogs to mongo: "
+                          f"{e.details['writeErrors'][0]['errmsg']}")
+        except PyMongoError as e:
+            self.failed += len(documents)
+            logging.error(f"Error writing {len(documents)} syslogs to mongo: {e}")
+            return 0
+        SYSLOG_SAVE_SECONDS.observe(time.perf_counter() - start)
+        with self.lock:
+            for index, document in enumerate(documents):
+                if index not in failed:
+                    self._count_syslog(devices=self.devices, rollups=self.rollups, src_ip=document["src_ip"],
+                                       src_port=document["src_port"], date=document["date_created"],
+                                       level=document["level"])
+            self.inserted += len(documents) - len(failed)
+            self.failed += len(failed)
+        self._start()
+        return len(documents) - len(failed)
+
+    def set_thread_ts(self, syslog_id: str, thread_ts: str) -> None:
+        """
+        Save the slack thread id of a syslog, either on the pending document or with the next bulk update
+        :param syslog_id:
+        :param thread_ts:
+        :return:
+        """
+        syslog_id = ObjectId(syslog_id)
+        with self.lock:
+            syslog = self.syslogs.get(syslog_id)
+            if syslog is not None:
+                syslog.thread_ts = thread_ts
+            else:
+                self.thread_ts[syslog_id] = thread_ts
+        self._start()
+
+    def add_repeats(self, syslog_id: str, src_ip: str, src_port: int, level: int, count: int) -> None:
+        """
+        Count repeats of a syslog that were not stored, they still count towards the device total and rollups
+        :param syslog_id: id of the first occurrence
+        :param src_ip:
+        :param src_port:
+        :param level:
+        :param count:
+        :return:
+        """
+        syslog_id = ObjectId(syslog_id)
+        with self.lock:
+            syslog = self.syslogs.get(syslog_id)
+            if syslog is not None:
+                syslog.repeat_count += count
+            else:
+                self.repeats[syslog_id] = self.repeats.get(syslog_id, 0) + count
+            self._count_syslog(devices=self.devices, rollups=self.rollups, src_ip=src_ip, src_port=src_port,
+                               date=datetime.datetime.now(), level=level, count=count)
+        self._start()
+
+    def flush(self) -> None:
+        """
+        Write everything that is buffered. Inserts always go before the updates that refer to them
+        :return:
+        """
+        with self.flush_lock:
+            with self.lock:
+                syslogs, self.syslogs = self.syslogs, dict()
+                devices, self.devices = self.devices, dict()
+                rollups, self.rollups = self.rollups, dict()
+                thread_ts, self.thread_ts = self.thread_ts, dict()
+                repeats, self.repeats = self.repeats, dict()
+            if not (syslogs or devices or rollups or thread_ts or repeats):
+                return
+            self.flushes += 1
+            duplicates = set()
+            if syslogs:
+                start = time.perf_counter()
+                inserted, duplicates, unsaved = self._insert(syslogs=syslogs)
+                SYSLOG_SAVE_SECONDS.observe(time.perf_counter() - start)
+                for syslog in syslogs.values():
+                    if syslog.id in inserted:
+                        self._count_syslog(devices=devices, rollups=rollups, src_ip=syslog.src_ip,
+                                           src_port=syslog.src_port, date=syslog.date_created, level=syslog.level)
+                if unsaved:
+                    # Thread ids and repeats of the syslogs that are kept go on the documents, updating them would
+                    # not match anything
+                    for syslog_id, syslog in unsaved.items():
+                        if syslog_id in thread_ts:
+                            syslog.thread_ts = thread_ts.pop(syslog_id)
+                        syslog.repeat_count += repeats.pop(syslog_id, 0)
+                    self._requeue(syslogs=unsaved)
+                # Thread ids and repeats may have been set while a duplicate was kept
+                for syslog_id in duplicates:
+                    syslog = syslogs[syslog_id]
+                    if syslog.thread_ts:
+                        thread_ts.setdefault(syslog_id, syslog.thread_ts)
+            if devices:
+                with DEVICE_SAVE_SECONDS.time():
+                    self._update_devices(devices=devices)
+            if rollups:
+                start = time.perf_counter()
+                try:
+                    SyslogRollup._get_collection().bulk_write(
+                        [SyslogRollup.inc_update(src_ip=src_ip, hour=hour, levels=levels)
+                         for (src_ip, hour), levels in rollups.items()],
+                        ordered=False
+                    )
+                except PyMongoError as e:
+                    logging.error(f"Error updating {len(rollups)} syslog rollups: {e}")
+                ROLLUP_SAVE_SECONDS.observe(time.perf_counter() - start)
+            updates = [UpdateOne({"_id": _id}, {"$set": {"thread_ts": ts}}) for _id, ts in thread_ts.items()]
+            updates.extend(UpdateOne({"_id": _id}, {"$inc": {"repeat_count": n}}) for _id, n in repeats.items())
+            updates.extend(
+                UpdateOne({"_id": _id}, {"$max": {"repeat_count": syslogs[_id].repeat_count}})
+                for _id in duplicates if syslogs[_id].repeat_count
+            )
+            if updates:
+                start = time.perf_counter()
+                try:
+                    Syslog._get_collection().bulk_write(updates, ordered=False)
+                except PyMongoError as e:
+                    logging.error(f"Error saving {len(updates)} syslog updates: {e}")
+                SYSLOG_UPDATE_SECONDS.observe(time.perf_counter() - start)
+
+    @property
+    def unsaved(self) -> int:
+        """
+        Syslogs that are buffered or kept after a failed insert
+        :return:
+        """
+        with self.lock:
+            return len(self.syslogs)
+
+    def _insert(self, syslogs: dict) -> Tuple[set, set, dict]:
+        """
+        Insert a batch of syslogs. Duplicates were inserted by an earlier attempt, syslogs mongo rejects are dropped
+        :param syslogs: {id: syslog}
+        :return: (ids of the inserted syslogs, ids of those that were duplicates, {id: syslog} to insert again after
+        an error that was not about the syslogs)
+        """
+        try:
+            Syslog._get_collection().insert_many([syslog.to_mongo() for syslog in syslogs.values()], ordered=False)
+        except BulkWriteError as e:
+            ids = list(syslogs)
+            rejected = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+            if rejected:
+                self.failed += len(rejected)
+                logging.error(f"Mongo rejected {len(rejected)} syslogs: {rejected[0]['errmsg']}")
+            inserted = set(ids) - {ids[error["index"]] for error in rejected}
+            duplicates = {ids[error["index"]] for error in e.details["writeErrors"] if error["code"] == 11000}
+            self.inserted += len(inserted)
+            return inserted, duplicates, dict()
+        except PyMongoError as e:
+            logging.error(f"Error writing {len(syslogs)} syslogs to mongo, they are written again with the next "
+                          f"flush: {e}")
+            return set(), set(), syslogs
+        self.inserted += len(syslogs)
+        return set(syslogs), set(), dict()
+
+    def _requeue(self, syslogs: dict) -> None:
+        """
+        Put syslogs back in front of the buffer. Beyond max_pending the oldest are dropped
+        :param syslogs:
+        :return:
+        """
+        with self.lock:
+            syslogs.update(self.syslogs)
+            overflow = len(syslogs) - self.max_pending
+            if overflow > 0:
+                for syslog_id in list(syslogs)[:overflow]:
+                    del syslogs[syslog_id]
+                self.failed += overflow
+                logging.error(f"More than {self.max_pending} syslogs are waiting for mongo, dropped {overflow}")
+            self.syslogs = syslogs
+
+    @staticmethod
+    def _count_syslog(devices: dict, rollups: dict, src_ip: str, src_port: int, date: datetime.datetime,
+                      level: int, count: int = 1) -> None:
+        src_port, device_count = devices.get(src_ip, (src_port, 0))
+        devices[src_ip] = (src_port, device_count + count)
+        levels = rollups.setdefault((src_ip, SyslogRollup.hour_of(date)), dict())
+        levels[str(level)] = levels.get(str(level), 0) + count
+
+    def _update_devices(self, devices: dict) -> None:
+        """
+        One $inc per device. Devices that are not cached are upserted, when another ingest process
+        upserted the same device first the update is retried as a plain $inc
+        :param devices: {src_ip: (src_port, count)}
+        :return:
+        """
+        src_ips = list(devices)
+        updates = [
+            Device.count_update(src_ip=src_ip, src_port=src_port, count=count, known=src_ip in self.known_devices)
+            for src_ip, (src_port, count) in devices.items()
+        ]
+        retries = []
+        try:
+            Device._get_collection().bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                src_ip = src_ips[error["index"]]
+                if error["code"] == 11000:
+                    src_port, count = devices[src_ip]
+                    retries.append(Device.count_update(src_ip=src_ip, src_port=src_port, count=count, known=True))
+                else:
+                    logging.error(f"Error updating device {src_ip}: {error['errmsg']}")
+        except PyMongoError as e:
+            logging.error(f"Error updating {len(devices)} devices: {e}")
+            return
+        if retries:
+            try:
+                Device._get_collection().bulk_write(retries, ordered=False)
+            except PyMongoError as e:
+                logging.error(f"Error updating {len(retries)} devices: {e}")
+        for src_ip in src_ips:
+            self.known_devices.add(src_ip)
+
+    def _start(self) -> None:
+        if self.thread:
+            return
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name="syslog-writer", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait(timeout=self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing syslogs: {e}")
@@ -1,26 +1,52 @@
+import hmac
 import logging
 
 from app.config import BaseConfig
 from app.server import app_blueprints
-from app.tasks import generate_jira_ticket, generate_timeline_chart
-from flask import abort, jsonify
+from app.tasks import generate_jira_ticket, generate_syslog_export, generate_timeline_chart
+from app.utils.metrics import CONTENT_TYPE, REGISTRY, SLACK_ACTION_FAILURES, SLACK_ACTIONS
+from flask import abort, g, jsonify, make_response, Response, stream_with_context
 from flask import request
-from app.utils.utils import unmarshall_slack_api_request, generate_200_ok
+from app.utils.syslog_search import parse_search_args, stream_syslogs
+from app.utils.utils import unmarshall_slack_api_request, generate_200_ok, verify_slack_signature
+from slack_sdk.webhook import WebhookClient
 
 logger = logging.getLogger(__name__)
 
+# Celery task per (action type, button text or first word of the selected option)
+ACTION_TASKS = {
+    ("button", "Create"): generate_jira_ticket,
+    ("overflow", "Generate"): generate_timeline_chart,
+    ("overflow", "Export"): generate_syslog_export,
+}
+
 
 @app_blueprints.before_request
 def pre_check():
     """
-    Verify Slack token for every request
+    Verify every Slack request and parse its payload once into g.slack_payload
     :return:
     """
-    if "payload" in request.form:
-        logger.info(f"Slack Body: {unmarshall_slack_api_request(api_request=request)}")
-        json_body = unmarshall_slack_api_request(api_request=request)
-        if json_body["token"] != BaseConfig.SLACK_VERIFICATION_TOKEN:
+    if request.method != "POST":
+        return
+    # Read the raw body before the form, the form is parsed from the cached body
+    body = request.get_data()
+    if "payload" not in request.form:
+        return
+    if BaseConfig.SLACK_SIGNING_SECRET:
+        if not verify_slack_signature(
+            body=body,
+            timestamp=request.headers.get("X-Slack-Request-Timestamp"),
+            signature=request.headers.get("X-Slack-Signature")
+        ):
+            return abort(403)
+        g.slack_payload = unmarshall_slack_api_request(api_request=request)
+    else:
+        g.slack_payload = unmarshall_slack_api_request(api_request=request)
+        if g.slack_payload.get("token") != BaseConfig.SLACK_VERIFICATION_TOKEN:
             return abort(403)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Slack Body: {g.slack_payload}")
 
 
 @app_blueprints.route('/', methods=['GET'])
@@ -32,26 +58,81 @@ def index():
     return jsonify("API is Up")
 
 
+@app_blueprints.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics of this web worker
+    :return:
+    """
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+@app_blueprints.route('/syslogs', methods=['GET'])
+def search_syslogs():
+    """
+    Search stored syslogs, newest first. Streams one json syslog per line and a last line with the next_cursor
+    to pass as cursor for the next page
+    :return:
+    """
+    # The API is off until a token is configured
+    if not BaseConfig.SYSLOG_API_TOKEN:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {BaseConfig.SYSLOG_API_TOKEN}".encode()):
+        abort(401)
+    try:
+        query, limit = parse_search_args(args=request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return Response(stream_with_context(stream_syslogs(query=query, limit=limit)), mimetype="application/x-ndjson")
+
+
 @app_blueprints.route('/slack/message_actions', methods=['POST'])
 def slack_button_response():
     """
-    API route to handle user interactions to bot messages
+    API route to handle user interactions to bot messages. If the task can't be queued the user gets an ephemeral
+    error message
     :return:
     """
-    if request.method != "POST":
+    json_body = g.get("slack_payload")
+    if json_body is None:
         abort(400)
 
-    json_body = unmarshall_slack_api_request(api_request=request)
     button_action = json_body["actions"][0]
-    button_type = button_action["type"]
-    if button_type == "button":
-        button_metadata = button_action["text"]["text"]
-        if button_metadata == "Create Jira Ticket":
-            generate_jira_ticket.apply_async(args=[json_body])
-    elif button_type == "overflow":
-        generate_timeline_chart.apply_async(args=[json_body])
+    action_key = _action_key(action=button_action)
+    task = ACTION_TASKS.get(action_key)
+    action = task.name.rsplit(".", 1)[-1] if task is not None else "unhandled"
+    SLACK_ACTIONS.labels(action).inc()
+    if task is not None:
+        try:
+            task.apply_async(args=[json_body])
+        except Exception as e:
+            SLACK_ACTION_FAILURES.labels(action).inc()
+            logger.error(f"Error queueing {action}: {e}")
+            _reply_error(json_body=json_body, text="Sorry, this action could not be started, please try again later")
+    return make_response(generate_200_ok())
 
-    return generate_200_ok()
 
+def _reply_error(json_body: dict, text: str) -> None:
+    """
+    Ephemeral message to the user who clicked, through the response_url of the interaction
+    :param json_body:
+    :param text:
+    :return:
+    """
+    if not json_body.get("response_url"):
+        return
+    try:
+        WebhookClient(url=json_body["response_url"]).send(text=text, response_type="ephemeral", replace_original=False)
+    except Exception as e:
+        logger.error(f"Error replying to slack interaction: {e}")
 
 
+def _action_key(action: dict) -> tuple:
+    if action["type"] == "button":
+        text = action["text"]["text"]
+    elif action["type"] == "overflow":
+        text = action["selected_option"]["text"]["text"]
+    else:
+        return action["type"], None
+    return action["type"], text.split(" ", 1)[0]
@@ -1,4 +1,5 @@
 from app.tasks.tasks import generate_jira_ticket
 from app.tasks.tasks import generate_timeline_chart
+from app.tasks.tasks import generate_syslog_export
 from app.tasks.tasks import run_syslog_server
 
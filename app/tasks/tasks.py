@@ -1,18 +1,60 @@
 import logging
 import os
 import socketserver
+import threading
+import time
 
 
 from app import celery
 from app import BaseConfig
-from app.models import SlackIntegration, Syslog, SyslogUDPHandler
-from app.utils.utils import create_jira_issue, DAYS, generate_chart
+from app.models import AsyncSyslogServer, Syslog, SyslogUDPHandler, SyslogWorkerSupervisor
+from app.models.slack_integration import get_slack_integration
+from app.models.syslog_server import SyslogServerStats
+from app.models.syslog_summary import apply_retention, compact_syslogs, daily_counts, release_pins
+from app.utils.chart_cache import ChartCache
+from app.utils.metrics import start_metrics_server, TASK_FAILURES, TASK_SECONDS
+from app.utils.export import export_syslogs
+from app.utils.utils import DAYS, EXPORT_DAYS
 from celery.contrib.abortable import AbortableTask
+from billiard.process import current_process
+from celery.signals import task_failure, task_postrun, task_prerun, worker_process_init, worker_ready
 from datetime import datetime, timedelta
 from mongoengine import connect
 
-slack = SlackIntegration()
+chart_cache = ChartCache()
 connect(host=BaseConfig.MONGODB_HOST)
+# Start time of the tasks running in this process by task id
+task_started = dict()
+
+
+@worker_ready.connect
+def start_worker_metrics(**kwargs) -> None:
+    if BaseConfig.METRICS_WORKER_PORT:
+        start_metrics_server(port=BaseConfig.METRICS_WORKER_PORT)
+
+
+@worker_process_init.connect
+def start_pool_process_metrics(**kwargs) -> None:
+    # Prefork tasks run in the pool processes, each serves its metrics on the ports after the worker's
+    if BaseConfig.METRICS_WORKER_PORT:
+        start_metrics_server(port=BaseConfig.METRICS_WORKER_PORT + 1 + getattr(current_process(), "index", 0))
+
+
+@task_prerun.connect
+def task_started_handler(task_id: str, **kwargs) -> None:
+    task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_finished_handler(task_id: str, task, **kwargs) -> None:
+    start = task_started.pop(task_id, None)
+    if start is not None:
+        TASK_SECONDS.labels(task.name).observe(time.perf_counter() - start)
+
+
+@task_failure.connect
+def task_failed_handler(sender, **kwargs) -> None:
+    TASK_FAILURES.labels(sender.name).inc()
 
 
 @celery.task()
@@ -22,23 +64,45 @@ def generate_jira_ticket(json_body: dict) -> None:
     :param json_body:
     :return:
     """
+    # Jira is only imported by the workers that create tickets
+    from app.utils.jira_client import create_jira_issue
     try:
         # Parse Response
         action = json_body["actions"][0]
         syslog_id = action["value"]
-        syslog = Syslog.objects.get(id=syslog_id)
 
-        # Create Jira Issue
-        jira_url = create_jira_issue(message=syslog.to_mongo())
+        # Only the first click creates a ticket, repeats get the existing one
+        if Syslog.claim_jira_ticket(syslog_id=syslog_id, timeout=BaseConfig.JIRA_CLAIM_TIMEOUT):
+            jira_url = None
+            try:
+                syslog = Syslog.objects.get(id=syslog_id)
+                # Create Jira Issue
+                jira_url = create_jira_issue(message=syslog.to_mongo())
+            finally:
+                # Whatever failed, the next click tries again instead of waiting for the claim to time out
+                if not jira_url:
+                    Syslog.release_jira_ticket(syslog_id=syslog_id)
+            if not jira_url:
+                return
+            # The ticket keeps the syslog until it is closed
+            syslog.update(set__jira_url=jira_url, unset__jira_pending_since=True, set__pinned=True,
+                          set__pinned_at=datetime.now())
+            text = f"JIRA bug created here {jira_url}"
+        else:
+            syslog = Syslog.objects.get(id=syslog_id)
+            if not syslog.jira_url:
+                logging.info(f"Jira ticket for syslog {syslog_id} is already being created")
+                return
+            text = f"JIRA bug already created here {syslog.jira_url}"
 
         params = {
             "channel": json_body["channel"]["id"],
             "mrkdwn": True,
             "thread_ts": syslog.thread_ts,
-            "text": f"JIRA bug created here {jira_url}"
+            "text": text
         }
 
-        slack.post_any_message(kwargs=params)
+        get_slack_integration().post_any_message(kwargs=params)
     except Exception as e:
         logging.info(f"Error: {e}")
 
@@ -50,6 +114,8 @@ def generate_timeline_chart(json_body: dict) -> None:
     :param json_body:
     :return:
     """
+    # Matplotlib is only imported by the workers that draw charts
+    from app.utils.charts import generate_chart
     # Parse response
     selected_option = json_body["actions"][0]["selected_option"]
     syslog_id = selected_option["value"]
@@ -62,21 +128,19 @@ def generate_timeline_chart(json_body: dict) -> None:
     end_time = datetime.today()
     start_time = end_time - timedelta(days=days)
 
-    # Create mongodb aggregation
-    query_pipeline = [
-        {"$match": {"src_ip": syslog.src_ip, "date_created": {"$gte": start_time, "$lt": end_time}}},
-        {"$group": {"_id": {"day": {"$dayOfMonth": "$date_created"}, "month": {"$month": "$date_created"}, "year": {"$year": "$date_created"}}, "count": {"$sum": 1}}}
-    ]
-
-    # Make Database aggregation from data
-    per_day_counts = list(Syslog.objects().aggregate(pipeline=query_pipeline))
+    def render_chart() -> bytes:
+        # Make Database aggregation from the hourly rollups, and the daily summaries past their retention
+        per_day_counts = list(daily_counts(src_ip=syslog.src_ip, start_time=start_time, end_time=end_time))
+        # Generate a png chart
+        return generate_chart(mongo_db_data=per_day_counts, end_time=end_time, start_time=start_time)
 
-    # Generate a chart and save it as a .png file
-    temp_filename = generate_chart(mongo_db_data=per_day_counts, end_time=end_time, start_time=start_time)
+    # Identical requests within the same time bucket share one render
+    cache_key = chart_cache.key(src_ip=syslog.src_ip, chart_range=chart_name, end_time=end_time)
+    chart = chart_cache.get_or_render(key=cache_key, render=render_chart)
 
     # Upload chart image to slack
-    upload_response = slack.upload_file(filename=temp_filename)
-    os.remove(temp_filename)
+    slack = get_slack_integration()
+    upload_response = slack.upload_file(filename=f"{syslog.src_ip}-{chart_name.replace(' ', '-')}.png", content=chart)
     slack_file_id = upload_response.data["file"]["id"]
 
     # Make the file public
@@ -97,24 +161,105 @@ def generate_timeline_chart(json_body: dict) -> None:
 
     # Post chart image to slack thread
     slack.post_any_message(kwargs=params)
+    Syslog.pin(syslog_id=syslog_id)
+
+
+@celery.task()
+def generate_syslog_export(json_body: dict) -> None:
+    """
+    Asynchronous task to export a device's syslogs to parquet and post the file in the slack thread
+    :param json_body:
+    :return:
+    """
+    selected_option = json_body["actions"][0]["selected_option"]
+    syslog = Syslog.objects.get(id=selected_option["value"])
+    export_range = selected_option["text"]["text"][7:]
+    end_time = datetime.now()
+    start_time = end_time - timedelta(days=EXPORT_DAYS[export_range])
+
+    os.makedirs(BaseConfig.SYSLOG_EXPORT_DIR, exist_ok=True)
+    path = os.path.join(BaseConfig.SYSLOG_EXPORT_DIR, f"{syslog.src_ip}-{end_time:%Y%m%d%H%M%S}.parquet")
+    try:
+        report = export_syslogs(path=path, src_ips=[syslog.src_ip], start_time=start_time, end_time=end_time)
+        slack = get_slack_integration()
+        upload_response = slack.upload_file(filename=path)
+        params = {
+            "channel": json_body["channel"]["id"],
+            "mrkdwn": True,
+            "text": f"{report['rows']} syslogs of {syslog.src_ip} from the last {EXPORT_DAYS[export_range]} days: "
+                    f"{upload_response.data['file']['permalink']}",
+            "thread_ts": syslog.thread_ts,
+        }
+        slack.post_any_message(kwargs=params)
+        Syslog.pin(syslog_id=syslog.id)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@celery.task()
+def compact_syslog_summaries() -> int:
+    """
+    Apply the retention, release the pins that expired or whose ticket was closed and summarize the days whose syslogs
+    changed
+    :return: number of summaries written
+    """
+    apply_retention()
+    closed_tickets = None
+    if BaseConfig.JIRA_URL:
+        # Jira is only imported by the workers
+        from app.utils.jira_client import closed_jira_issues
+        closed_tickets = closed_jira_issues
+    release_pins(closed_tickets=closed_tickets)
+    written = compact_syslogs()
+    logging.info(f"Wrote {written} syslog daily summaries")
+    return written
 
 
 @celery.task(bae=AbortableTask)
-def run_syslog_server() -> None:
+def run_syslog_server(mode: str = BaseConfig.SYSLOG_SERVER_MODE, workers: int = BaseConfig.SYSLOG_WORKERS) -> None:
     """
     Code start the syslog server
+    :param mode: "socketserver" or "asyncio"
+    :param workers: Number of SO_REUSEPORT worker processes, these always run the asyncio server
     :return:
     """
     # Kill old server if still running
     logging.info("Killing any process using syslog port")
     os.system(f"lsof -t -i :{BaseConfig.PORT} | xargs kill -9")
+    if BaseConfig.METRICS_SYSLOG_PORT:
+        start_metrics_server(port=BaseConfig.METRICS_SYSLOG_PORT)
     try:
-        print("Syslog Server Starting")
-        server = socketserver.UDPServer((BaseConfig.HOST, BaseConfig.PORT), SyslogUDPHandler)
-        server.serve_forever(poll_interval=0.5)
+        if workers > 1:
+            print(f"Syslog Server Starting ({workers} workers)")
+            SyslogWorkerSupervisor(target=run_syslog_worker, workers=workers).serve_forever()
+            return
+        print(f"Syslog Server Starting ({mode})")
+        if mode == "asyncio":
+            AsyncSyslogServer().serve_forever()
+        else:
+            if BaseConfig.SYSLOG_TCP_PORT:
+                # The TCP listener is part of the asyncio server, run only that part beside the UDP server
+                threading.Thread(
+                    target=AsyncSyslogServer(udp=False).serve_forever, name="syslog-tcp-server", daemon=True
+                ).start()
+            server = socketserver.UDPServer((BaseConfig.HOST, BaseConfig.PORT), SyslogUDPHandler)
+            server.serve_forever(poll_interval=0.5)
     except (IOError, SystemExit):
         raise
     except KeyboardInterrupt:
         print("Crtl+C Pressed. Shutting down.")
 
 
+def run_syslog_worker(counters, counters_offset: int) -> None:
+    """
+    Entrypoint of a SO_REUSEPORT worker process started by SyslogWorkerSupervisor
+    :param counters: Shared counters array of the supervisor
+    :param counters_offset: Index of this worker's counters
+    :return:
+    """
+    if BaseConfig.METRICS_SYSLOG_PORT:
+        index = counters_offset // len(SyslogServerStats.FIELDS)
+        start_metrics_server(port=BaseConfig.METRICS_SYSLOG_PORT + 1 + index)
+    server = AsyncSyslogServer(reuse_port=True, counters=counters, counters_offset=counters_offset)
+    server.serve_forever()
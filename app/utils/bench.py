@@ -0,0 +1,239 @@
+import itertools
+import json
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+from app.config import BaseConfig
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+# Cisco syslog lines as seen from our devices, {n} is replaced with random numbers
+CISCO_TEMPLATES = [
+    "<187>{n}: {time}: %LINK-3-UPDOWN: Interface GigabitEthernet0/{n}, changed state to down",
+    "<189>{n}: {time}: %LINEPROTO-5-UPDOWN: Line protocol on Interface GigabitEthernet1/0/{n}, changed state to up",
+    "<186>{n}: {time}: %PLATFORM_ENV-2-FRU_PS_FAN_FAILED: Fan {n} in power supply {n} has failed",
+    "<189>{n}: {time}: %SYS-5-CONFIG_I: Configured from console by admin on vty{n} (10.1.{n}.{n})",
+    "<190>{n}: {time}: %MODULE-2-MOD_DIAG_FAIL: Module {n} reported failure Ethernet2/{n} due to Fatal runtime "
+    "Arb error. (DevErr is bitmap of failed modules) in device DEV_XBAR_COMPLEX (device error 0x{n})",
+    "<188>{n}: {time}: %BGP-4-MSGDUMP_LIMIT: BGP: Error message dump limit exceeded for neighbor 10.0.{n}.{n}",
+    "<185>{n}: {time}: %OSPF-1-NBRSTATE: Process {n}, Nbr 10.2.{n}.{n} on Vlan{n} from FULL to DOWN",
+]
+# Marker appended to every generated line so the fake Slack can match posts to the time they were sent
+BENCH_MARKER = re.compile(r"\[bench (\d+)]")
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class SyslogLoadGenerator:
+    """
+    Sends Cisco syslog lines over UDP at a fixed rate and remembers when each one was sent
+    """
+    def __init__(self, host: str, port: int, rate: int, duration: float, templates: List[str] = None):
+        self.address = (host, port)
+        self.rate = rate
+        self.duration = duration
+        self.templates = templates or CISCO_TEMPLATES
+        self.sent_at = dict()
+        self.sent = 0
+
+    def run(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rng = random.Random(0)
+        start = time.monotonic()
+        total = int(self.rate * self.duration)
+        for seq in range(total):
+            # Keep to the schedule, sending in bursts when we fall behind
+            delay = start + seq / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            line = rng.choice(self.templates).replace("{time}", time.strftime("%b %d %H:%M:%S.000"))
+            line = re.sub(r"\{n}", lambda _: str(rng.randint(1, 48)), line)
+            self.sent_at[seq] = time.monotonic()
+            sock.sendto(f"{line} [bench {seq}]".encode(), self.address)
+            self.sent += 1
+        sock.close()
+
+
+class FakeSlackServer:
+    """
+    Local stand-in for the Slack Web API. Answers every method successfully after `latency` seconds,
+    every `rate_limit_every`th chat.postMessage gets a 429 with Retry-After instead
+    """
+    def __init__(self, channel: str, latency: float = 0.0, rate_limit_every: int = 0, retry_after: float = 1.0):
+        self.channel = channel
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.posted_at = dict()
+        self.calls = dict()
+        self.rate_limited = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api/"
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-slack", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method: str, params: dict) -> tuple:
+        """
+        Status and body of the response to an API call
+        :param method: e.g. chat.postMessage
+        :param params: request arguments
+        :return:
+        """
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            count = self.calls[method]
+        if method == "chat.postMessage":
+            if self.rate_limit_every and count % self.rate_limit_every == 0:
+                with self.lock:
+                    self.rate_limited += 1
+                return 429, {"ok": False, "error": "ratelimited"}
+            time.sleep(self.latency)
+            match = BENCH_MARKER.search(params.get("text", ""))
+            if match:
+                with self.lock:
+                    self.posted_at[int(match.group(1))] = time.monotonic()
+            return 200, {"ok": True, "channel": params.get("channel"), "ts": f"{time.time():.6f}"}
+        time.sleep(self.latency)
+        if method == "conversations.list":
+            return 200, {"ok": True, "channels": [{"id": "CBENCH", "name": self.channel}],
+                         "response_metadata": {"next_cursor": ""}}
+        return 200, {"ok": True, "channel": params.get("channel"), "ts": f"{next(self.counter)}.000000"}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                status, data = fake.respond(method=self.path.rsplit("/", 1)[-1], params=params)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", str(fake.retry_after))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def run_ingest_benchmark(rate: int, duration: float, port: int, mode: str = "socketserver",
+                         mongo_host: str = "mongomock://localhost/syslog_bench", slack_latency: float = 0.0,
+                         rate_limit_every: int = 0, post_rate: float = 1000.0,
+                         storm_suppression: bool = False, drain_timeout: float = 30.0) -> dict:
+    """
+    Send syslogs through the real ingest path (UDP server, process_syslog_message, syslog writer and slack poster)
+    with mongo and slack replaced by local stand-ins
+    :param rate: messages per second sent
+    :param duration: seconds to send for
+    :param port: UDP port of the syslog server
+    :param mode: "socketserver" or "asyncio"
+    :param mongo_host: mongomock:// or a local mongod
+    :param slack_latency: seconds the fake slack takes per call
+    :param rate_limit_every: every Nth post is rate limited, 0 disables it
+    :param post_rate: posts per second per channel allowed by the scheduler
+    :param storm_suppression: fold repeats, off by default so every message is stored
+    :param drain_timeout: seconds to wait for ingest to catch up after sending
+    :return: report
+    """
+    from app.models.slack_integration import get_slack_integration
+    from app.models.syslog_server import AsyncSyslogServer, SyslogUDPHandler
+    from app.utils.channel_cache import ChannelCache
+    from mongoengine import connect, disconnect
+
+    disconnect()
+    connect(host=mongo_host)
+
+    fake_slack = FakeSlackServer(channel="syslog-bench", latency=slack_latency, rate_limit_every=rate_limit_every)
+    fake_slack.start()
+    BaseConfig.SLACK_API_URL = fake_slack.url
+    BaseConfig.SLACK_CHANNEL = fake_slack.channel
+    BaseConfig.SLACK_POST_RATE = post_rate
+    BaseConfig.SLACK_POST_BURST = max(BaseConfig.SLACK_POST_BURST, int(post_rate))
+    BaseConfig.STORM_SUPPRESSION = storm_suppression
+
+    # Created after the settings above so the ingest path talks to the fake slack
+    slack = get_slack_integration()
+    slack.channel_cache = ChannelCache(backend="disk")
+
+    if mode == "asyncio":
+        server = AsyncSyslogServer(host="127.0.0.1", port=port)
+        threading.Thread(target=server.serve_forever, name="bench-syslog-server", daemon=True).start()
+    else:
+        server = socketserver.UDPServer(("127.0.0.1", port), SyslogUDPHandler)
+        threading.Thread(target=server.serve_forever, name="bench-syslog-server", daemon=True).start()
+    time.sleep(0.5)
+
+    generator = SyslogLoadGenerator(host="127.0.0.1", port=port, rate=rate, duration=duration)
+    start = time.monotonic()
+    generator.run()
+    sending_time = time.monotonic() - start
+
+    def accepted() -> int:
+        slack.writer.flush()
+        return slack.writer.inserted + (slack.suppressor.suppressed if slack.suppressor else 0)
+
+    # Wait until the server stops accepting new messages
+    deadline = time.monotonic() + drain_timeout
+    count = accepted()
+    last_change = time.monotonic()
+    while time.monotonic() < deadline and time.monotonic() - last_change < 1:
+        time.sleep(0.2)
+        if accepted() != count:
+            count = accepted()
+            last_change = time.monotonic()
+    ingest_time = last_change - start
+    slack.poster.flush(timeout=max(0.0, deadline - time.monotonic()))
+    if mode != "asyncio":
+        server.shutdown()
+        server.server_close()
+    fake_slack.stop()
+
+    latencies = [
+        posted - generator.sent_at[seq] for seq, posted in fake_slack.posted_at.items() if seq in generator.sent_at
+    ]
+    return {
+        "sent": generator.sent,
+        "send_rate": generator.sent / sending_time,
+        "accepted": count,
+        "ingest_rate": count / ingest_time if ingest_time else 0.0,
+        "drop_rate": 1 - count / generator.sent if generator.sent else 0.0,
+        "posted": len(fake_slack.posted_at),
+        "post_dropped": slack.poster.dropped,
+        "rate_limited": fake_slack.rate_limited,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+    }
@@ -0,0 +1,48 @@
+import logging
+
+from app.config import BaseConfig
+from app.utils.chart_cache import DiskChartBackend, RedisChartBackend
+from typing import Optional
+
+
+class ChannelCache:
+    """
+    Slack channel ids by name, shared by every process through the same backends as the chart cache.
+    Errors are logged and treated as a miss so a broken cache only costs a lookup
+    """
+    def __init__(self, backend: str = BaseConfig.SLACK_CHANNEL_CACHE_BACKEND,
+                 ttl: int = BaseConfig.SLACK_CHANNEL_CACHE_TTL):
+        self.backend_name = backend
+        self.backend = None
+        self.ttl = ttl
+
+    def get(self, name: str) -> Optional[str]:
+        try:
+            channel_id = self._backend().get(key=self._key(name=name))
+        except Exception as e:
+            logging.error(f"Error reading slack channel {name} from cache: {e}")
+            return None
+        return channel_id.decode() if channel_id else None
+
+    def set(self, name: str, channel_id: str) -> None:
+        try:
+            self._backend().set(key=self._key(name=name), data=channel_id.encode(), ttl=self.ttl)
+        except Exception as e:
+            logging.error(f"Error caching slack channel {name}: {e}")
+
+    def delete(self, name: str) -> None:
+        try:
+            self._backend().delete(key=self._key(name=name))
+        except Exception as e:
+            logging.error(f"Error removing slack channel {name} from cache: {e}")
+
+    def _key(self, name: str) -> str:
+        return f"slack:channel:{name}"
+
+    def _backend(self):
+        if self.backend is None:
+            if self.backend_name == "redis":
+                self.backend = RedisChartBackend(url=BaseConfig.SLACK_CHANNEL_CACHE_REDIS_URL)
+            else:
+                self.backend = DiskChartBackend(directory=BaseConfig.SLACK_CHANNEL_CACHE_DIR)
+        return self.backend
@@ -0,0 +1,184 @@
+import fcntl
+import logging
+import os
+import redis
+import threading
+import time
+
+from app.config import BaseConfig
+from contextlib import contextmanager
+from datetime import datetime
+from redis.exceptions import LockError, RedisError
+from typing import Callable, Optional
+
+
+class RedisChartBackend:
+    """
+    Charts stored in redis with a TTL, renders are locked with a redis lock so they are shared between workers
+    """
+    def __init__(self, url: str = BaseConfig.CHART_CACHE_REDIS_URL):
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, data: bytes, ttl: int) -> None:
+        self.client.set(key, data, ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+    @contextmanager
+    def lock(self, key: str, timeout: int):
+        lock = self.client.lock(f"{key}:lock", timeout=timeout, blocking_timeout=timeout)
+        try:
+            acquired = lock.acquire()
+        except RedisError as e:
+            # Render without the lock rather than failing the request
+            logging.error(f"Error locking chart {key}: {e}")
+            acquired = False
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except (LockError, RedisError):
+                    pass
+
+
+class DiskChartBackend:
+    """
+    Charts stored as files, expired by modification time. Renders are locked with flock
+    """
+    def __init__(self, directory: str = BaseConfig.CHART_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key=key)
+        try:
+            expires = os.path.getmtime(path)
+            if expires < time.time():
+                os.remove(path)
+                return None
+            with open(path, "rb") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def set(self, key: str, data: bytes, ttl: int) -> None:
+        path = self._path(key=key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        # The modification time is used as the expiry time
+        expires = time.time() + ttl
+        os.utime(temp_path, (expires, expires))
+        os.replace(temp_path, path)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key=key))
+        except OSError:
+            pass
+
+    @contextmanager
+    def lock(self, key: str, timeout: int):
+        with open(f"{self._path(key=key)}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key.replace(":", "_").replace("/", "_"))
+
+
+class ChartCache:
+    """
+    Cache of rendered charts. Concurrent requests for the same chart wait for a single render
+    """
+    def __init__(self, backend: str = BaseConfig.CHART_CACHE_BACKEND, ttl: int = BaseConfig.CHART_CACHE_TTL,
+                 bucket: int = BaseConfig.CHART_CACHE_BUCKET, render_timeout: int = 60):
+        self.backend_name = backend
+        self.backend = None
+        self.ttl = ttl
+        self.bucket = bucket
+        self.render_timeout = render_timeout
+        self.lock = threading.Lock()
+        self.key_locks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, src_ip: str, chart_range: str, end_time: datetime) -> str:
+        """
+        Charts of a device for the same range requested within the same time bucket share a key
+        :param src_ip:
+        :param chart_range: e.g. "1 week chart"
+        :param end_time:
+        :return:
+        """
+        bucket = int(end_time.timestamp()) // self.bucket
+        return f"chart:{src_ip}:{chart_range.replace(' ', '_')}:{bucket}"
+
+    def get_or_render(self, key: str, render: Callable[[], bytes]) -> bytes:
+        """
+        Return the cached chart or render it. Only one thread per process and one process per backend renders a key
+        :param key:
+        :param render: returns the png
+        :return:
+        """
+        backend = self._backend()
+        data = self._get(backend=backend, key=key)
+        if data:
+            self.hits += 1
+            return data
+        with self._key_lock(key=key):
+            data = self._get(backend=backend, key=key)
+            if data:
+                self.hits += 1
+                return data
+            with backend.lock(key=key, timeout=self.render_timeout):
+                data = self._get(backend=backend, key=key)
+                if data:
+                    self.hits += 1
+                    return data
+                self.misses += 1
+                data = render()
+                try:
+                    backend.set(key=key, data=data, ttl=self.ttl)
+                except Exception as e:
+                    logging.error(f"Error caching chart {key}: {e}")
+                return data
+
+    def _get(self, backend, key: str) -> Optional[bytes]:
+        try:
+            return backend.get(key=key)
+        except Exception as e:
+            logging.error(f"Error reading chart {key} from cache: {e}")
+            return None
+
+    def _backend(self):
+        if self.backend is None:
+            with self.lock:
+                if self.backend is None:
+                    self.backend = RedisChartBackend() if self.backend_name == "redis" else DiskChartBackend()
+        return self.backend
+
+    @contextmanager
+    def _key_lock(self, key: str):
+        with self.lock:
+            lock, users = self.key_locks.get(key, (threading.Lock(), 0))
+            self.key_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.key_locks[key]
+                if users == 1:
+                    del self.key_locks[key]
+                else:
+                    self.key_locks[key] = (lock, users - 1)
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+def generate_chart(mongo_db_data: list, start_time: datetime, end_time: datetime) -> bytes:
+    """
+    Generating a chart based on the user input and from mongodb
+    :param mongo_db_data:
+    :param start_time:
+    :param end_time:
+    :return: png image
+    """
+    # Generating matplotlib chart xaxis and yaxis
+    data_from_db = {
+        datetime.strptime(f"{d['_id']['day']}-{d['_id']['month']}-{d['_id']['year']}", '%d-%m-%Y').isocalendar(): d["count"] for d in mongo_db_data
+    }
+    delta = end_time - start_time  # as timedelta
+    xaxis = list()
+    yaxis = list()
+    for i in range(delta.days + 1):
+        date = (start_time + timedelta(days=i)).date()
+        # Set default value to 0
+        count = 0
+        # If the database returns a datapoint, subsitute it
+        if date.isocalendar() in data_from_db:
+            count = data_from_db[date.isocalendar()]
+
+        xaxis.append(date)
+        yaxis.append(count)
+
+    # Create the chart with the Agg canvas directly, pyplot would keep every figure alive
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    try:
+        ax = fig.subplots()
+        ax.bar(xaxis, yaxis)
+        ax.xaxis_date()
+        fig.autofmt_xdate()
+        ax.set_xlabel("Day")
+        ax.set_ylabel("# of Error Syslogs")
+
+        # Render the chart in memory
+        image = BytesIO()
+        canvas.print_png(image)
+        return image.getvalue()
+    finally:
+        fig.clear()
@@ -0,0 +1,92 @@
+import datetime
+import logging
+import os
+import time
+
+from app.config import BaseConfig
+from app.models import Syslog
+from typing import List
+
+EXPORT_FORMATS = ("parquet", "arrow")
+# Column name and arrow type name of each exported Syslog field
+EXPORT_COLUMNS = (
+    ("id", "string"), ("src_ip", "string"), ("src_port", "int32"), ("level", "int8"), ("facility", "string"),
+    ("mnemonic", "string"), ("hostname", "string"), ("syslog", "string"), ("time", "string"),
+    ("repeat_count", "int32"), ("thread_ts", "string"), ("jira_url", "string"), ("date_created", "timestamp"),
+)
+
+
+def _schema(pa):
+    types = {"string": pa.string(), "int8": pa.int8(), "int32": pa.int32(), "timestamp": pa.timestamp("ms")}
+    return pa.schema([(name, types[type_name]) for name, type_name in EXPORT_COLUMNS])
+
+
+def export_syslogs(path: str, src_ips: List[str] = None, start_time: datetime.datetime = None,
+                   end_time: datetime.datetime = None, file_format: str = "parquet",
+                   batch_size: int = BaseConfig.SYSLOG_EXPORT_BATCH_SIZE) -> dict:
+    """
+    Write syslogs to a Parquet or Arrow IPC file. Syslogs are read from the cursor batch_size at a time and every
+    batch is written as its own row group, so memory stays bounded whatever the number of syslogs
+    :param path: file to write
+    :param src_ips: only these devices
+    :param start_time: only syslogs created from this time
+    :param end_time: only syslogs created before this time
+    :param file_format: "parquet" or "arrow"
+    :param batch_size: rows per row group
+    :return: report with rows, seconds, rows_per_second and bytes
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {file_format}, expected one of {', '.join(EXPORT_FORMATS)}")
+    # pyarrow is only imported by the processes that export
+    import pyarrow as pa
+
+    query = dict()
+    if src_ips:
+        query["src_ip"] = {"$in": list(src_ips)}
+    if start_time or end_time:
+        query["date_created"] = dict()
+        if start_time:
+            query["date_created"]["$gte"] = start_time
+        if end_time:
+            query["date_created"]["$lt"] = end_time
+    projection = {name: 1 for name, _ in EXPORT_COLUMNS if name != "id"}
+
+    schema = _schema(pa=pa)
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(path, schema)
+
+    start = time.perf_counter()
+    rows = 0
+    columns = {name: [] for name, _ in EXPORT_COLUMNS}
+    cursor = Syslog._get_collection().find(query, projection=projection, sort=[("_id", 1)], batch_size=batch_size)
+    try:
+        for document in cursor:
+            document["id"] = str(document["_id"])
+            for name, values in columns.items():
+                values.append(document.get(name))
+            if len(columns["id"]) >= batch_size:
+                rows += _write_batch(pa=pa, writer=writer, schema=schema, columns=columns)
+        if columns["id"]:
+            rows += _write_batch(pa=pa, writer=writer, schema=schema, columns=columns)
+    finally:
+        cursor.close()
+        writer.close()
+    seconds = time.perf_counter() - start
+    logging.info(f"Exported {rows} syslogs to {path} in {seconds:.1f}s")
+    return {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def _write_batch(pa, writer, schema, columns: dict) -> int:
+    table = pa.Table.from_pydict(columns, schema=schema)
+    writer.write_table(table)
+    for values in columns.values():
+        values.clear()
+    return table.num_rows
@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+
+from app.config import BaseConfig
+from app.utils.utils import generate_mkdn_message
+from jira import JIRA, JIRAError
+from requests.adapters import HTTPAdapter
+from typing import List
+
+# Jira client of this process
+_jira_client = None
+_jira_client_pid = None
+_jira_client_lock = threading.Lock()
+
+
+def get_jira_client() -> JIRA:
+    """
+    Jira client shared by everything in this process, its session keeps the TLS connections open.
+    A new client is created after a fork
+    :return:
+    """
+    global _jira_client, _jira_client_pid
+    if _jira_client is None or _jira_client_pid != os.getpid():
+        with _jira_client_lock:
+            if _jira_client is None or _jira_client_pid != os.getpid():
+                jira = JIRA(
+                    server=BaseConfig.JIRA_URL,
+                    basic_auth=(BaseConfig.JIRA_EMAIL, BaseConfig.JIRA_API_TOKEN),
+                    get_server_info=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BaseConfig.JIRA_POOL_SIZE)
+                jira._session.mount("https://", adapter)
+                jira._session.mount("http://", adapter)
+                _jira_client, _jira_client_pid = jira, os.getpid()
+    return _jira_client
+
+
+def create_jira_issue(message: dict) -> str:
+    """
+    Create jira ticket with metadata
+    :param message:
+    :return:
+    """
+    jira = get_jira_client()
+    issue_dict = {
+        "project": {"id": BaseConfig.JIRA_PROJECT},
+        "summary": f"P1 - Error message from {message['src_ip']}",
+        "description": generate_mkdn_message(message=message, format="JIRA"),
+        "issuetype": {'name': 'Bug'},
+        "labels": ["OPS", "NETWORK"],
+        "priority": {
+                 "name": "Highest",
+                 "id": "1",
+                 "iconUrl": "https://slack-integration.atlassian.net/images/icons/priorities/highest.svg"
+             },
+        "environment": "Backbone Network"
+    }
+    try:
+        response = jira.create_issue(fields=issue_dict)
+        return f"{BaseConfig.JIRA_URL}/browse/{response.key}"
+    except JIRAError as e:
+        logging.error(f"Error creating jira issue: {e}")
+
+
+def closed_jira_issues(urls: List[str]) -> set:
+    """
+    The tickets of a list that are done
+    :param urls: ticket urls as returned by create_jira_issue
+    :return: urls of the closed tickets, empty if jira could not be asked
+    """
+    keys = {url.rsplit("/", 1)[-1]: url for url in urls}
+    jql = f"key in ({', '.join(keys)}) AND statusCategory = Done"
+    try:
+        # Tickets that were deleted are ignored instead of failing the query
+        issues = get_jira_client().search_issues(jql, maxResults=len(keys), fields="key", validate_query=False)
+    except JIRAError as e:
+        logging.error(f"Error checking the status of {len(keys)} jira issues: {e}")
+        return set()
+    return {keys[issue.key] for issue in issues if issue.key in keys}
@@ -0,0 +1,230 @@
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Latency buckets in seconds, from a regex parse to a slow Slack or Jira call
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    """
+    A metric with optional labels. Values are kept per label values tuple, metric.labels(...) returns the child
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = dict()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self.children.items()):
+            lines.extend(self._render_child(values=values, child=child))
+        return "\n".join(lines)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, values: tuple, child) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.get()}"]
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get(self) -> float:
+        return self.value
+
+
+class _FunctionValue:
+    __slots__ = ("function",)
+
+    def __init__(self, function: Callable[[], float]):
+        self.function = function
+
+    def get(self) -> float:
+        try:
+            return self.function()
+        except Exception as e:
+            logging.error(f"Error reading metric: {e}")
+            return float("nan")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    """
+    Gauge that is set, or read from a function when the metrics are rendered
+    """
+    type = "gauge"
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float], *values: str) -> None:
+        with self.lock:
+            self.children[values] = _FunctionValue(function=function)
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum", "lock")
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name=name, documentation=documentation, labelnames=labelnames, registry=registry)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _new_child(self):
+        return _HistogramValue(upper_bounds=self.buckets)
+
+    def _render_child(self, values: tuple, child) -> list:
+        with child.lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="+Inf"' if upper_bound == float("inf") else f'le="{upper_bound!r}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of this process in the Prometheus text format
+    """
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = dict()
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in list(self.metrics.values())) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0", registry: Optional[Registry] = None) -> ThreadingHTTPServer:
+    """
+    Serve /metrics from a background thread, for processes that don't run the flask app
+    :param port:
+    :param host:
+    :param registry:
+    :return:
+    """
+    registry = registry or REGISTRY
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            payload = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics on {host}:{port}/metrics")
+    return server
+
+
+# Metrics of the ingest, slack and task stages
+STAGE_SECONDS = Histogram("syslog_stage_seconds", "Time spent per syslog processing stage", labelnames=("stage",))
+SYSLOGS_TOTAL = Counter("syslogs_total",
+                        "Syslogs by outcome: dropped, stored, suppressed, digested, posted, post_failed, post_dropped",
+                        labelnames=("outcome",))
+QUEUE_DEPTH = Gauge("queue_depth", "Items waiting per queue", labelnames=("queue",))
+TASK_SECONDS = Histogram("celery_task_seconds", "Celery task run time", labelnames=("task",))
+TASK_FAILURES = Counter("celery_task_failures_total", "Celery tasks that raised", labelnames=("task",))
+SLACK_ACTIONS = Counter("slack_actions_total", "Slack interactions received", labelnames=("action",))
+SLACK_ACTION_FAILURES = Counter("slack_action_enqueue_failures_total", "Slack interactions whose task was not queued",
+                                labelnames=("action",))
@@ -0,0 +1,202 @@
+import collections
+import gzip
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+
+from app.config import BaseConfig
+from app.models.slack_integration import get_slack_integration
+from app.models.syslog_summary import compact_syslogs
+from app.models.syslog_writer import SyslogWriter
+from app.utils import syslog_parser
+from app.utils.rules import ACTION_DROP, ACTION_STORE, load_rules, route
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Optional, Set, Tuple
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Bytes of lines parsed and inserted together
+CHUNK_SIZE = 1 << 20
+# Fields of a stored syslog that are not part of the parsed message
+STORED_FIELDS = ("_id", "repeat_count", "pinned", "date_created")
+
+# Rules of a parse process, loaded on its first chunk
+_rules = None
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Whole lines of a file, about chunk_size bytes at a time. Gzip files are decompressed as they are read, plain
+    files are mapped into memory
+    :param path:
+    :param chunk_size:
+    :return:
+    """
+    with open(path, "rb") as file:
+        gzipped = file.read(2) == GZIP_MAGIC
+        size = os.fstat(file.fileno()).st_size
+        if not gzipped:
+            if not size:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = 0
+                while start < size:
+                    end = mapped.find(b"\n", start + chunk_size)
+                    end = size if end == -1 else end + 1
+                    yield mapped[start:end]
+                    start = end
+            return
+    with gzip.open(path, "rb") as file:
+        tail = b""
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            data = tail + data
+            end = data.rfind(b"\n") + 1
+            tail = data[end:]
+            if end:
+                yield data[:end]
+        if tail:
+            yield tail
+
+
+def parse_chunk(task: Tuple[bytes, Optional[str], int, datetime, Optional[datetime]]) \
+        -> Tuple[List[dict], List[Tuple[int, str]], dict, Set[Tuple[str, date]]]:
+    """
+    Parse and route a chunk of lines into syslogs in their stored form, run in the parse processes. Syslogs are dated
+    by their own timestamp, timestamps without a year are placed in the year before now
+    :param task: (chunk, src_ip, src_port, now, expired), src_ip None uses the hostname in each syslog, syslogs dated
+    before expired are not stored, the retention would delete them
+    :return: (syslogs, (index, channel) of the syslogs to post, counts of lines, skipped, dropped, undated and expired
+    lines, (src_ip, day) of the syslogs)
+    """
+    global _rules
+    if _rules is None:
+        _rules = load_rules()
+    chunk, src_ip, src_port, now, expired = task
+    documents = []
+    posts = []
+    days = set()
+    counts = {"lines": 0, "skipped": 0, "dropped": 0, "undated": 0, "expired": 0}
+    for line in chunk.split(b"\n"):
+        if not line.strip():
+            continue
+        counts["lines"] += 1
+        message = syslog_parser.parse(data=line, src_ip=src_ip, src_port=src_port)
+        if message["src_ip"] is None:
+            message["src_ip"] = message.get("hostname")
+            if message["src_ip"] is None:
+                counts["skipped"] += 1
+                continue
+        rule = route(rules=_rules, message=message)
+        if rule.action == ACTION_DROP:
+            counts["dropped"] += 1
+            continue
+        date_created = syslog_parser.parse_timestamp(time=message["time"], now=now)
+        if date_created is None:
+            counts["undated"] += 1
+            date_created = now
+        elif date_created.tzinfo is not None:
+            # Stored dates are naive local times like the ones the syslog server stores
+            date_created = date_created.astimezone().replace(tzinfo=None)
+        if expired and date_created < expired:
+            counts["expired"] += 1
+            continue
+        if rule.action != ACTION_STORE:
+            posts.append((len(documents), rule.channel))
+        document = {key: value for key, value in message.items() if value is not None}
+        document.update(repeat_count=0, pinned=False, date_created=date_created)
+        documents.append(document)
+        days.add((message["src_ip"], date_created.date()))
+    return documents, posts, counts, days
+
+
+def replay_files(paths: List[str], src_ip: str = None, src_port: int = 514, processes: int = None,
+                 post_rate: float = 0, chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Store the syslogs of archived files, one raw syslog per line, plain or gzip. Chunks of lines are parsed in a
+    process pool and each chunk is one insert_many, device counters and rollups are updated by the syslog writer.
+    Syslogs go through the rules but not through storm suppression or the digest. Syslogs older than the raw
+    retention are not stored, the days that were stored are summarized again once all files are stored
+    :param paths: files to replay
+    :param src_ip: address of the device that sent the syslogs, by default the hostname in each syslog
+    :param src_port: port the syslogs were sent from
+    :param processes: parse processes, by default one per core, 0 parses in this process
+    :param post_rate: max slack posts per second of the syslogs the rules post, the rest are only stored. 0 posts
+    nothing
+    :param chunk_size: bytes of lines per chunk
+    :return: report with the counts, seconds and lines_per_second
+    """
+    processes = os.cpu_count() if processes is None else processes
+    slack = get_slack_integration() if post_rate else None
+    writer = slack.writer if slack else SyslogWriter()
+    report = {"files": len(paths), "bytes": 0, "lines": 0, "stored": 0, "skipped": 0, "dropped": 0, "undated": 0,
+              "expired": 0, "posted": 0, "not_posted": 0, "summaries": 0}
+    next_post = 0.0
+    expired = None
+    if BaseConfig.SYSLOG_RETENTION_DAYS:
+        expired = datetime.now() - timedelta(days=BaseConfig.SYSLOG_RETENTION_DAYS)
+    # Devices per day that were stored, summarized at the end as their rollups may already have expired
+    stored_days = dict()
+
+    def tasks() -> Iterator[tuple]:
+        for path in paths:
+            # Yearless timestamps are dated relative to when the file was last written
+            now = datetime.fromtimestamp(os.path.getmtime(path))
+            for chunk in read_chunks(path=path, chunk_size=chunk_size):
+                report["bytes"] += len(chunk)
+                yield chunk, src_ip, src_port, now, expired
+
+    def store(result: tuple) -> None:
+        nonlocal next_post
+        documents, posts, counts, days = result
+        for key, count in counts.items():
+            report[key] += count
+        stored = writer.insert_many(documents=documents)
+        report["stored"] += stored
+        if not stored:
+            return
+        for device, day in days:
+            stored_days.setdefault(datetime(day.year, day.month, day.day), set()).add(device)
+        for index, channel in posts:
+            now = time.monotonic()
+            if not slack or now < next_post:
+                report["not_posted"] += 1
+                continue
+            next_post = now + 1 / post_rate
+            message = {key: value for key, value in documents[index].items() if key not in STORED_FIELDS}
+            message["syslog_id"] = str(documents[index]["_id"])
+            message["channel"] = channel
+            if slack.poster.submit(message=message):
+                report["posted"] += 1
+            else:
+                report["not_posted"] += 1
+
+    start = time.perf_counter()
+    if processes:
+        with multiprocessing.Pool(processes=processes) as pool:
+            # A few chunks per process are in flight, files are read as fast as they are stored
+            pending = collections.deque()
+            for task in tasks():
+                pending.append(pool.apply_async(parse_chunk, (task,)))
+                if len(pending) >= processes * 2:
+                    store(result=pending.popleft().get())
+            while pending:
+                store(result=pending.popleft().get())
+    else:
+        for task in tasks():
+            store(result=parse_chunk(task=task))
+    writer.flush()
+    if slack:
+        slack.poster.flush()
+    if report["expired"]:
+        logging.warning(f"Skipped {report['expired']} syslogs older than the {BaseConfig.SYSLOG_RETENTION_DAYS} days "
+                        f"syslog retention")
+    report["summaries"] = compact_syslogs(days=stored_days)
+    seconds = time.perf_counter() - start
+    report["seconds"] = seconds
+    report["lines_per_second"] = report["lines"] / seconds if seconds else 0.0
+    logging.info(f"Replayed {report['lines']} lines of {len(paths)} files in {seconds:.1f}s")
+    return report
@@ -0,0 +1,193 @@
+import fnmatch
+import ipaddress
+import logging
+import re
+
+from app.config import BaseConfig, load_file
+from typing import List, Optional
+
+ACTION_DROP = "drop"
+ACTION_STORE = "store"
+ACTION_POST = "post"
+ACTION_ROUTE = "route"
+ACTIONS = (ACTION_DROP, ACTION_STORE, ACTION_POST, ACTION_ROUTE)
+# Max cached matches per src_ip, facility and mnemonic value
+CACHE_SIZE = 65536
+
+
+class Rule:
+    """
+    A routing rule, every condition that is set has to match. Lists match any of their values
+    """
+    __slots__ = ("name", "action", "channel", "src_ip", "severity", "facility", "mnemonic", "contains", "regex",
+                 "text")
+
+    def __init__(self, name: str, action: str, channel: str = None, src_ip: List[str] = None,
+                 severity: List[int] = None, facility: List[str] = None, mnemonic: List[str] = None,
+                 contains: List[str] = None, regex: str = None):
+        if action not in ACTIONS:
+            raise ValueError(f"Rule {name}: unknown action {action}, expected one of {', '.join(ACTIONS)}")
+        if action == ACTION_ROUTE and not channel:
+            raise ValueError(f"Rule {name}: route needs a channel")
+        self.name = name
+        self.action = action
+        self.channel = channel
+        self.src_ip = [ipaddress.ip_network(network, strict=False) for network in src_ip] if src_ip else None
+        self.severity = set(severity) if severity else None
+        self.facility = facility
+        self.mnemonic = mnemonic
+        self.contains = contains
+        self.regex = regex
+        # Substrings and the regex as one pattern
+        patterns = [re.escape(text) for text in contains or ()]
+        if regex:
+            patterns.append(f"(?:{regex})")
+        self.text = re.compile("|".join(patterns)) if patterns else None
+
+
+# Used when no rule matches: store everything and post up to LOGGING_LEVEL_FILTER
+DEFAULT_POST = Rule(name="default", action=ACTION_POST)
+DEFAULT_STORE = Rule(name="default", action=ACTION_STORE)
+
+
+class CidrTrie:
+    """
+    Binary prefix tree of networks, a lookup returns the bitmask of the rules whose networks contain the address
+    """
+    def __init__(self, bits: int):
+        self.bits = bits
+        # Node: [zero child, one child, mask of the rules with a network ending here]
+        self.root = [None, None, 0]
+
+    def insert(self, network, bit: int) -> None:
+        node = self.root
+        address = int(network.network_address)
+        for index in range(network.prefixlen):
+            branch = (address >> (self.bits - 1 - index)) & 1
+            if node[branch] is None:
+                node[branch] = [None, None, 0]
+            node = node[branch]
+        node[2] |= bit
+
+    def lookup(self, address: int) -> int:
+        node = self.root
+        mask = node[2]
+        for index in range(self.bits):
+            node = node[(address >> (self.bits - 1 - index)) & 1]
+            if node is None:
+                break
+            mask |= node[2]
+        return mask
+
+
+class RuleSet:
+    """
+    Rules compiled into bitmasks, bit i is rule i. Each condition maps a value to the mask of the rules it
+    satisfies (rules without the condition always do), the first rule left after and-ing the masks is the match.
+    Text conditions are only tested for the remaining rules, after one combined regex of all of them matched
+    """
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.all = (1 << len(rules)) - 1
+        self.tries = {4: CidrTrie(bits=32), 6: CidrTrie(bits=128)}
+        self.any_ip = 0
+        self.severities = [0] * 8
+        self.any_text = 0
+        for index, rule in enumerate(rules):
+            bit = 1 << index
+            if rule.src_ip is None:
+                self.any_ip |= bit
+            else:
+                for network in rule.src_ip:
+                    self.tries[network.version].insert(network=network, bit=bit)
+            for level in range(8):
+                if rule.severity is None or level in rule.severity:
+                    self.severities[level] |= bit
+            if rule.text is None:
+                self.any_text |= bit
+        patterns = [rule.text.pattern for rule in rules if rule.text is not None]
+        self.text = re.compile("|".join(f"(?:{pattern})" for pattern in patterns)) if patterns else None
+        self.ip_cache = dict()
+        self.facility_cache = dict()
+        self.mnemonic_cache = dict()
+
+    def match(self, message: dict) -> Optional[Rule]:
+        """
+        First rule that matches a parsed syslog
+        :param message:
+        :return: the rule or None
+        """
+        if not self.rules:
+            return None
+        level = message["level"]
+        mask = self.severities[level] if 0 <= level < 8 else self.all
+        if mask:
+            mask &= self._ip_mask(src_ip=message["src_ip"])
+        if mask:
+            mask &= self._field_mask(cache=self.facility_cache, field="facility", value=message.get("facility"))
+        if mask:
+            mask &= self._field_mask(cache=self.mnemonic_cache, field="mnemonic", value=message.get("mnemonic"))
+        if mask & ~self.any_text and self.text is not None and self.text.search(message["syslog"]) is None:
+            # None of the text conditions can match
+            mask &= self.any_text
+        while mask:
+            bit = mask & -mask
+            rule = self.rules[bit.bit_length() - 1]
+            if rule.text is None or rule.text.search(message["syslog"]) is not None:
+                return rule
+            mask ^= bit
+        return None
+
+    def _ip_mask(self, src_ip: str) -> int:
+        mask = self.ip_cache.get(src_ip)
+        if mask is None:
+            try:
+                address = ipaddress.ip_address(src_ip)
+                mask = self.any_ip | self.tries[address.version].lookup(address=int(address))
+            except ValueError:
+                mask = self.any_ip
+            self._cache(cache=self.ip_cache, key=src_ip, mask=mask)
+        return mask
+
+    def _field_mask(self, cache: dict, field: str, value: Optional[str]) -> int:
+        mask = cache.get(value)
+        if mask is None:
+            mask = 0
+            for index, rule in enumerate(self.rules):
+                patterns = getattr(rule, field)
+                if patterns is None or value is not None and any(fnmatch.fnmatchcase(value, glob) for glob in patterns):
+                    mask |= 1 << index
+            self._cache(cache=cache, key=value, mask=mask)
+        return mask
+
+    @staticmethod
+    def _cache(cache: dict, key, mask: int) -> None:
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        cache[key] = mask
+
+
+def load_rules(file_name: str = BaseConfig.SYSLOG_RULES_FILE) -> RuleSet:
+    """
+    Rules from a json list of rules, relative to the repository root. No file means no rules
+    :param file_name:
+    :return:
+    """
+    if not file_name:
+        return RuleSet(rules=[])
+    rules = [Rule(**rule) for rule in load_file(file_name=file_name)]
+    logging.info(f"Loaded {len(rules)} syslog rules from {file_name}")
+    return RuleSet(rules=rules)
+
+
+def route(rules: RuleSet, message: dict) -> Rule:
+    """
+    Rule to apply to a parsed syslog, the default one stores everything and posts up to LOGGING_LEVEL_FILTER
+    :param rules:
+    :param message:
+    :return:
+    """
+    rule = rules.match(message=message)
+    if rule is not None:
+        return rule
+    return DEFAULT_POST if message["level"] <= BaseConfig.LOGGING_LEVEL_FILTER else DEFAULT_STORE
@@ -0,0 +1,180 @@
+import re
+
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+# Messages without a PRI are user.notice (RFC 3164 section 4.3.3)
+DEFAULT_LEVEL = 5
+
+FACILITIES = (
+    "kern", "user", "mail", "daemon", "auth", "syslog", "lpr", "news", "uucp", "cron", "authpriv", "ftp",
+    "ntp", "security", "console", "solaris-cron", "local0", "local1", "local2", "local3", "local4", "local5",
+    "local6", "local7",
+)
+
+_CISCO_TIME = r"[*.]?(?P<time>(?:\d{4} )?[A-Z][a-z]{2} +\d{1,2}(?: \d{4})? \d\d:\d\d:\d\d(?:\.\d+)?(?: [A-Z]{2,5})?)"
+_CISCO_TAG = r"%(?P<facility>[A-Z][A-Z0-9_]*(?:-[A-Z][A-Z0-9_]*)*)-(?P<severity>[0-7])-(?P<mnemonic>[A-Z0-9_]+)"
+
+# <190>1531142: Sep 21 17:27:41.305: %MODULE-2-MOD_DIAG_FAIL: Module 2 reported failure
+# <189>52: router1: *Mar  1 18:46:11: %SYS-5-CONFIG_I: Configured from console by console
+CISCO = re.compile(
+    r"(?:<(?P<pri>\d{1,3})>)?(?:\d+: )?(?:(?P<host>[^\s:%]+): ?)?"
+    r"(?:" + _CISCO_TIME + r": )?" + _CISCO_TAG + r":? ?(?P<text>.*)",
+    re.S
+)
+CISCO_TAG = re.compile(_CISCO_TAG + r":? ?(?P<text>.*)", re.S)
+
+# <165>1 2003-10-11T22:14:15.003Z mymachine.example.com evntslog - ID47 [exampleSDID@32473 iut="3"] message
+RFC5424 = re.compile(
+    r"<(?P<pri>\d{1,3})>1 (?P<time>\S+) (?P<host>\S+) (?P<app>\S+) (?P<procid>\S+) (?P<msgid>\S+) "
+    r"(?P<sd>-|(?:\[(?:[^\]\"\\]|\\.|\"(?:[^\"\\]|\\.)*\")*\])+)(?: \ufeff?(?P<text>.*))?",
+    re.S
+)
+
+# <34>Oct 11 22:14:15 mymachine su: 'su root' failed for lonvick on /dev/pts/8
+RFC3164 = re.compile(
+    r"<(?P<pri>\d{1,3})>(?P<time>[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d) (?P<host>\S+) (?P<text>.*)",
+    re.S
+)
+
+PRI = re.compile(r"<(?P<pri>\d{1,3})>")
+
+TIME_FORMATS = (
+    "%b %d %H:%M:%S.%f", "%b %d %H:%M:%S", "%Y %b %d %H:%M:%S.%f", "%Y %b %d %H:%M:%S",
+    "%b %d %Y %H:%M:%S.%f", "%b %d %Y %H:%M:%S",
+)
+
+
+def parse(data: bytes, src_ip: str = None, src_port: int = None) -> dict:
+    """
+    Parse a Cisco, RFC 5424 or RFC 3164 syslog message into the fields stored on a Syslog.
+    Messages that match none of the formats are kept as is with the PRI severity
+    :param data: raw datagram
+    :param src_ip: address of the sender
+    :param src_port: port of the sender
+    :return:
+    """
+    message = data.decode("utf-8", "replace").strip()
+    match = CISCO.match(message)
+    if match is not None:
+        return _from_cisco(match=match, src_ip=src_ip, src_port=src_port)
+    match = RFC5424.match(message)
+    if match is not None:
+        pri = int(match["pri"])
+        return {
+            "src_ip": src_ip,
+            "src_port": src_port,
+            "time": match["time"],
+            "level": pri & 7,
+            "facility": _facility(pri=pri),
+            "mnemonic": None if match["msgid"] == "-" else match["msgid"],
+            "hostname": None if match["host"] == "-" else match["host"],
+            "structured_data": None if match["sd"] == "-" else match["sd"],
+            "syslog": match["text"] or message,
+        }
+    match = RFC3164.match(message)
+    if match is not None:
+        # Cisco tags without the Cisco header, e.g. relayed by another syslog server
+        tag = CISCO_TAG.search(match["text"])
+        if tag is not None:
+            return _from_cisco(match=tag, src_ip=src_ip, src_port=src_port, time=match["time"], host=match["host"])
+        pri = int(match["pri"])
+        return {
+            "src_ip": src_ip,
+            "src_port": src_port,
+            "time": match["time"],
+            "level": pri & 7,
+            "facility": _facility(pri=pri),
+            "hostname": match["host"],
+            "syslog": match["text"],
+        }
+    return _fallback(message=message, src_ip=src_ip, src_port=src_port)
+
+
+def parse_many(messages: Iterable[bytes], src_ip: str = None, src_port: int = None) -> List[dict]:
+    """
+    Parse a batch of messages from the same sender
+    :param messages:
+    :param src_ip:
+    :param src_port:
+    :return:
+    """
+    return [parse(data=data, src_ip=src_ip, src_port=src_port) for data in messages]
+
+
+def parse_timestamp(time: str, now: datetime = None) -> Optional[datetime]:
+    """
+    Convert the timestamp of a parsed message to a datetime. Timestamps without a year are placed in the
+    year that puts them closest before now. Timezone names are ignored. This is not done on the ingest path
+    :param time: "time" of a parsed message
+    :param now:
+    :return: None if the timestamp can't be parsed
+    """
+    now = now or datetime.now()
+    if time[4:5] == "-":
+        try:
+            return datetime.fromisoformat(time.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    value = time.lstrip("*.")
+    if value[-4:-3] == " " and value[-3:].isalpha():
+        value = value[:-4]
+    elif value[-5:-4] == " " and value[-4:].isalpha():
+        value = value[:-5]
+    value = " ".join(value.split())
+    for time_format in TIME_FORMATS:
+        try:
+            timestamp = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        if "%Y" not in time_format:
+            timestamp = timestamp.replace(year=now.year)
+            if timestamp > now + timedelta(days=1):
+                timestamp = timestamp.replace(year=now.year - 1)
+        return timestamp
+    return None
+
+
+def _from_cisco(match: re.Match, src_ip: str, src_port: int, time: str = None, host: str = None) -> dict:
+    groups = match.groupdict()
+    return {
+        "src_ip": src_ip,
+        "src_port": src_port,
+        "time": groups.get("time") or time or _now(),
+        "level": int(match["severity"]),
+        "facility": match["facility"],
+        "mnemonic": match["mnemonic"],
+        "hostname": groups.get("host") or host,
+        # The message starting at the %FACILITY-SEV-MNEMONIC tag
+        "syslog": match.string[match.start("facility") - 1:],
+    }
+
+
+def _fallback(message: str, src_ip: str, src_port: int) -> dict:
+    match = PRI.match(message)
+    if match is not None:
+        pri = int(match["pri"])
+        text = message[match.end():]
+        level, facility = pri & 7, _facility(pri=pri)
+    else:
+        text, level, facility = message, DEFAULT_LEVEL, None
+    tag = CISCO_TAG.search(text)
+    if tag is not None:
+        return _from_cisco(match=tag, src_ip=src_ip, src_port=src_port)
+    return {
+        "src_ip": src_ip,
+        "src_port": src_port,
+        "time": _now(),
+        "level": level,
+        "facility": facility,
+        "syslog": text or message,
+    }
+
+
+def _facility(pri: int) -> Optional[str]:
+    facility = pri >> 3
+    return FACILITIES[facility] if facility < len(FACILITIES) else None
+
+
+def _now() -> str:
+    return datetime.now().strftime("%b %d %H:%M:%S")
@@ -0,0 +1,84 @@
+import datetime
+import json
+
+from app.config import BaseConfig
+from app.models import Syslog
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import Iterator, Tuple
+from werkzeug.datastructures import MultiDict
+
+# Fields returned per syslog, the rest of the document is never read
+SEARCH_PROJECTION = {
+    "src_ip": 1, "src_port": 1, "level": 1, "facility": 1, "mnemonic": 1, "hostname": 1, "syslog": 1, "time": 1,
+    "repeat_count": 1, "thread_ts": 1, "jira_url": 1, "date_created": 1,
+}
+
+
+def parse_search_args(args: MultiDict) -> Tuple[dict, int]:
+    """
+    Mongo filter and page size of a syslog search. Repeated src_ip, level and mnemonic arguments match any value.
+    src_ip is required, the (src_ip, -_id) index is what serves the pages newest first
+    :param args: request arguments: src_ip, start, end (ISO 8601), level, mnemonic, q (text search), cursor, limit
+    :return: (filter, limit)
+    """
+    if not args.getlist("src_ip"):
+        raise ValueError("src_ip is required")
+    query = dict()
+    for field, values in (("src_ip", args.getlist("src_ip")), ("mnemonic", args.getlist("mnemonic"))):
+        if values:
+            query[field] = {"$in": values}
+    levels = args.getlist("level")
+    if levels:
+        try:
+            query["level"] = {"$in": [int(level) for level in levels]}
+        except ValueError:
+            raise ValueError(f"level must be a number: {', '.join(levels)}")
+    for name, operator in (("start", "$gte"), ("end", "$lt")):
+        if args.get(name):
+            try:
+                query.setdefault("date_created", dict())[operator] = datetime.datetime.fromisoformat(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be an ISO 8601 date: {args[name]}")
+    if args.get("q"):
+        query["$text"] = {"$search": args["q"]}
+    # Newest first, the cursor is the id of the last syslog of the previous page
+    if args.get("cursor"):
+        try:
+            query["_id"] = {"$lt": ObjectId(args["cursor"])}
+        except InvalidId:
+            raise ValueError(f"Invalid cursor: {args['cursor']}")
+    try:
+        limit = int(args.get("limit", BaseConfig.SYSLOG_API_PAGE_SIZE))
+    except ValueError:
+        raise ValueError(f"limit must be a number: {args['limit']}")
+    if not 0 < limit <= BaseConfig.SYSLOG_API_MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {BaseConfig.SYSLOG_API_MAX_PAGE_SIZE}")
+    return query, limit
+
+
+def stream_syslogs(query: dict, limit: int, batch_size: int = 500) -> Iterator[str]:
+    """
+    NDJSON lines of the syslogs matching a filter, read from the server side cursor one batch at a time. The last
+    line is {"next_cursor": ...}, null when there are no more syslogs
+    :param query: filter from parse_search_args
+    :param limit: syslogs per page
+    :param batch_size: documents per cursor batch
+    :return:
+    """
+    cursor = Syslog._get_collection().find(
+        query, projection=SEARCH_PROJECTION, sort=[("_id", -1)], limit=limit, batch_size=min(batch_size, limit)
+    )
+    count = 0
+    last_id = None
+    try:
+        for document in cursor:
+            last_id = document.pop("_id")
+            document["id"] = str(last_id)
+            if document.get("date_created"):
+                document["date_created"] = document["date_created"].isoformat()
+            count += 1
+            yield json.dumps(document) + "\n"
+    finally:
+        cursor.close()
+    yield json.dumps({"next_cursor": str(last_id) if count == limit else None}) + "\n"
@@ -1,59 +1,18 @@
+import hashlib
+import hmac
 import json
 import logging
-import matplotlib.pyplot as plt
 import sys
-import uuid
+import time
 
 from app.config import BaseConfig
 from celery import Celery
-from datetime import datetime, timedelta
 from flask import Flask
 from flask import Request
-from jira import JIRA, JIRAError
 
 # Constants
 DAYS = {"1 day chart": 1, "1 week chart": 7, "1 month chart": 30}
-
-
-def generate_chart(mongo_db_data: list, start_time: datetime, end_time: datetime) -> str:
-    """
-    Generating a chart based on the user input and from mongodb
-    :param mongo_db_data:
-    :param start_time:
-    :param end_time:
-    :return:
-    """
-    # Generating matplotlib chart xaxis and yaxis
-    data_from_db = {
-        datetime.strptime(f"{d['_id']['day']}-{d['_id']['month']}-{d['_id']['year']}", '%d-%m-%Y').isocalendar(): d["count"] for d in mongo_db_data
-    }
-    delta = end_time - start_time  # as timedelta
-    xaxis = list()
-    yaxis = list()
-    for i in range(delta.days + 1):
-        date = (start_time + timedelta(days=i)).date()
-        # Set default value to 0
-        count = 0
-        # If the database returns a datapoint, subsitute it
-        if date.isocalendar() in data_from_db:
-            count = data_from_db[date.isocalendar()]
-
-        xaxis.append(date)
-        yaxis.append(count)
-
-    # Create the chart
-    fig, ax = plt.subplots()
-    ax.bar(xaxis, yaxis)
-    ax.xaxis_date()
-    fig.autofmt_xdate()
-    plt.xlabel("Day")
-    plt.ylabel("# of Error Syslogs")
-
-    # Save chart to a file
-    temp_filename = f"tmp/{uuid.uuid4()}-chart.png"
-    plt.savefig(temp_filename)
-
-    return temp_filename
+EXPORT_DAYS = {"1 week of syslogs": 7, "1 month of syslogs": 30}
 
 
 def generate_200_ok():
@@ -76,34 +35,24 @@ def unmarshall_slack_api_request(api_request: Request) -> dict:
     return json.loads(api_request.form["payload"])
 
 
-def create_jira_issue(message: dict) -> str:
+def verify_slack_signature(body: bytes, timestamp: str, signature: str) -> bool:
     """
-    Create jira ticket with metadata
-    :param message:
+    Verify a request with Slack's signing secret, https://api.slack.com/authentication/verifying-requests-from-slack
+    :param body: raw request body
+    :param timestamp: X-Slack-Request-Timestamp header
+    :param signature: X-Slack-Signature header
     :return:
     """
-    jira = JIRA(
-        server=BaseConfig.JIRA_URL,
-        basic_auth=(BaseConfig.JIRA_EMAIL, BaseConfig.JIRA_API_TOKEN)
-    )
-    issue_dict = {
-        "project": {"id": BaseConfig.JIRA_PROJECT},
-        "summary": f"P1 - Error message from {message['src_ip']}",
-        "description": generate_mkdn_message(message=message, format="JIRA"),
-        "issuetype": {'name': 'Bug'},
-        "labels": ["OPS", "NETWORK"],
-        "priority": {
-                 "name": "Highest",
-                 "id": "1",
-                 "iconUrl": "https://slack-integration.atlassian.net/images/icons/priorities/highest.svg"
-             },
-        "environment": "Backbone Network"
-    }
+    if not timestamp or not signature:
+        return False
     try:
-        response = jira.create_issue(fields=issue_dict)
-        return f"{BaseConfig.JIRA_URL}/browse/{response.key}"
-    except JIRAError as e:
-        logging.error(f"Error creating jira issue: {e}")
+        if abs(time.time() - int(timestamp)) > BaseConfig.SLACK_SIGNATURE_MAX_AGE:
+            return False
+    except ValueError:
+        return False
+    base_string = b"v0:" + timestamp.encode() + b":" + body
+    expected = "v0=" + hmac.new(BaseConfig.SLACK_SIGNING_SECRET.encode(), base_string, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
 
 
 def configure_logging(app: Flask) -> None:
@@ -132,12 +81,25 @@ def make_celery() -> Celery:
     Celery app factory
     :return:
     """
-    return Celery(
+    celery = Celery(
         BaseConfig.APP_NAME,
         backend=BaseConfig.CELERY_RESULT_BACKEND,
         broker=BaseConfig.CELERY_BROKER_URL,
         include=["app.tasks"]
     )
+    # CPU bound renders don't wait behind API calls and the other way around. Old style setting names, like the
+    # CELERY_* settings init_celery copies from the flask config, celery refuses to mix both
+    celery.conf.CELERY_DEFAULT_QUEUE = "io"
+    celery.conf.CELERY_ROUTES = {
+        "app.tasks.tasks.generate_timeline_chart": {"queue": "charts"},
+        "app.tasks.tasks.generate_jira_ticket": {"queue": "io"},
+        "app.tasks.tasks.generate_syslog_export": {"queue": "io"},
+    }
+    # Raw syslogs are summarized every hour when celery beat runs, days that were summarized are skipped
+    celery.conf.CELERYBEAT_SCHEDULE = {
+        "compact-syslog-summaries": {"task": "app.tasks.tasks.compact_syslog_summaries", "schedule": 3600.0},
+    }
+    return celery
 
 
 def init_celery(celery: Celery, app: Flask) -> Celery:
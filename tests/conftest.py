@@ -0,0 +1,51 @@
+import os
+
+# The configuration is read when the app is imported. Tests always run against mongomock, the mongo fixture drops
+# every collection, and never reach Slack
+os.environ["MONGODB_HOST"] = "mongomock://localhost/slack_integration_test"
+os.environ.setdefault("HOST", "127.0.0.1")
+os.environ.setdefault("PORT", "5514")
+os.environ.setdefault("FLASK_PORT", "5040")
+os.environ.setdefault("MONGODB_PORT", "27017")
+os.environ.setdefault("SLACK_CHANNEL", "alerts")
+
+import pytest
+
+from app.config import BaseConfig
+from app.models import Syslog
+from mongoengine import connect
+from slack_sdk import WebClient
+from slack_sdk.web import SlackResponse
+
+connect(host=BaseConfig.MONGODB_HOST)
+
+
+@pytest.fixture
+def mongo():
+    """
+    Empty mongomock database
+    :return:
+    """
+    database = Syslog._get_collection().database
+    for name in database.list_collection_names():
+        database.drop_collection(name)
+    return database
+
+
+@pytest.fixture
+def slack_calls(monkeypatch):
+    """
+    Slack API calls of the test, every call succeeds
+    :return: [(api_method, kwargs)]
+    """
+    calls = []
+
+    def api_call(self, api_method, *, http_verb="POST", **kwargs):
+        calls.append((api_method, kwargs))
+        data = {"ok": True, "ts": f"1.{len(calls)}", "channel": "C1", "channels": [{"name": "alerts", "id": "C1"}],
+                "response_metadata": {"next_cursor": ""}}
+        return SlackResponse(client=self, http_verb=http_verb, api_url=api_method, req_args={}, data=data,
+                             headers={}, status_code=200)
+
+    monkeypatch.setattr(WebClient, "api_call", api_call)
+    return calls
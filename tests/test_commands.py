@@ -0,0 +1,18 @@
+from app import create_app
+from app.models import Syslog
+
+
+def test_migrate_syslogs(mongo):
+    collection = Syslog._get_collection()
+    collection.insert_many([
+        {"src_ip": "10.0.0.1", "src_port": 514, "level": 3, "time": "t", "syslog": "old"},
+        {"src_ip": "10.0.0.1", "src_port": 514, "level": 3, "time": "t", "syslog": "ticket", "jira_url": "https://j/1"},
+    ])
+    result = create_app().test_cli_runner().invoke(args=["migrate-syslogs"])
+    assert result.exit_code == 0, result.output
+    assert "Pinned 1 syslogs with a jira ticket, 1 syslogs can expire" in result.output
+    assert collection.find_one({"syslog": "old"})["pinned"] is False
+    assert collection.find_one({"syslog": "ticket"})["pinned"] is True
+    indexes = collection.index_information()
+    assert "src_ip_1__id_-1" in indexes
+    assert "syslog_text" in indexes
@@ -0,0 +1,81 @@
+import json
+import pytest
+
+from app.config import BaseConfig
+from app.utils.rules import ACTION_DROP, ACTION_POST, ACTION_ROUTE, ACTION_STORE, Rule, RuleSet, load_rules, route
+
+
+def message(src_ip: str = "10.0.0.1", level: int = 5, facility: str = "LINK", mnemonic: str = "UPDOWN",
+            syslog: str = "%LINK-5-UPDOWN: Interface Gi0/1, changed state to down") -> dict:
+    return {"src_ip": src_ip, "level": level, "facility": facility, "mnemonic": mnemonic, "syslog": syslog}
+
+
+def test_first_matching_rule_wins():
+    rules = RuleSet(rules=[
+        Rule(name="lab", action=ACTION_DROP, src_ip=["10.99.0.0/16"]),
+        Rule(name="links", action=ACTION_STORE, mnemonic=["UPDOWN"]),
+        Rule(name="everything", action=ACTION_POST),
+    ])
+    assert rules.match(message=message(src_ip="10.99.1.1")).name == "lab"
+    assert rules.match(message=message()).name == "links"
+    assert rules.match(message=message(mnemonic="CONFIG_I")).name == "everything"
+
+
+def test_networks():
+    rules = RuleSet(rules=[
+        Rule(name="host", action=ACTION_DROP, src_ip=["10.0.0.1"]),
+        Rule(name="site", action=ACTION_STORE, src_ip=["10.0.0.0/8", "2001:db8::/32"]),
+    ])
+    assert rules.match(message=message(src_ip="10.0.0.1")).name == "host"
+    assert rules.match(message=message(src_ip="10.200.0.1")).name == "site"
+    assert rules.match(message=message(src_ip="2001:db8::1")).name == "site"
+    assert rules.match(message=message(src_ip="192.168.0.1")) is None
+    # Hostnames used as the device never match a network
+    assert rules.match(message=message(src_ip="core-sw-01")) is None
+
+
+def test_severity_facility_and_mnemonic():
+    rules = RuleSet(rules=[
+        Rule(name="optics", action=ACTION_ROUTE, channel="optics", facility=["SFF8472", "GBIC*"], severity=[0, 1, 2]),
+        Rule(name="config", action=ACTION_STORE, mnemonic=["CONFIG_?"]),
+    ])
+    assert rules.match(message=message(facility="GBIC_SECURITY", level=2)).channel == "optics"
+    assert rules.match(message=message(facility="GBIC_SECURITY", level=3)) is None
+    assert rules.match(message=message(facility="SYS", mnemonic="CONFIG_I")).name == "config"
+    assert rules.match(message=message(facility=None, mnemonic=None)) is None
+
+
+def test_text_conditions():
+    rules = RuleSet(rules=[
+        Rule(name="bgp", action=ACTION_POST, contains=["BGP"], regex=r"neighbor 10\.0\."),
+        Rule(name="crash", action=ACTION_POST, contains=["Traceback", "core dumped"]),
+    ])
+    assert rules.match(message=message(syslog="%BGP-5-ADJCHANGE: neighbor 10.1.0.1 Down")).name == "bgp"
+    assert rules.match(message=message(syslog="ping neighbor 10.0.0.2 lost")).name == "bgp"
+    assert rules.match(message=message(syslog="process core dumped")).name == "crash"
+    assert rules.match(message=message(syslog="all good")) is None
+
+
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        Rule(name="typo", action="forward")
+    with pytest.raises(ValueError):
+        Rule(name="nowhere", action=ACTION_ROUTE)
+
+
+def test_default_rule(monkeypatch):
+    monkeypatch.setattr(BaseConfig, "LOGGING_LEVEL_FILTER", 2)
+    rules = RuleSet(rules=[])
+    assert route(rules=rules, message=message(level=2)).action == ACTION_POST
+    assert route(rules=rules, message=message(level=3)).action == ACTION_STORE
+
+
+def test_load_rules(tmp_path, monkeypatch):
+    monkeypatch.setattr(BaseConfig, "BASEDIR", str(tmp_path))
+    (tmp_path / "rules.json").write_text(json.dumps([
+        {"name": "lab noise", "action": "drop", "src_ip": ["10.99.0.0/16"]},
+        {"name": "optics", "action": "route", "channel": "network-optics", "facility": ["SFF8472"]},
+    ]))
+    rules = load_rules(file_name="rules.json")
+    assert [rule.name for rule in rules.rules] == ["lab noise", "optics"]
+    assert load_rules(file_name=None).match(message=message()) is None
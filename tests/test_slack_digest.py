@@ -0,0 +1,26 @@
+from app.config import BaseConfig
+from app.models import Syslog
+from app.models.slack_integration import SlackIntegration
+
+
+def test_digest_counts_storm_suppressed_repeats(monkeypatch, mongo, slack_calls):
+    monkeypatch.setattr(BaseConfig, "STORM_SUPPRESSION", True)
+    monkeypatch.setattr(BaseConfig, "SLACK_DIGEST", True)
+    slack = SlackIntegration()
+    slack.channel_ids[BaseConfig.SLACK_CHANNEL] = "C1"
+    for _ in range(5):
+        slack.process_syslog_message(data=b"<186>1: %LINK-2-UPDOWN: Interface Gi0/1, changed state to down",
+                                     address=("10.0.0.1", 514))
+    slack.digest.flush()
+    slack.suppressor.report()
+    slack.writer.flush()
+
+    posts = [kwargs for method, kwargs in slack_calls if method == "chat.postMessage"]
+    assert len(posts) == 1
+    digest = posts[0]["json"]["blocks"][0]["text"]["text"]
+    assert "*Syslogs* - 5 (level 2: 5)" in digest
+    assert "LINK-UPDOWN x5" in digest
+    assert slack.digest.digested == 1
+    syslog = Syslog.objects.get()
+    assert syslog.repeat_count == 4
+    assert syslog.thread_ts == "1.1"
@@ -0,0 +1,76 @@
+from app.utils import syslog_parser
+from datetime import datetime, timedelta, timezone
+
+
+def test_cisco():
+    message = syslog_parser.parse(
+        data=b"<190>1531142: Sep 21 17:27:41.305: %MODULE-2-MOD_DIAG_FAIL: Module 2 reported failure",
+        src_ip="10.0.0.1", src_port=514
+    )
+    assert message == {
+        "src_ip": "10.0.0.1", "src_port": 514, "time": "Sep 21 17:27:41.305", "level": 2, "facility": "MODULE",
+        "mnemonic": "MOD_DIAG_FAIL", "hostname": None, "syslog": "%MODULE-2-MOD_DIAG_FAIL: Module 2 reported failure",
+    }
+
+
+def test_cisco_with_hostname():
+    message = syslog_parser.parse(
+        data=b"<189>52: core-sw-01: *Mar  1 18:46:11.123: %LINEPROTO-5-UPDOWN: Line protocol on Interface Gi0/1"
+    )
+    assert message["hostname"] == "core-sw-01"
+    assert message["time"] == "Mar  1 18:46:11.123"
+    assert (message["level"], message["facility"], message["mnemonic"]) == (5, "LINEPROTO", "UPDOWN")
+
+
+def test_rfc5424():
+    message = syslog_parser.parse(
+        data=b"<165>1 2003-10-11T22:14:15.003Z mymachine.example.com evntslog - ID47 "
+             b"[exampleSDID@32473 iut=\"3\" eventSource=\"Application\"] An application event log entry"
+    )
+    assert message["time"] == "2003-10-11T22:14:15.003Z"
+    assert (message["level"], message["facility"], message["mnemonic"]) == (5, "local4", "ID47")
+    assert message["hostname"] == "mymachine.example.com"
+    assert message["structured_data"] == "[exampleSDID@32473 iut=\"3\" eventSource=\"Application\"]"
+    assert message["syslog"] == "An application event log entry"
+
+
+def test_rfc5424_without_structured_data():
+    message = syslog_parser.parse(data=b"<34>1 2003-10-11T22:14:15Z - su - - - 'su root' failed")
+    assert message["hostname"] is None
+    assert message["mnemonic"] is None
+    assert message["structured_data"] is None
+    assert message["syslog"] == "'su root' failed"
+
+
+def test_rfc3164():
+    message = syslog_parser.parse(data=b"<34>Oct 11 22:14:15 mymachine su: 'su root' failed for lonvick")
+    assert message["time"] == "Oct 11 22:14:15"
+    assert (message["level"], message["facility"], message["hostname"]) == (2, "auth", "mymachine")
+    assert message["syslog"] == "su: 'su root' failed for lonvick"
+
+
+def test_rfc3164_relaying_cisco():
+    message = syslog_parser.parse(data=b"<187>Oct 11 22:14:15 relay %LINK-3-UPDOWN: Interface Gi0/2, changed state")
+    assert (message["level"], message["facility"], message["mnemonic"]) == (3, "LINK", "UPDOWN")
+    assert (message["time"], message["hostname"]) == ("Oct 11 22:14:15", "relay")
+    assert message["syslog"] == "%LINK-3-UPDOWN: Interface Gi0/2, changed state"
+
+
+def test_unknown_format_keeps_the_message():
+    message = syslog_parser.parse(data=b"<11>something happened")
+    assert (message["level"], message["facility"], message["syslog"]) == (3, "user", "something happened")
+    message = syslog_parser.parse(data=b"no header at all")
+    assert (message["level"], message["facility"]) == (syslog_parser.DEFAULT_LEVEL, None)
+    assert message["syslog"] == "no header at all"
+
+
+def test_parse_timestamp():
+    now = datetime(2024, 1, 2, 12, 0, 0)
+    assert syslog_parser.parse_timestamp(time="Jan  1 10:00:00.500", now=now) == datetime(2024, 1, 1, 10, 0, 0, 500000)
+    # Without a year the closest date before now is used
+    assert syslog_parser.parse_timestamp(time="Dec 31 23:00:00", now=now) == datetime(2023, 12, 31, 23, 0, 0)
+    assert syslog_parser.parse_timestamp(time="*Mar  1 18:46:11.123 UTC", now=now).month == 3
+    assert syslog_parser.parse_timestamp(time="2003-10-11T22:14:15.003Z", now=now) == \
+        datetime(2003, 10, 11, 22, 14, 15, 3000, tzinfo=timezone.utc)
+    assert syslog_parser.parse_timestamp(time="2003-10-11T22:14:15+02:00").utcoffset() == timedelta(hours=2)
+    assert syslog_parser.parse_timestamp(time="not a time", now=now) is None
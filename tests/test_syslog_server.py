@@ -0,0 +1,83 @@
+from app.models.syslog_server import SyslogServerStats, SyslogStreamProtocol
+
+
+class FakeServer:
+    def __init__(self):
+        self.received = []
+        self.stats = SyslogServerStats()
+        self.paused_streams = set()
+
+    def queue_full(self) -> bool:
+        return False
+
+    def receive(self, data: bytes, address: tuple) -> None:
+        self.received.append(data)
+
+
+class FakeTransport:
+    def get_extra_info(self, name: str):
+        return "10.0.0.1", 1234
+
+    def close(self) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+    def pause_reading(self) -> None:
+        pass
+
+    def resume_reading(self) -> None:
+        pass
+
+
+def receive(*chunks: bytes, max_message: int = 40) -> tuple:
+    """
+    Feed chunks to a connection the way asyncio does, through get_buffer
+    :return: (messages, framing errors)
+    """
+    server = FakeServer()
+    protocol = SyslogStreamProtocol(server=server, buffer_size=64, max_message=max_message)
+    protocol.connection_made(FakeTransport())
+    for chunk in chunks:
+        while chunk:
+            buffer = protocol.get_buffer(len(chunk))
+            size = min(len(buffer), len(chunk))
+            buffer[:size] = chunk[:size]
+            protocol.buffer_updated(size)
+            chunk = chunk[size:]
+    protocol.eof_received()
+    return server.received, server.stats.framing_errors
+
+
+def test_newline_framing():
+    assert receive(b"<13>first\n<13>sec", b"ond\r\n", b"<13>last") == ([b"<13>first", b"<13>second", b"<13>last"], 0)
+
+
+def test_newline_framing_of_messages_starting_with_digits():
+    # The first message decides, a later message that looks octet counted is still a line
+    assert receive(b"2021 Jan 1 hello\n", b"42 <13>looks counted\n") == \
+        ([b"2021 Jan 1 hello", b"42 <13>looks counted"], 0)
+    assert receive(b"router1: 12 up\n") == ([b"router1: 12 up"], 0)
+    assert receive(b"123") == ([b"123"], 0)
+
+
+def test_octet_counting():
+    assert receive(b"1", b"0 <13>hello", b"9", b"5 <1>ab", b"7 <1>a", b"bcd") == \
+        ([b"<13>hello9", b"<1>ab", b"<1>abcd"], 0)
+
+
+def test_octet_counting_skips_newlines_between_frames():
+    assert receive(b"5 <1>ab\n", b"\r\n5 <1>cd") == ([b"<1>ab", b"<1>cd"], 0)
+
+
+def test_octet_counting_frame_without_count():
+    assert receive(b"5 <1>ab", b"foo\n6 <1>xyz") == ([b"<1>ab", b"<1>xyz"], 1)
+
+
+def test_oversized_and_truncated_frames():
+    assert receive(b"99 <1>" + b"x" * 99 + b"8 <1>last") == ([], 2)
+
+
+def test_oversized_line():
+    assert receive(b"<13>" + b"x" * 60 + b"\n<13>next\n") == ([b"<13>next"], 1)
@@ -0,0 +1,102 @@
+import mongomock
+import threading
+import time
+
+from app.config import BaseConfig
+from app.models import Device, Syslog, SyslogRollup
+from app.models.syslog_server import AsyncSyslogServer
+from app.models.syslog_spool import SyslogSpool
+from pymongo.errors import AutoReconnect
+
+ADDRESS = ("10.0.0.1", 514)
+
+
+def test_uncommitted_syslogs_are_read_again_after_a_restart(tmp_path):
+    spool = SyslogSpool(directory=str(tmp_path))
+    for index in range(5):
+        spool.append(data=b"<13>syslog %d" % index, address=ADDRESS)
+    assert spool.read(max_records=2, timeout=0) == [(b"<13>syslog 0", ADDRESS), (b"<13>syslog 1", ADDRESS)]
+    spool.commit()
+    assert len(spool.read(max_records=2, timeout=0)) == 2
+    spool.close()
+
+    spool = SyslogSpool(directory=str(tmp_path))
+    assert [data for data, address in spool.read(max_records=10, timeout=0)] == \
+        [b"<13>syslog 2", b"<13>syslog 3", b"<13>syslog 4"]
+    spool.commit()
+    spool.close()
+    assert SyslogSpool(directory=str(tmp_path)).read(max_records=10, timeout=0) == []
+
+
+def test_torn_record_is_skipped(tmp_path):
+    spool = SyslogSpool(directory=str(tmp_path))
+    spool.append(data=b"<13>complete", address=ADDRESS)
+    spool.append(data=b"<13>torn by a crash", address=ADDRESS)
+    spool.close()
+    path = spool._path(segment=spool.write_segment)
+    with open(path, "r+b") as file:
+        file.truncate(file.seek(0, 2) - 3)
+    spool = SyslogSpool(directory=str(tmp_path))
+    assert spool.read(max_records=10, timeout=0) == [(b"<13>complete", ADDRESS)]
+    assert spool.corrupt == 1
+
+
+def test_quota_drops_the_oldest_segments(tmp_path):
+    spool = SyslogSpool(directory=str(tmp_path), segment_size=100, quota=300)
+    for index in range(40):
+        spool.append(data=b"<13>syslog %02d" % index, address=ADDRESS)
+    records = spool.read(max_records=100, timeout=0)
+    assert spool.dropped + len(records) == 40
+    assert records[-1] == (b"<13>syslog 39", ADDRESS)
+    assert spool.total <= 300 + 100
+
+
+def test_mongo_failing_mid_window_stores_every_syslog_once(tmp_path, monkeypatch, mongo, slack_calls):
+    monkeypatch.setattr(BaseConfig, "SYSLOG_SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(BaseConfig, "SYSLOG_SPOOL_COMMIT_INTERVAL", 0.05)
+    outage = {"inserts": 3}
+    insert_many = mongomock.collection.Collection.insert_many
+    command = mongomock.database.Database.command
+
+    def failing_insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        if self.name == "syslog" and outage["inserts"]:
+            # The connection drops after half of the batch was written
+            outage["inserts"] -= 1
+            try:
+                insert_many(self, documents[:len(documents) // 2], *args, **kwargs)
+            except Exception:
+                pass
+            raise AutoReconnect("connection reset by peer")
+        return insert_many(self, documents, *args, **kwargs)
+
+    def failing_command(self, *args, **kwargs):
+        if outage["inserts"]:
+            raise AutoReconnect("connection refused")
+        return command(self, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, "insert_many", failing_insert_many)
+    monkeypatch.setattr(mongomock.database.Database, "command", failing_command)
+
+    server = AsyncSyslogServer(spool=True, udp=False, tcp_port=0)
+    count = 2000
+    for index in range(count):
+        server.spool.append(data=b"<189>1: %%LINK-5-UPDOWN: Interface Gi0/%d changed state to down" % index,
+                            address=("10.0.0.%d" % (index % 3), 514))
+    consumer = threading.Thread(target=server._consume_spool, daemon=True)
+    consumer.start()
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and (
+            server.spool.backlog() or server.spool.committed != (server.spool.read_segment, server.spool.read_position)
+    ):
+        time.sleep(0.05)
+    server.stopping.set()
+    consumer.join(timeout=10)
+
+    assert outage["inserts"] == 0
+    assert server.spool.backlog() == 0
+    assert server.spool.committed == (server.spool.read_segment, server.spool.read_position)
+    assert Syslog.objects.count() == count
+    assert len(Syslog.objects.distinct("syslog")) == count
+    assert sum(device.syslog_count for device in Device.objects) == count
+    assert sum(rollup.count for rollup in SyslogRollup.objects) == count
@@ -0,0 +1,45 @@
+import hashlib
+import hmac
+import pytest
+import time
+
+from app.config import BaseConfig
+from app.utils.utils import verify_slack_signature
+
+SECRET = "test-signing-secret"
+BODY = b"payload=%7B%22type%22%3A%22block_actions%22%7D"
+
+
+def sign(body: bytes, timestamp: str, secret: str = SECRET) -> str:
+    return "v0=" + hmac.new(secret.encode(), b"v0:" + timestamp.encode() + b":" + body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def signing_secret(monkeypatch):
+    monkeypatch.setattr(BaseConfig, "SLACK_SIGNING_SECRET", SECRET)
+
+
+def test_valid_signature():
+    timestamp = str(int(time.time()))
+    assert verify_slack_signature(body=BODY, timestamp=timestamp, signature=sign(body=BODY, timestamp=timestamp))
+
+
+def test_wrong_secret_or_body():
+    timestamp = str(int(time.time()))
+    assert not verify_slack_signature(body=BODY, timestamp=timestamp,
+                                      signature=sign(body=BODY, timestamp=timestamp, secret="other"))
+    assert not verify_slack_signature(body=BODY + b"x", timestamp=timestamp,
+                                      signature=sign(body=BODY, timestamp=timestamp))
+
+
+def test_replayed_request():
+    timestamp = str(int(time.time()) - BaseConfig.SLACK_SIGNATURE_MAX_AGE - 10)
+    assert not verify_slack_signature(body=BODY, timestamp=timestamp, signature=sign(body=BODY, timestamp=timestamp))
+
+
+def test_missing_or_invalid_headers():
+    timestamp = str(int(time.time()))
+    assert not verify_slack_signature(body=BODY, timestamp="", signature=sign(body=BODY, timestamp=timestamp))
+    assert not verify_slack_signature(body=BODY, timestamp=timestamp, signature="")
+    assert not verify_slack_signature(body=BODY, timestamp="yesterday",
+                                      signature=sign(body=BODY, timestamp="yesterday"))